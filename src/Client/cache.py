@@ -0,0 +1,118 @@
+import os, re, struct, threading, zlib
+from array import array
+# Local copy of everything this client has been sent, so scrollback and search work without the server.
+# cdatabase.db holds "channel;id;time;user;message" lines (channel is "@dm" for direct messages) and
+# cdatabase.idx one (id, offset, channel crc) record per line. The index is loaded at startup, the lines are
+# only read when they're shown. high_water is the newest channel message id, sent with /sync on connect.
+CACHE_FILE = "cdatabase.db"
+INDEX_FILE = "cdatabase.idx"
+RECORD = struct.Struct("<QQI")
+WORD = re.compile(r"\w+")
+DM = "@dm"
+lock = threading.Lock()
+ids = set()
+high_water = 0
+by_channel = {} # {channel crc: array of offsets into CACHE_FILE, oldest first}
+names = {} # {channel crc: channel name}
+
+def crc(channel: str) -> int:
+    return zlib.crc32(channel.encode())
+def split(line: str):
+    # a delivered line -> (channel, "id;time;user;message")
+    if line.startswith("@dm;"):
+        return DM, line[4:]
+    if line.startswith("#"):
+        channel, rest = line[1:].split(";", 1)
+        return channel, rest
+    return "general", line
+def load():
+    global high_water
+    try:
+        size = os.path.getsize(CACHE_FILE)
+        with open(INDEX_FILE, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    dm = crc(DM)
+    count = len(data) // RECORD.size
+    for k in range(count):
+        i, offset, channel = RECORD.unpack_from(data, k * RECORD.size)
+        if offset >= size:
+            # the line never made it to disk, drop it and everything after it
+            count = k
+            break
+        ids.add(i)
+        by_channel.setdefault(channel, array("Q")).append(offset)
+        if channel != dm and i > high_water:
+            high_water = i
+    if count * RECORD.size != len(data):
+        with open(INDEX_FILE, "r+b") as f:
+            f.truncate(count * RECORD.size)
+    with open(CACHE_FILE, "rb") as f:
+        for channel, offsets in by_channel.items():
+            f.seek(offsets[0])
+            names[channel] = f.readline().decode().split(";", 1)[0]
+def add(line: str) -> bool:
+    # stores a delivered line, False if it was already here
+    return bool(add_many([line]))
+def add_many(lines: list) -> list:
+    # stores a batch of delivered lines with one open of each file, returns the ones that were new
+    global high_water
+    new = []
+    with lock:
+        with open(CACHE_FILE, "ab") as f, open(INDEX_FILE, "ab") as idx:
+            offset = f.seek(0, 2)
+            for line in lines:
+                channel, rest = split(line)
+                try:
+                    i = int(rest.split(";", 1)[0])
+                except ValueError:
+                    continue
+                if i in ids:
+                    continue
+                data = f"\n{channel};{rest}".encode()
+                f.write(data)
+                idx.write(RECORD.pack(i, offset + 1, crc(channel)))
+                ids.add(i)
+                by_channel.setdefault(crc(channel), array("Q")).append(offset + 1)
+                names[crc(channel)] = channel
+                offset += len(data)
+                if channel != DM and i > high_water:
+                    high_water = i
+                new.append(line)
+    return new
+def channels() -> list:
+    return sorted(name for name in names.values() if name != DM)
+def _lines(offsets) -> list:
+    out = []
+    with open(CACHE_FILE, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            out.append(f.readline().decode().rstrip("\n"))
+    return out
+def _as_delivered(line: str) -> str:
+    # back to the format the server delivers, so it prints the same way
+    channel, rest = line.split(";", 1)
+    if channel == DM:
+        return "@dm;" + rest
+    return rest if channel == "general" else f"#{channel};{rest}"
+def history(channel: str, count: int = 20) -> list:
+    with lock:
+        offsets = by_channel.get(crc(channel), array("Q"))[-count:]
+    return [_as_delivered(line) for line in _lines(offsets)]
+def find(channel: str, query: str, limit: int = 20) -> list:
+    # every word of query in the message, newest first, no server needed
+    words = set(WORD.findall(query.lower()))
+    with lock:
+        offsets = by_channel.get(crc(channel), array("Q"))[::-1]
+    found = []
+    with open(CACHE_FILE, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            line = f.readline().decode().rstrip("\n")
+            text = line.split(";", 4)[-1].replace("\\n", " ").lower()
+            if words.issubset(WORD.findall(text)):
+                found.append(_as_delivered(line))
+                if len(found) == limit:
+                    break
+    return found
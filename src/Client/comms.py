@@ -1,9 +1,14 @@
-import threading, socket, time, db, ast
-from prompt_toolkit import PromptSession
-from time import sleep
-past_time = 0
-session = PromptSession()
+import asyncio, os, time, compress, cache, frames
+from collections import deque
+from core import ATTACHMENT, Client
 username = "Bob"
+ports = [frames.SESSION_PORT] # servers to try in turn, more than one for a cluster with a standby
+tls = None # the server's certificate file with --tls, or "system" to check it against the system's CAs
+channel = "general" # messages without a "#channel " in front go here, /join switches it
+client = None
+FRAME = 0.05 # incoming lines are drawn at most 20 times a second, so a big catch-up can't starve the prompt
+BATCH = 200 # most lines drawn per frame, a backlog bigger than this only shows its newest lines
+pending = deque() # delivered lines waiting to be drawn
 def unfix_message(i: str):
     o = ""
     b = False
@@ -23,135 +28,170 @@ def unfix_message(i: str):
         else:
             o += v
     return o
-def fetch_messages():
-    HOST = "127.0.0.1"
-    PORT = 6090
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen(5)
+def format_line(line: str) -> str:
+    # "id;time;user;message", with "#channel;" in front for anything outside general and "@dm;" for DMs
+    room = None
+    if line.startswith("@dm;"):
+        # DMs are stored as "@recipient message"
+        _, timed, user, text = line[4:].split(";", 3)
+        recipient, _, text = text.partition(" ")
+        when = time.strftime('%H:%M', time.localtime(float(timed)))
+        return f"[{when}] {user} -> {recipient}: {unfix_message(text)}"
+    if line.startswith("#"):
+        room, line = line[1:].split(";", 1)
+    if line.count(";") < 3:
+        return line
+    _, timed, user, text = line.split(";", 3)
+    when = time.strftime('%H:%M', time.localtime(float(timed)))
+    text = ATTACHMENT.sub(lambda m: f"[{m.group(3)}, {int(m.group(2)) // 1024} KB, /save {m.group(1)}]", text)
+    return f"[{when}] {'#' + room + ' ' if room else ''}{user}: {unfix_message(text)}"
+def print_line(line: str):
+    print(format_line(line))
+def receive(lines: list):
+    # delivered or synced lines go into the local cache, and get drawn on the next frame unless we already had them
+    pending.extend(cache.add_many(lines))
+async def render():
+    # draws whatever came in since the last frame with one print, above the prompt
     while True:
-        client, addr = server_socket.accept()
-        try:
-            messages = client.recv(4096)
-            # Decode bytes to string before splitting
-            messages_str = messages.decode()
-            for i in messages_str.split("\n"):
-                print(f"{db.fetch_user(i)}: {unfix_message(db.fetch_message(i))}")
-        except Exception as e:
-            print(f"Error in fetch_messages: {e}")
-        finally:
-            client.close()
-
-def send_message():
-    print("Press [Alt/Option+Enter] or [Esc] followed by [Enter] to accept input.")
-    message = session.prompt("Enter message: ", multiline=True)
-    message = str(message)
-    HOST = "127.0.0.1"
-    PORT = 9980
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((HOST, PORT))
-    client_socket.sendall(f"{username};{message}".encode())
-    client_socket.close()
-
-def heartbeat():
-    HOST = "127.0.0.1"
-    PORT = 8070
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen(3)
-    while True:
-        try:
-            client, addr = server_socket.accept()
-            data = client.recv(1024)
-            tries = 10
-            while not data and tries > 0:
-                data = client.recv(1024)
-                tries -= 1
-            client.sendall(str(time.time()).encode("utf-8"))
-            client.close()  # Close client connection after each heartbeat
-        except Exception as e:
-            print(f"Heartbeat error: {e}")
-            break
-    server_socket.close()
-
-def main():
-    HOST = "127.0.0.1"
-    PORT = 10740
-    AUTH_PORT = 9281
-    
-    # Step 1: Set up client listening socket for server's authentication callback first
-    client_auth_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_auth_listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    client_auth_listener.bind((HOST, 12090))
-    client_auth_listener.listen(1)
-    client_auth_listener.settimeout(10)
-    
-    # Step 2: Connect to main server socket
-    print("Connecting to main server socket...")
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((HOST, PORT))
-    print("Sending Ping...")
-    client_socket.sendall(b"Ping")
-    
-    # Step 3: Connect to authentication socket simultaneously
-    print("Connecting to authentication socket...")
-    auth_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    auth_socket.connect((HOST, AUTH_PORT))
-    print("Sending AuthRequest...")
-    auth_socket.sendall(b"AuthRequest")
-    
-    # Step 4: Wait for server responses
+        await asyncio.sleep(FRAME)
+        if not pending:
+            continue
+        out = []
+        if len(pending) > BATCH:
+            skipped = len(pending) - BATCH
+            for _ in range(skipped):
+                pending.popleft()
+            out.append(f"... {skipped} earlier messages, /history to read them")
+        while pending:
+            out.append(format_line(pending.popleft()))
+        print("\n".join(out))
+def local(message: str) -> bool:
+    # /history [count] and /find <words> read the local cache, they work with the server gone
+    name, _, arg = message.partition(" ")
+    if name == "/history":
+        for line in cache.history(channel, int(arg) if arg.strip().isdigit() else 20):
+            print_line(line)
+        return True
+    if name == "/find":
+        for line in cache.find(channel, arg) or ["Nothing found"]:
+            print_line(line)
+        return True
+    return False
+async def files(message: str) -> bool:
+    # /attach <file> [message] uploads a file and posts it, /save <sha256> [file] downloads one (to its hash in
+    # the current folder if no file is given). Either carries on from where it stopped if it was cut off before
+    name, _, arg = message.partition(" ")
+    if name not in ("/attach", "/save"):
+        return False
+    target, _, rest = arg.strip().partition(" ")
+    if not target:
+        print(f"Usage: {name} {'<file> [message]' if name == '/attach' else '<sha256> [file]'}")
+        return True
+    if client is None or not client.connected:
+        print("Can't reach the server")
+        return True
     try:
-        # Server should send "Pong" on main socket
-        client_socket.settimeout(5)
-        data = client_socket.recv(1024)
-        
-        # Server should send "Auth1" on auth socket  
-        auth_socket.settimeout(5)
-        auth_response = auth_socket.recv(1024)
-        
-        if data == b"Pong" and auth_response == b"Auth1":
-            print("Connected and authenticated with server")
-            
-            # Step 5: Wait for server's authentication callback
-            try:
-                server_conn, addr = client_auth_listener.accept()
-                server_auth_data = server_conn.recv(1024)
-                if server_auth_data == b"Authed":
-                    print("Full authentication completed")
-                    server_conn.close()
-                    client_auth_listener.close()
-                    auth_socket.close()
-                    client_socket.close()
-                    
-                    # Start client threads
-                    threading.Thread(target=heartbeat, daemon=True).start()
-                    threading.Thread(target=fetch_messages, daemon=True).start()
-                    
-                    print("Client ready - you can start sending messages")
-                    while True:
-                        send_message()
-                else:
-                    exit("Server authentication callback failed.")
-            except TimeoutError:
-                exit("Server authentication callback timeout.")
+        if name == "/attach":
+            text = rest if channel == "general" or rest.startswith("#") else f"#{channel} {rest}"
+            await client.attach(os.path.expanduser(target), text)
         else:
-            exit("Authentication Failed.")
-            
+            path = os.path.expanduser(rest.strip() or target)
+            print(f"Saved {await client.download(target, path)} bytes to {path}")
+    except (OSError, ValueError, TimeoutError) as e: # ConnectionError and FileNotFoundError are OSErrors
+        print(f"{name[1:].capitalize()} failed: {e}")
+    return True
+async def send_message(message: str):
+    global channel
+    if local(message) or await files(message):
+        return
+    if channel != "general" and not message.startswith("#"):
+        message = f"#{channel} {message}"
+    words = message.split(" ", 2)
+    command = words[1] if message.startswith("#") and len(words) > 1 else words[0]
+    if client is None or not client.connected:
+        print("Can't reach the server, message not sent")
+        return
+    try:
+        if not command.startswith("/"):
+            asyncio.ensure_future(post(message))
+            return
+        reply = await client.command(message)
+    except ConnectionError:
+        print("Can't reach the server, message not sent")
+        return
+    for line in reply.split("\n"):
+        print_line(line)
+    if reply.startswith("Joined #"):
+        channel = reply[8:]
+    elif reply.startswith("Left #") and reply[6:] == channel:
+        channel = "general"
+async def post(message: str):
+    # waits for the server's ack off to the side, so the prompt is free straight away
+    try:
+        await client.send(message)
+    except ConnectionError:
+        print("Lost the server, the message goes out again once it's back")
     except TimeoutError:
-        exit("Connection timeout during authentication.")
-    except Exception as e:
-        exit(f"Authentication error: {e}")
-    finally:
-        # Clean up sockets
+        print("The server didn't confirm the message, it goes out again on the next reconnect")
+async def reconnect():
+    # when the connection drops, keeps trying the servers in turn and picks up from the newest cached message
+    k = 0
+    while True:
+        await asyncio.sleep(1)
+        if client.connected:
+            continue
+        client.port = ports[k % len(ports)]
+        k += 1
+        try:
+            if not await client.connect(cache.channels(), cache.high_water):
+                print(f"Reconnected to port {client.port}")
+        except OSError:
+            pass
+async def main():
+    global client
+    # prompt_toolkit is slow to import, so it's only imported once we're running
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.patch_stdout import patch_stdout
+    cache.load()
+    compress.load_dictionary()
+    client = Client(username, on_lines=receive, port=ports[0], tls=True if tls == "system" else tls)
+    try:
+        # only what was posted since the newest message we have comes back
+        error = await client.connect(cache.channels(), cache.high_water)
+        if error:
+            exit(error)
+        # connecting doesn't claim the name, DMs need it registered to this address
+        registered = await client.command(f"/register {username}")
+        if not registered.startswith("Registered"):
+            print(registered)
+        print("Client ready - you can start sending messages")
+    except OSError:
+        print("Server unreachable, working offline: /history and /find still read the local cache")
+    session = PromptSession()
+    print("Press [Alt/Option+Enter] or [Esc] followed by [Enter] to accept input.")
+    with patch_stdout():
+        drawing = asyncio.ensure_future(render())
+        watching = asyncio.ensure_future(reconnect())
         try:
-            client_socket.close()
-            auth_socket.close() 
-            client_auth_listener.close()
-        except:
+            while True:
+                message = await session.prompt_async("Enter message: ", multiline=True)
+                await send_message(str(message))
+        except (EOFError, KeyboardInterrupt):
             pass
+        finally:
+            drawing.cancel()
+            watching.cancel()
+            if client is not None:
+                await client.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    import sys
+    if len(sys.argv) > 1:
+        username = sys.argv[1]
+    # python comms.py <username> [--tls certificate] [port ...]
+    args = sys.argv[2:]
+    if "--tls" in args[:-1]:
+        tls = args.pop(args.index("--tls") + 1)
+        args.remove("--tls")
+    ports = [int(port) for port in args] or ports
+    asyncio.run(main())
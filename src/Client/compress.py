@@ -0,0 +1,143 @@
+import base64, os, sys, zlib
+from collections import Counter
+try:
+    import zstandard
+except ImportError: # zstd is optional, zlib always works
+    zstandard = None
+# Compression for deliveries. The client lists the codecs it has after its "Ping", the server answers
+# "Pong <codec> <dictionary id>" and compresses every delivery to that client from then on.
+# A compressed delivery is HEADER + one compression stream, made per connection and primed with a shared
+# dictionary of common chat text, which is what makes short deliveries worth compressing at all.
+# The same file lives in src/Server and src/Client.
+PREFERENCE = ["zstd", "zlib"] # the first one both ends have wins
+MARKER = b"\x00" # plain deliveries are text and never start with a NUL byte
+CODEC_BYTES = {"zlib": b"z", "zstd": b"s"}
+DICT_FILE = "chat.dict"
+DICT_SIZE = 16 * 1024
+CHUNK = 64 * 1024
+dictionary = b""
+dict_id = 0
+
+def available() -> list:
+    return [c for c in PREFERENCE if c != "zstd" or zstandard is not None]
+def negotiate(offered: list):
+    for codec in available():
+        if codec in offered:
+            return codec
+    return None
+def load_dictionary(path: str = DICT_FILE) -> int:
+    try:
+        with open(path, "rb") as f:
+            use_dictionary(f.read())
+    except FileNotFoundError:
+        use_dictionary(b"")
+    return dict_id
+def use_dictionary(data: bytes):
+    global dictionary, dict_id
+    dictionary = data
+    dict_id = zlib.crc32(data) if data else 0
+def save_dictionary(data: bytes, path: str = DICT_FILE):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+    use_dictionary(data)
+def encode_dictionary() -> str:
+    # for sending the dictionary over the text protocol
+    return base64.b64encode(dictionary).decode()
+def train(samples: list, size: int = DICT_SIZE) -> bytes:
+    # samples are delivery lines, the dictionary is whatever text turns up in them most
+    if zstandard is not None and len(samples) >= 100:
+        try:
+            return zstandard.train_dictionary(size, [s.encode() for s in samples]).as_bytes()
+        except zstandard.ZstdError:
+            pass # too little or too uniform data, fall back to the plain one
+    # plain content dictionary: the most common fields and words, weighted by the bytes they'd save
+    counts = Counter()
+    for line in samples:
+        fields = line.split(";", 3)
+        if len(fields) == 4:
+            counts[f";{fields[1][:6]}"] += 1 # timestamps share their first digits for days
+            counts[f";{fields[2]};"] += 1
+            line = fields[3]
+        counts.update(w + " " for w in line.split(" ") if w)
+    picked = []
+    total = 0
+    for text, count in sorted(counts.items(), key=lambda item: item[1] * len(item[0]), reverse=True):
+        data = text.encode()
+        if count < 2:
+            continue
+        if total + len(data) > size:
+            continue
+        picked.append(data)
+        total += len(data)
+    # zlib and zstd both find matches near the end of the dictionary cheapest, so the best go last
+    return b"".join(reversed(picked))
+def train_from(paths: list, tail: int = 1024 * 1024) -> bytes:
+    # trains on the last tail bytes of each log, the recent end of a log is never compressed on disk
+    lines = []
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                f.seek(max(0, os.path.getsize(path) - tail))
+                lines += [l for l in f.read().decode(errors="replace").split("\n")[1:] if l]
+        except FileNotFoundError:
+            pass
+    return train(lines) if len(lines) >= 100 else b""
+def header(codec: str) -> bytes:
+    return MARKER + CODEC_BYTES[codec] + dict_id.to_bytes(4, "big")
+def parse_header(data: bytes):
+    # -> (codec, dictionary id, rest) for a compressed delivery, (None, 0, data) for a plain one
+    if not data.startswith(MARKER) or len(data) < 6:
+        return None, 0, data
+    for codec, byte in CODEC_BYTES.items():
+        if data[1:2] == byte:
+            return codec, int.from_bytes(data[2:6], "big"), data[6:]
+    raise ValueError("unknown compression")
+def compressor(codec: str):
+    # compress() / flush() stream
+    if codec == "zstd":
+        data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        return zstandard.ZstdCompressor(level=3, dict_data=data).compressobj()
+    if dictionary:
+        return zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    return zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS, 9)
+def decompressor(codec: str):
+    # decompress() stream
+    if codec == "zstd":
+        data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        return zstandard.ZstdDecompressor(dict_data=data).decompressobj()
+    if dictionary:
+        return zlib.decompressobj(zlib.MAX_WBITS, dictionary)
+    return zlib.decompressobj(zlib.MAX_WBITS)
+def frame(stream, codec: str, payload: bytes) -> bytes:
+    # one payload out of a stream that lives as long as the connection, flushed so the other end can
+    # decompress it right away while later frames still get to refer back to it
+    if codec == "zstd":
+        return stream.compress(payload) + stream.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    return stream.compress(payload) + stream.flush(zlib.Z_SYNC_FLUSH)
+def chunks(codec: str, payload: bytes):
+    # the compressed delivery in pieces, so sending starts before the whole payload is compressed
+    stream = compressor(codec)
+    yield header(codec)
+    for i in range(0, len(payload), CHUNK):
+        out = stream.compress(payload[i:i + CHUNK])
+        if out:
+            yield out
+    yield stream.flush()
+if __name__ == "__main__":
+    # python compress.py --train [log ...] builds chat.dict from the last MB of each log
+    if len(sys.argv) > 1 and sys.argv[1] == "--train":
+        paths = sys.argv[2:] or ["database.db"]
+        data = train_from(paths)
+        if not data:
+            sys.exit("Not enough messages to train on")
+        with open(paths[0], "rb") as f:
+            f.seek(max(0, os.path.getsize(paths[0]) - 4 * 1024)) # about one delivery
+            payload = f.read()
+        for codec in available():
+            for d in (b"", data):
+                use_dictionary(d)
+                size = len(b"".join(chunks(codec, payload)))
+                print(f"{codec}{' + dictionary' if d else ''}: last {len(payload)} bytes -> {size}")
+        save_dictionary(data)
+        print(f"Wrote {DICT_FILE}, {len(data)} bytes, id {dict_id:08x}")
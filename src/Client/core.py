@@ -0,0 +1,315 @@
+import asyncio, hashlib, inspect, os, re, ssl, threading, time
+from collections import namedtuple
+import compress, frames
+# The client's connection to the server: one socket on the session port and one asyncio event loop for
+# sending, receiving, pings and command replies. Nothing here prints or touches the cache, whoever owns the
+# Client gets delivered lines through on_lines and decides what to do with them, or reads them as Messages.
+# It binds no local ports, so bots and load tests can run as many clients as they like in one process, from
+# async code with Client or from plain threads with SyncClient.
+# With TLS, each connection saves the session the server gave it and the next one resumes it, so reconnecting
+# (after a failover, or thousands of bots at once) skips the certificate exchange and key agreement.
+# Attachments are uploaded once per content in chunks, and a message only carries a reference to one, see
+# upload(). Uploads and downloads that get cut off carry on from where they stopped when they're tried again.
+Message = namedtuple("Message", "channel id time user text") # channel is "@dm" for DMs, text is still escaped
+ACK_TIMEOUT = 5 # seconds send() waits for an ack before sending the message again
+RESEND_WINDOW = 600 # the server remembers message ids this long (dedup.WINDOW), older ones aren't sent again
+CHUNK = 256 * 1024 # bytes of a file in one UPLOAD frame
+ATTACHMENT = re.compile(r"\[attachment ([0-9a-f]{64}) (\d+) ([^\]]*)\]") # how messages refer to attachments
+_loop = None # event loop shared by every SyncClient, started the first time one is made
+_loop_lock = threading.Lock()
+
+class _Resuming(ssl.SSLContext):
+    # asyncio has no way to pass a session to resume, so the context hands its saved one to every connection
+    session = None
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session or self.session)
+def tls_context(trust: str = None) -> ssl.SSLContext:
+    # trust is the server's certificate (or the CA that signed it) when it isn't signed by one the system trusts.
+    # Clients sharing a context share the saved session too
+    context = _Resuming(ssl.PROTOCOL_TLS_CLIENT)
+    if trust:
+        context.load_verify_locations(trust)
+    else:
+        context.load_default_certs()
+    return context
+def parse(line: str) -> Message:
+    # a delivered line -> Message
+    channel = "general"
+    if line.startswith("@dm;"):
+        channel, line = "@dm", line[4:]
+    elif line.startswith("#"):
+        channel, line = line[1:].split(";", 1)
+    i, timed, user, text = line.split(";", 3)
+    return Message(channel, int(i), float(timed), user, text)
+def attachments(text: str) -> list:
+    # [(sha256, size, name)] for the attachments a message refers to
+    return [(digest, int(size), name) for digest, size, name in ATTACHMENT.findall(text)]
+class Client:
+    def __init__(self, username: str, on_lines=None, host: str = "127.0.0.1", port: int = frames.SESSION_PORT,
+                 tls=None):
+        self.username = username
+        self.on_lines = on_lines # called with a list of delivered lines, from the event loop
+        self.messages = asyncio.Queue() # without on_lines, deliveries queue up here as Messages
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.stream = None # decompression stream, lives as long as the connection
+        self.replies = {} # {request number: future for the reply}
+        self.number = 0
+        self.task = None
+        self.missed = 0 # lines the server coalesced into gaps because we fell behind, they come back through /sync
+        self.newest = 0 # newest channel message id delivered, connecting again picks up from here
+        self.channels = () # what the last connect() joined
+        # None for a plain connection, True to check the server against the system's CAs, a certificate file to
+        # trust, or a context from tls_context()
+        self.tls = tls if tls is None or isinstance(tls, ssl.SSLContext) else tls_context(None if tls is True else tls)
+        self.resumed = False # whether the last TLS handshake resumed a saved session
+        self.prefix = os.urandom(6).hex() # message ids are this and a count, unique without asking the server
+        self.sent = 0
+        self.unacked = {} # {message id: (SEND payload, when it was first sent)} until the server acks it,
+                          # connect() sends these again
+        self.acks = {} # {message id: future send() is waiting on}
+        self.downloads = {} # {sha256: (open file, future for when it's all written)}
+    async def connect(self, channels=None, newest: int = None) -> str:
+        # says hello and starts reading, returns the server's error (a taken username) or ""
+        # calling it again after the connection drops (to another server, after a failover) resumes where the
+        # last one stopped instead of fetching everything again
+        channels = self.channels if channels is None else channels
+        newest = self.newest if newest is None else newest
+        self.channels, self.newest = tuple(channels), newest
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.tls,
+                                                                 server_hostname=self.host if self.tls else None)
+        hello = ";".join([self.username, ",".join(compress.available()), f"{compress.dict_id:08x}", str(newest),
+                          " ".join("#" + c for c in channels)])
+        self._write(frames.HELLO, hello.encode())
+        got = await frames.read_async(self.reader)
+        if got is None or got[0] != frames.WELCOME:
+            raise ConnectionError("server hung up before welcoming us")
+        if self.tls is not None:
+            # the server's session tickets came in before the welcome, the next connect() resumes from one
+            tls = self.writer.get_extra_info("ssl_object")
+            self.resumed, self.tls.session = tls.session_reused, tls.session
+        head, _, data = got[1].partition(b"\n")
+        codec, dict_id, error = head.decode().split(";", 2)
+        if error:
+            self.writer.close()
+            return error
+        if codec and int(dict_id, 16) != compress.dict_id:
+            # the server's dictionary changed (or we never had it), it came along with the welcome
+            compress.save_dictionary(data)
+        self.stream = compress.decompressor(codec) if codec else None
+        self.task = asyncio.ensure_future(self._read_loop())
+        now = time.monotonic()
+        for message_id, (payload, sent) in list(self.unacked.items()):
+            # sent before the last connection dropped, the server drops any it already stored. Past the window
+            # it could have forgotten the id and would store it twice, so those are given up on
+            if now - sent > RESEND_WINDOW:
+                del self.unacked[message_id]
+                continue
+            self._write(frames.SEND, payload)
+        return ""
+    def _deliver(self, lines: list):
+        for line in lines:
+            if not line.startswith("@"):
+                self.newest = max(self.newest, parse(line).id)
+        if lines and self.on_lines is not None:
+            self.on_lines(lines)
+        elif lines:
+            for line in lines:
+                self.messages.put_nowait(parse(line))
+    async def _resync(self, first: int, last: int):
+        # fetches the stretch of messages a gap stood in for, what came after it was delivered as usual
+        try:
+            reply = await self.command(f"/sync {first - 1}")
+        except ConnectionError:
+            return
+        self._deliver([line for line in reply.split("\n") if line and parse(line).id <= last])
+    def _write(self, kind: int, payload: bytes):
+        if self.writer is None or self.writer.is_closing():
+            raise ConnectionError("not connected")
+        self.writer.write(frames.pack(kind, payload))
+    async def _read_loop(self):
+        try:
+            while (got := await frames.read_async(self.reader)) is not None:
+                kind, payload = got
+                if kind == frames.DELIVERY:
+                    if self.stream is not None:
+                        payload = self.stream.decompress(payload)
+                    self._deliver([line for line in payload.decode().split("\n") if line])
+                elif kind == frames.GAP:
+                    count, first, last = map(int, payload.decode().split(";"))
+                    self.missed += count
+                    asyncio.ensure_future(self._resync(first, last))
+                elif kind == frames.ACKED:
+                    message_id = payload.decode()
+                    self.unacked.pop(message_id, None)
+                    future = self.acks.pop(message_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(message_id)
+                elif kind == frames.REPLY:
+                    number, _, reply = payload.decode().partition(";")
+                    future = self.replies.pop(int(number), None)
+                    if future is not None and not future.done():
+                        future.set_result(reply)
+                elif kind == frames.FILE:
+                    digest, offset, size, data = payload.split(b";", 3)
+                    download = self.downloads.get(digest.decode())
+                    if download is not None:
+                        download[0].seek(int(offset))
+                        download[0].write(data)
+                        if int(offset) + len(data) == int(size) and not download[1].done():
+                            download[1].set_result(int(size))
+                elif kind == frames.PING:
+                    self._write(frames.PONG, str(time.time()).encode())
+        finally:
+            futures = list(self.replies.values()) + list(self.acks.values())
+            for future in futures + [future for _, future in self.downloads.values()]:
+                if not future.done():
+                    future.set_exception(ConnectionError("connection lost"))
+            self.replies.clear()
+            self.acks.clear()
+            self.messages.put_nowait(None) # wakes up anyone waiting in next_message
+            self.writer.close()
+    async def send(self, text: str, timeout: float = ACK_TIMEOUT, tries: int = 3) -> str:
+        # a message, "#channel text" for anything outside general. Returns its id once the server has it, sending
+        # it again every timeout seconds (it can be dropped by a rate limit) under the same id, so it's stored
+        # once. Raises TimeoutError after tries sends, or ConnectionError if the connection drops, and either way
+        # it stays in unacked and goes out again on the next connect()
+        self.sent += 1
+        message_id = f"{self.prefix}{self.sent:x}"
+        payload = f"{message_id};{text}".encode()
+        self._write(frames.SEND, payload) # not connected: raises and nothing is kept
+        self.unacked[message_id] = (payload, time.monotonic())
+        future = self.acks[message_id] = asyncio.get_running_loop().create_future()
+        for attempt in range(tries):
+            if attempt:
+                self._write(frames.SEND, payload)
+            await self.writer.drain()
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.acks.pop(message_id, None)
+        raise TimeoutError(f"no ack for message {message_id}")
+    async def command(self, text: str) -> str:
+        # "/command args" (or "#channel /command args"), returns the server's reply
+        self.number += 1
+        future = asyncio.get_running_loop().create_future()
+        self.replies[self.number] = future
+        self._write(frames.COMMAND, f"{self.number};{text}".encode())
+        await self.writer.drain()
+        return await future
+    async def upload(self, path: str) -> str:
+        # stores a file on the server and returns the reference to it to put in a message. Nothing is sent if
+        # the server has the file already, and a file partly sent before carries on from where that stopped.
+        # Raises ValueError if the server won't take it
+        found = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                found.update(chunk)
+        digest, size = found.hexdigest(), os.path.getsize(path)
+        reply = await self.command(f"/upload {digest} {size}")
+        if not reply.isdigit():
+            raise ValueError(reply)
+        offset = int(reply)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while offset < size:
+                chunk = f.read(CHUNK)
+                self._write(frames.UPLOAD, f"{digest};{offset};".encode() + chunk)
+                await self.writer.drain()
+                offset += len(chunk)
+        reply = await self.command(f"/upload {digest} {size}") # stored once the server says it has all of it
+        if reply != str(size):
+            raise ValueError(reply if not reply.isdigit() else f"the server only has {reply} of {size} bytes")
+        name = os.path.basename(path).replace("]", ")").replace(";", ",")
+        return f"[attachment {digest} {size} {name}]"
+    async def attach(self, path: str, text: str = "") -> str:
+        # uploads a file and sends text with a reference to it, returns the message id like send()
+        return await self.send(f"{text} {await self.upload(path)}".strip())
+    async def download(self, digest: str, path: str) -> int:
+        # writes an attachment to path and returns its size. What's already in path is taken to be the start
+        # of it, so a download that was cut off carries on
+        if digest in self.downloads:
+            raise ValueError(f"{digest} is already being downloaded")
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        f = open(path, "r+b" if offset else "wb")
+        future = asyncio.get_running_loop().create_future()
+        self.downloads[digest] = (f, future)
+        try:
+            # the file frames can come in before the reply, they're written as soon as they do
+            reply = await self.command(f"/download {digest} {offset}")
+            if not reply.isdigit():
+                raise FileNotFoundError(reply)
+            if offset < int(reply):
+                await future
+            return int(reply)
+        finally:
+            self.downloads.pop(digest, None)
+            f.close()
+    async def next_message(self, timeout: float = None):
+        # the next delivered Message, None once the connection is gone or after timeout seconds
+        if not self.connected and self.messages.empty():
+            return None
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+    async def run(self, handler):
+        # calls handler(client, message) for every Message until the connection closes, handler can be async
+        while (message := await self.next_message()) is not None:
+            result = handler(self, message)
+            if inspect.isawaitable(result):
+                await result
+    @property
+    def connected(self) -> bool:
+        return self.task is not None and not self.task.done()
+    async def wait_closed(self):
+        if self.task is not None:
+            await asyncio.gather(self.task, return_exceptions=True)
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        await self.wait_closed()
+def _background_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+class SyncClient:
+    # the same calls as Client for code without an event loop, every SyncClient shares one loop thread
+    def __init__(self, username: str, host: str = "127.0.0.1", port: int = frames.SESSION_PORT, timeout: float = 10,
+                 tls=None):
+        self.timeout = timeout
+        self.client = Client(username, host=host, port=port, tls=tls)
+    def _run(self, coroutine, timeout: float = None):
+        return asyncio.run_coroutine_threadsafe(coroutine, _background_loop()).result(timeout or self.timeout)
+    def connect(self, channels=None, newest: int = None) -> str:
+        return self._run(self.client.connect(channels, newest))
+    def send(self, text: str) -> str:
+        # it can take all of Client.send's tries to get an ack
+        return self._run(self.client.send(text), max(self.timeout, ACK_TIMEOUT * 3 + 1))
+    def command(self, text: str) -> str:
+        return self._run(self.client.command(text))
+    def upload(self, path: str) -> str:
+        # files take as long as they take, these wait without a timeout
+        return asyncio.run_coroutine_threadsafe(self.client.upload(path), _background_loop()).result()
+    def attach(self, path: str, text: str = "") -> str:
+        return asyncio.run_coroutine_threadsafe(self.client.attach(path, text), _background_loop()).result()
+    def download(self, digest: str, path: str) -> int:
+        return asyncio.run_coroutine_threadsafe(self.client.download(digest, path), _background_loop()).result()
+    def next_message(self, timeout: float = None):
+        # blocks for up to timeout seconds, forever if it's None
+        return asyncio.run_coroutine_threadsafe(self.client.next_message(timeout), _background_loop()).result()
+    @property
+    def connected(self) -> bool:
+        return self.client.connected
+    def close(self):
+        self._run(self.client.close())
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
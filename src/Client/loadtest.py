@@ -0,0 +1,41 @@
+import asyncio, sys, time
+from core import Client
+# Load test on the client library: python loadtest.py [clients] [messages per client] [channel]
+# Every client runs in this one process and joins the same channel, so each message is delivered to all of
+# them. Messages carry their send time, latency is measured from there to each delivery.
+clients = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+messages = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+channel = sys.argv[3] if len(sys.argv) > 3 else "load"
+latencies = []
+began = time.time() # messages from earlier runs come back in the catch-up on connect, they don't count
+
+def on_lines(lines: list):
+    now = time.time()
+    for line in lines:
+        text = line.split(";", 4)[-1]
+        if text.startswith("load ") and float(text[5:]) >= began:
+            latencies.append(now - float(text[5:]))
+def percentile(values: list, p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000 if values else 0
+async def main():
+    started = time.perf_counter()
+    pool = [Client(f"load-{n:05}", on_lines=on_lines) for n in range(clients)]
+    errors = await asyncio.gather(*(c.connect([channel]) for c in pool))
+    if any(errors):
+        sys.exit(next(e for e in errors if e))
+    print(f"{clients} clients connected in {time.perf_counter() - started:.2f}s")
+    started = time.perf_counter()
+    for _ in range(messages):
+        await asyncio.gather(*(c.send(f"#{channel} load {time.time()}") for c in pool))
+    sent = time.perf_counter() - started
+    print(f"{clients * messages} messages sent and acked in {sent:.2f}s ({clients * messages / sent:.0f}/s)")
+    expected = clients * messages * clients
+    deadline = time.time() + 30
+    while len(latencies) < expected and time.time() < deadline:
+        await asyncio.sleep(0.1)
+    done = time.perf_counter() - started
+    latencies.sort()
+    print(f"{len(latencies)}/{expected} deliveries in {done:.2f}s, latency p50 {percentile(latencies, 0.5):.1f}ms"
+          f" p99 {percentile(latencies, 0.99):.1f}ms max {percentile(latencies, 1):.1f}ms")
+    await asyncio.gather(*(c.close() for c in pool))
+asyncio.run(main())
@@ -0,0 +1,79 @@
+import asyncio, os, socket, ssl, subprocess, sys, tempfile, threading, time
+from core import Client, tls_context
+# TLS handshake benchmark: python tlsbench.py [handshakes] [port certificate]
+# Times full handshakes against ones that resume the session from the last connection. With no port it makes
+# a throwaway self-signed certificate with openssl and runs its own TLS listener set up like the server's.
+# With a port and the certificate the server was started with (--tls-cert), it connects Clients to that server.
+handshakes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+port = int(sys.argv[2]) if len(sys.argv) > 3 else None
+certificate = sys.argv[3] if len(sys.argv) > 3 else None
+listener_cpu = [0.0] # CPU seconds the local listener has spent handshaking, what a reconnect storm costs a server
+
+def make_certificate(folder: str) -> str:
+    # cert.pem with the key in it, good for 127.0.0.1
+    path = os.path.join(folder, "cert.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                    "-days", "1", "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+                    "-keyout", path, "-out", path], check=True, capture_output=True)
+    return path
+def listen(certificate: str) -> int:
+    # handshakes, sends one byte so the client gets its session ticket, and hangs up
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certificate)
+    context.num_tickets = 1
+    server = socket.create_server(("127.0.0.1", 0), backlog=128)
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            started = time.thread_time()
+            try:
+                with context.wrap_socket(conn, server_side=True) as tls:
+                    tls.sendall(b"W")
+            except OSError:
+                pass
+            listener_cpu[0] += time.thread_time() - started
+    threading.Thread(target=serve, daemon=True).start()
+    return server.getsockname()[1]
+def raw(port: int, certificate: str, resume: bool) -> tuple:
+    # -> (seconds, resumed handshakes)
+    context = tls_context(certificate)
+    session, resumed = None, 0
+    started = time.perf_counter()
+    for _ in range(handshakes):
+        with context.wrap_socket(socket.create_connection(("127.0.0.1", port)), server_hostname="127.0.0.1",
+                                 session=session) as tls:
+            tls.recv(1)
+            resumed += tls.session_reused
+            if resume:
+                session = tls.session
+    return time.perf_counter() - started, resumed
+async def clients(port: int, certificate: str, resume: bool) -> tuple:
+    # the same through Client.connect(), a fresh context each time can't resume anything
+    shared = tls_context(certificate)
+    resumed = 0
+    started = time.perf_counter()
+    for n in range(handshakes):
+        client = Client(f"tlsbench-{n:05}", port=port, tls=shared if resume else certificate)
+        error = await client.connect()
+        if error:
+            sys.exit(error)
+        resumed += client.resumed
+        await client.close()
+    return time.perf_counter() - started, resumed
+def main():
+    global port, certificate
+    with tempfile.TemporaryDirectory() as folder:
+        if port is None:
+            certificate = make_certificate(folder)
+            port = listen(certificate)
+            run = lambda resume: raw(port, certificate, resume)
+        else:
+            run = lambda resume: asyncio.run(clients(port, certificate, resume))
+        for resume in (False, True):
+            listener_cpu[0] = 0.0
+            seconds, resumed = run(resume)
+            cpu = f", listener CPU {listener_cpu[0] / handshakes * 1000:.2f}ms each" if listener_cpu[0] else ""
+            print(f"{'resumed' if resume else 'full':>7}: {handshakes} handshakes in {seconds:.2f}s, "
+                  f"{handshakes / seconds:.0f}/s, {resumed} resumed{cpu}")
+main()
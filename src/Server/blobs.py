@@ -0,0 +1,126 @@
+import hashlib, os, re, threading, time
+# Attachments. Files are stored once however often they're sent, as blobs/{first 2 hex digits}/{SHA-256}, and
+# messages carry "[attachment {sha256} {size} {name}]" instead of the bytes.
+# Uploads come in on the session port as UPLOAD frames, after "/upload {sha256} {size}"
+# said what's coming and got back how much of it is already here: the size for a file someone sent before, how
+# far a partial upload got, or 0. A partial upload waits in blobs/partial/ until the rest comes, a day at most,
+# and is only stored once its hash checks out.
+# "/download {sha256} {offset}" queues the blob on the session's writer thread (see outbound.py), which sends it
+# in FILE frames straight from the file with sendfile.
+BLOB_DIR = "blobs"
+PARTIAL_DIR = os.path.join(BLOB_DIR, "partial")
+MAX_SIZE = 1024 * 1024 * 1024
+PARTIAL_TTL = 86400 # seconds an upload nobody finished is kept
+DIGEST = re.compile(r"[0-9a-f]{64}")
+lock = threading.Lock() # for uploads and _locks, never held while a file is read or written
+uploads = {} # {sha256: [size, hashlib object fed everything written so far]}, the uploads in progress
+_locks = {} # {sha256: Lock}, held while that upload's partial file is hashed, written, stored or pruned
+
+def path_of(digest: str) -> str:
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+def _partial(digest: str) -> str:
+    return os.path.join(PARTIAL_DIR, digest)
+def size_of(digest: str):
+    # the stored blob's size, None if there's no such blob
+    try:
+        return os.path.getsize(path_of(digest)) if DIGEST.fullmatch(digest) else None
+    except FileNotFoundError:
+        return None
+def _hold(digest: str) -> threading.Lock:
+    # takes digest's lock and returns it, to be released by the caller. Whoever stores or prunes the upload
+    # removes its lock from _locks with it held, so a lock that's been replaced while waiting on it is let go of
+    while True:
+        with lock:
+            own = _locks.setdefault(digest, threading.Lock())
+        own.acquire()
+        with lock:
+            if _locks.get(digest) is own:
+                return own
+        own.release()
+def _finish(digest: str):
+    # with digest's lock held
+    with lock:
+        uploads.pop(digest, None)
+        _locks.pop(digest, None)
+def begin(digest: str, size: int) -> str:
+    # the reply to /upload: how many bytes of it the server has, or why it won't take it
+    if not DIGEST.fullmatch(digest):
+        return "Bad hash, it's the SHA-256 in lowercase hex"
+    if not 0 < size <= MAX_SIZE:
+        return f"Attachments are 1 to {MAX_SIZE} bytes"
+    stored = size_of(digest)
+    if stored is not None:
+        return str(stored)
+    own = _hold(digest)
+    try:
+        # again, it may have been stored while waiting for the lock
+        stored = size_of(digest)
+        if stored is not None:
+            _finish(digest)
+            return str(stored)
+        with lock:
+            upload = uploads.get(digest)
+        if upload is None:
+            # a new upload, or one from before a restart, whose hash has to catch up with what's written
+            found = hashlib.sha256()
+            try:
+                with open(_partial(digest), "rb") as f:
+                    while chunk := f.read(1024 * 1024):
+                        found.update(chunk)
+            except FileNotFoundError:
+                pass
+            upload = [size, found]
+            with lock:
+                uploads[digest] = upload
+        upload[0] = size
+        return str(os.path.getsize(_partial(digest)) if os.path.exists(_partial(digest)) else 0)
+    finally:
+        own.release()
+def append(digest: str, offset: int, data: bytes):
+    # an UPLOAD frame. It's only written if it carries on exactly where the upload is, anything else (a resend,
+    # a second client sending the same file) is dropped, and /upload tells the client where to carry on from
+    own = _hold(digest)
+    try:
+        with lock:
+            upload = uploads.get(digest)
+        if upload is None:
+            # not its lock to keep either
+            _finish(digest)
+            return
+        size, found = upload
+        os.makedirs(PARTIAL_DIR, exist_ok=True)
+        with open(_partial(digest), "ab") as f:
+            if f.tell() != offset or offset + len(data) > size:
+                return
+            f.write(data)
+        found.update(data)
+        if offset + len(data) < size:
+            return
+        if found.hexdigest() != digest:
+            print(f"[BLOBS]: Upload of {digest} didn't match its hash, dropped")
+            os.remove(_partial(digest))
+        else:
+            os.makedirs(os.path.dirname(path_of(digest)), exist_ok=True)
+            os.replace(_partial(digest), path_of(digest))
+            print(f"[BLOBS]: Stored {digest}, {size} bytes")
+        _finish(digest)
+    finally:
+        own.release()
+def prune():
+    # uploads nobody finished, run from the compaction thread
+    if not os.path.isdir(PARTIAL_DIR):
+        return
+    for name in os.listdir(PARTIAL_DIR):
+        path = os.path.join(PARTIAL_DIR, name)
+        own = _hold(name)
+        try:
+            if time.time() - os.path.getmtime(path) > PARTIAL_TTL:
+                os.remove(path)
+                _finish(name)
+            elif name not in uploads:
+                # one from before a restart nobody's carried on with yet, begin makes its lock again
+                _finish(name)
+        except FileNotFoundError:
+            pass
+        finally:
+            own.release()
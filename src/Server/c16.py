@@ -1,14 +1,25 @@
 import ctypes
 import os
 
-# Load the appropriate library based on the platform
-if os.name == 'nt':  # Windows
-    c16 = ctypes.CDLL("./16.dll")
-else:  # Linux/Unix
-    c16 = ctypes.CDLL("./lib16.so")
-# use "from c16.py import ctypes, c16" to import
-c16.decode_B.restype = ctypes.c_char_p
-c16.encode_B.restype = ctypes.c_char_p
+_lib = None
+def load():
+    # Load the appropriate library based on the platform, next to this file rather than the working directory
+    global _lib
+    if _lib is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        if os.name == 'nt':  # Windows
+            _lib = ctypes.CDLL(os.path.join(here, "16.dll"))
+        else:  # Linux/Unix
+            _lib = ctypes.CDLL(os.path.join(here, "lib16.so"))
+        _lib.decode_B.restype = ctypes.c_char_p
+        _lib.encode_B.restype = ctypes.c_char_p
+    return _lib
+def __getattr__(name):
+    # the library is only loaded the first time someone touches c16.c16
+    if name == "c16":
+        return load()
+    raise AttributeError(name)
+# use "from c16 import ctypes, c16" to import (this loads the library)
 if __name__ == "__main__":
     #print(c16.decode_B(c16.encode_B("L")).decode('utf-8'))
-    print(c16.encode_B("A"))
\ No newline at end of file
+    print(load().encode_B("A"))
\ No newline at end of file
@@ -0,0 +1,103 @@
+import os, re, threading
+import db, search
+# Named channels. "general" is the old database.db and search/, every other channel gets its own log
+# and search index in channels/. Clients subscribe to channels, a new message only marks that channel's
+# subscribers as having something to fetch, and fetching only reads the logs of those channels from where
+# the client's cursor left off.
+DEFAULT = "general"
+CHANNEL_DIR = "channels"
+NAME = re.compile(r"#([\w-]{1,32})(?:\s+|$)")
+lock = threading.Lock()
+subscribers = {} # {channel: set of clients}
+subscriptions = {} # {client: set of channels}
+cursors = {} # {(client, channel): byte offset in the channel's log the client has been sent up to}
+pending = {} # {client: set of channels with messages the client hasn't been sent yet}
+indexes = {} # {channel: search.Index}, opened the first time the channel is used
+wake = threading.Event() # set on every new message, the session port's delivery thread waits on it
+
+def log_path(channel: str) -> str:
+    return "database.db" if channel == DEFAULT else os.path.join(CHANNEL_DIR, channel + ".db")
+def split(text: str):
+    # "#room rest of it" -> ("room", "rest of it"), anything else goes to general
+    match = NAME.match(text)
+    if match is None:
+        return DEFAULT, text
+    return match.group(1).lower(), text[match.end():]
+def known() -> list:
+    names = {DEFAULT}
+    if os.path.isdir(CHANNEL_DIR):
+        names.update(n[:-3] for n in os.listdir(CHANNEL_DIR) if n.endswith(".db"))
+    return sorted(names)
+def index(channel: str) -> search.Index:
+    with lock:
+        found = indexes.get(channel)
+        if found is None:
+            if channel == DEFAULT:
+                found = search.Index()
+            else:
+                os.makedirs(CHANNEL_DIR, exist_ok=True)
+                found = search.Index(log_path(channel), os.path.join(CHANNEL_DIR, channel + ".search"))
+            found.open()
+            indexes[channel] = found
+    return found
+def flush():
+    for found in list(indexes.values()):
+        found.flush()
+def subscribe(client: str, channel: str):
+    # new subscribers start at the end of the log, they get what's posted from now on
+    with lock:
+        if channel in subscriptions.setdefault(client, set()):
+            return
+        subscriptions[client].add(channel)
+        subscribers.setdefault(channel, set()).add(client)
+        cursors[(client, channel)] = db.log_size(log_path(channel))
+def unsubscribe(client: str, channel: str):
+    with lock:
+        subscriptions.get(client, set()).discard(channel)
+        subscribers.get(channel, set()).discard(client)
+        cursors.pop((client, channel), None)
+        pending.get(client, set()).discard(channel)
+def drop(client: str):
+    # the client is gone, forget everything about it
+    with lock:
+        for channel in subscriptions.pop(client, ()):
+            subscribers[channel].discard(client)
+            cursors.pop((client, channel), None)
+        pending.pop(client, None)
+def post(channel: str, time: str, user: str, message: str, i: int = None) -> int:
+    found = index(channel) # opened before writing, or catching up would index this message twice
+    i, offset = db.add_message(time, user, message, log_path(channel), i)
+    found.add(offset, user, message)
+    with lock:
+        for client in subscribers.get(channel, ()):
+            pending.setdefault(client, set()).add(channel)
+    wake.set()
+    return i
+def fetch(client: str):
+    # -> (lines to send, {channel: new cursor}), hand the cursors to delivered() once the lines are out
+    # lines from channels other than general are prefixed with "#channel;"
+    lines = []
+    moved = {}
+    with lock:
+        channels = pending.pop(client, ())
+        for channel in sorted(channels):
+            start = cursors.get((client, channel))
+            if start is None:
+                continue
+            with db.lock, db.open_log(log_path(channel)) as f: # not halfway through someone's add_message
+                f.seek(start)
+                data = f.read()
+            moved[channel] = f.tell() # past start if retention dropped some of what it hadn't been sent
+            prefix = "" if channel == DEFAULT else f"#{channel};"
+            lines += [prefix + line for line in data.decode().split("\n") if line]
+    return lines, moved
+def delivered(client: str, moved: dict):
+    with lock:
+        for channel, offset in moved.items():
+            if (client, channel) in cursors:
+                cursors[(client, channel)] = offset
+def retry(client: str, moved: dict):
+    # sending failed, fetch the same lines again next time
+    with lock:
+        if client in subscriptions:
+            pending.setdefault(client, set()).update(moved)
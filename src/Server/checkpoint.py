@@ -0,0 +1,92 @@
+import json, os, zlib
+import db
+# Checkpoints, so a restart reads what was written since the last one instead of every log from the start.
+# checkpoint.json holds the id counter, and for each log its size and the CRC-32 of its last record at that
+# point, synced to disk first so that much of it survives a power cut. Recovery checks a log still ends that way
+# there (a log that doesn't, or wasn't in the checkpoint, is read from the start) and replays only what comes
+# after. Whatever keeps its own state (the cluster's stream index, inbox read positions) saves it at the
+# same time, see save(). The search index has its own segments and catches up from the last one.
+CHECKPOINT = "checkpoint.json"
+INTERVAL = 30 # seconds between checkpoints, about the most a crash leaves to replay
+
+def load() -> dict:
+    # the last checkpoint, {} if there's none or it can't be read
+    try:
+        with open(CHECKPOINT) as f:
+            saved = json.load(f)
+        return saved if isinstance(saved, dict) else {}
+    except (OSError, ValueError):
+        return {}
+def save(state: dict):
+    # written whole and renamed over the old one, a crash leaves one or the other
+    with open(CHECKPOINT + ".tmp", "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(CHECKPOINT + ".tmp", CHECKPOINT)
+def _last_record(path: str, end: int):
+    # -> (offset, bytes) of the record a log has ending at end, (end, b"") for none
+    if end <= 0:
+        return end, b""
+    back = 4096
+    with db.open_log(path) as f:
+        if end <= f.start:
+            return end, b""
+        while True:
+            start = f.seek(max(0, end - back)) # not before what retention dropped
+            data = f.read(end - start)
+            cut = data.rfind(b"\n")
+            if cut != -1 or start == f.start:
+                return start + cut + 1, data[cut + 1:]
+            back *= 4
+def mark(path: str) -> list:
+    # [size, CRC-32 of the last record] for the checkpoint, called with db.lock held so no record is half written
+    size = db.log_size(path)
+    if size:
+        with open(path, "rb") as f:
+            os.fsync(f.fileno())
+    return [size, zlib.crc32(_last_record(path, size)[1])]
+def _torn(record: bytes) -> bool:
+    # a record cut short by a crash: NULs where the data never made it to disk, or not "id;time;user;message".
+    # One cut off in the middle of its message can't be told apart from a short message
+    if b"\0" in record:
+        return True
+    try:
+        i, timed, _, _ = record.decode().split(";", 3)
+        int(i), float(timed)
+    except ValueError:
+        return True
+    return False
+def repair(path: str) -> bool:
+    # drops the last record if it was torn, True if it did. Records start with their newline, so cutting at
+    # the last newline leaves the log as it was before that write
+    size = db.log_size(path)
+    offset, record = _last_record(path, size)
+    if not record or offset - 1 < db.base(path) or not _torn(record):
+        return False # compressed records were whole when they were compressed
+    with db.lock:
+        with open(path, "rb+") as f:
+            f.truncate(offset - 1 - db.base(path))
+    print(f"[CHECKPOINT]: Dropped a torn record at the end of {path}: {record[:60]!r}")
+    return True
+def start_of(path: str, saved: dict):
+    # where replaying path can start: its size at the checkpoint if it still ends with the same record there,
+    # None if it doesn't or it wasn't in the checkpoint, and it has to be read from the start
+    if path not in saved.get("logs", {}):
+        return None
+    size, crc = saved["logs"][path]
+    if db.log_size(path) < size or zlib.crc32(_last_record(path, size)[1]) != crc:
+        return None
+    return size
+def replay(path: str, start: int):
+    # -> (offset, line) for every record from start on
+    if db.log_size(path) <= start:
+        return
+    with db.open_log(path) as f:
+        pos = f.seek(start)
+        for raw in f:
+            offset = pos
+            pos += len(raw)
+            line = raw.decode(errors="replace").strip("\n")
+            if line:
+                yield offset, line
@@ -0,0 +1,487 @@
+import os, socket, struct, threading, time
+from array import array
+from bisect import bisect_right
+from collections import deque, OrderedDict
+import db, channels, inbox, frames, outbound, checkpoint
+# Cluster mode: several server nodes sharing one ordered message stream. One node is the sequencer, it numbers
+# every message and appends it to stream.db as "id;time;user;target message", target being "#channel" or
+# "@recipient" for a DM. Member nodes send the sequencer what their own clients post, and get every numbered
+# message back (their own included), which they write to their own stream.db, channel logs and inboxes under
+# the same id and deliver to their own clients. A member that (re)joins first gets what it missed from stream.db.
+# Nodes heartbeat each other, the sequencer drops members it hasn't heard from in TIMEOUT seconds and members
+# reconnect when it goes quiet. Everything runs over the session framing, see frames.py.
+# Members started with --standby are warm standbys: they ack what they've written, and with --commit sync a
+# message only counts as committed (and only goes out to the other members) once enough standbys have it, so a
+# standby promoted with kill -USR1 (or by itself with --failover) is never behind anyone it takes over.
+STREAM_LOG = "stream.db"
+STREAM_IDS = "stream.db.ids" # (id, offset) pairs for stream.db, what's new is appended at every checkpoint
+PAIR = struct.Struct("QQ") # one pair in STREAM_IDS, laid out like the array it's written from
+HEARTBEAT = 1
+TIMEOUT = 5
+BACKLOG = 10000 # posts a member holds on to until the sequencer has numbered them, more are refused
+NUMBERED_LIMIT = 100000 # sequencer: the last this many tokens are remembered, so a post sent again isn't numbered twice
+REPLAY_CHUNK = 64 * 1024
+ACK_DELAY = 0.005 # members wait this long before acking, so a burst of messages gets one ack
+SYNC_TIMEOUT = 2 # longest a post waits for standbys before it's committed without them
+JOIN = ord("J") # member -> sequencer "name;newest id it has;1 for a standby", always first
+POST = ord("S") # member -> sequencer "token;target;time;user;message", the token is unique to the post
+NUMBERED = ord("N") # sequencer -> member "token;id", the post with that token was numbered id
+BEAT = ord("B") # both ways, "name;newest id;sessions" lines, the sequencer's lists every node with a standby flag
+ACK = ord("A") # member -> sequencer, the newest id it has written
+READ = ord("R") # both ways, "user;delivered position;read position;unread", the user's DMs were delivered or read on some node
+# numbered messages go out as frames.DELIVERY, one stream.db line each
+role = None # None outside cluster mode, "sequencer" or "member"
+name = ""
+standby = False
+commit = "async" # "sync": wait for `replicas` standbys before a message is committed
+replicas = 1
+promote_port = None # where a standby listens once it's promoted
+failover = None # seconds without the sequencer before a standby promotes itself, None to only promote on USR1
+lock = threading.Lock() # held from numbering a message to appending it to the stream, so the stream is in id order
+acked = threading.Condition(lock) # notified when committed moves
+ids = array("Q") # ids in stream.db since the last checkpoint, oldest first
+offsets = array("Q") # and the offset of each one's line
+saved_ids = 0 # how many came before them, those are in STREAM_IDS and only read from there when a member joins
+applied = 0 # newest id in stream.db
+committed = 0 # sequencer: newest id the members that aren't standbys have been sent
+uncommitted = deque() # sequencer with sync commit: (id, line) waiting for standby acks
+members = {} # sequencer: {node name: connection state, see outbound.py}
+link = None # member: connection state for the sequencer, None while it's unreachable
+addresses = [] # member: sequencers to try, in turn
+view = [] # member: [(node, newest id, sessions, standby)] from the sequencer's last heartbeat, sequencer first
+posts = OrderedDict() # member: {token: (POST payload, done)} sent or waiting for the sequencer, not numbered yet
+numbering = {} # member: {id: [done, ...]} posts the sequencer numbered, waiting for the numbered copy to come back
+tokens = [os.urandom(4).hex(), 0] # member: prefix and count for post tokens, so they're new after a restart
+numbered = OrderedDict() # sequencer: {token: id} for posts from members, oldest first
+ack_wanted = threading.Event()
+sessions = lambda: 0 # set by start(), how many clients this node has
+
+def configure(node: str = None, sequencer_port: int = None, join: str = None, standby_port: int = None,
+              commit_level: str = "async", sync_replicas: int = 1, failover_after: float = None):
+    # --sequencer-port makes this node the sequencer, --join host:port[,host:port] a member of that sequencer's
+    # cluster, and --standby port a member that takes over as the sequencer on that port when promoted
+    global role, name, standby, promote_port, commit, replicas, failover
+    name = node or f"{socket.gethostname()}-{os.getpid()}"
+    commit, replicas, failover = commit_level, int(sync_replicas), failover_after and float(failover_after)
+    if sequencer_port is not None:
+        role = "sequencer"
+    elif join is not None:
+        role = "member"
+        for address in join.split(","):
+            host, _, port = address.rpartition(":")
+            addresses.append((host or "127.0.0.1", int(port)))
+        if standby_port is not None:
+            standby, promote_port = True, int(standby_port)
+def load(saved: dict = None, newest: dict = None):
+    # where the messages in stream.db after the checkpoint in saved start, read from stream.db past it. The ones
+    # before are in STREAM_IDS, which isn't read. Messages there that never reached their channel log or dms.db
+    # (newest holds the newest id in each) because of a crash are written to it now
+    global applied, committed, saved_ids
+    if role is None or not os.path.exists(STREAM_LOG):
+        return
+    saved, newest = saved or {}, newest or {}
+    start = checkpoint.start_of(STREAM_LOG, saved)
+    count = saved.get("stream ids", 0) if start is not None else 0
+    try:
+        size = os.path.getsize(STREAM_IDS)
+    except FileNotFoundError:
+        size = 0
+    if size < count * PAIR.size:
+        start, count = None, 0 # the checkpoint is no use without them, read it all
+    saved_ids = count
+    added = 0
+    for offset, line in checkpoint.replay(STREAM_LOG, start or 0):
+        i, time, user, rest = line.split(";", 3)
+        i = int(i)
+        ids.append(i)
+        offsets.append(offset)
+        added += 1
+        target, _, message = rest.partition(" ")
+        path = inbox.DM_LOG if target.startswith("@") else channels.log_path(target[1:])
+        if i > newest.get(path, 0):
+            print(f"[CLUSTER]: Writing message {i} from {STREAM_LOG} to {path}")
+            if target.startswith("@"):
+                inbox.send(time, user, target[1:], message, i)
+            else:
+                channels.post(target[1:], time, user, message, i)
+            newest[path] = i
+    applied = committed = ids[-1] if ids else _pair(saved_ids - 1)[0] if saved_ids else 0
+    print(f"[CLUSTER]: {saved_ids + len(ids)} messages in {STREAM_LOG} ({added} read from it), newest {applied}")
+def save() -> int:
+    # called with the lock and db.lock held while checkpointing, moves the ids added since the last one to
+    # STREAM_IDS and returns how many it holds
+    global saved_ids
+    if role is None:
+        return 0
+    pairs = array("Q")
+    for pair in zip(ids, offsets):
+        pairs.extend(pair)
+    with open(STREAM_IDS, "ab") as f:
+        f.truncate(saved_ids * PAIR.size) # anything past the last checkpoint is from before a crash
+        f.write(pairs.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    saved_ids += len(ids)
+    del ids[:], offsets[:]
+    return saved_ids
+def _pair(k: int) -> tuple:
+    # (id, offset) of the k-th message in stream.db, called with the lock held
+    if k >= saved_ids:
+        return ids[k - saved_ids], offsets[k - saved_ids]
+    with open(STREAM_IDS, "rb") as f:
+        f.seek(k * PAIR.size)
+        return PAIR.unpack(f.read(PAIR.size))
+def _count(i: int) -> int:
+    # how many messages in stream.db have ids up to i, called with the lock held. Ones from before the last
+    # checkpoint are binary searched in STREAM_IDS, a few reads instead of keeping it all in memory
+    if ids and ids[0] <= i:
+        return saved_ids + bisect_right(ids, i)
+    lo, hi = 0, saved_ids
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _pair(mid)[0] <= i:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+def _append(i: int, time: str, user: str, target: str, message: str):
+    # called with the lock held
+    global applied
+    _, offset = db.add_message(time, user, f"{target} {message}", STREAM_LOG, i)
+    ids.append(i)
+    offsets.append(offset)
+    applied = i
+def _standbys() -> list:
+    return [state for state in members.values() if state["standby"]]
+def _commit(i: int):
+    # called with the lock held, sends everything up to i to the members that aren't standbys
+    global committed
+    while uncommitted and uncommitted[0][0] <= i:
+        _, line = uncommitted.popleft()
+        for state in list(members.values()):
+            if not state["standby"]:
+                outbound.put(state, frames.DELIVERY, line.encode(), [line])
+    committed = max(committed, i)
+    acked.notify_all()
+def _recommit():
+    # called with the lock held when acks or standbys change: committed is the newest id enough standbys have,
+    # or everything when none are connected
+    found = sorted((state["acked"] for state in _standbys()), reverse=True)
+    if uncommitted:
+        _commit(found[min(replicas, len(found)) - 1] if found else applied)
+def publish(target: str, time: str, user: str, message: str, wait: bool = True, done=None):
+    # posts a message ("#channel" target) or DM ("@user" target) from this node's clients, returns its id. With
+    # sync commits it returns once the message is committed, unless wait is False (posts relayed from members,
+    # whose reader thread can't sit waiting for acks). On a member the id only comes back with the message from
+    # the sequencer, so it returns None once the post is queued for the sequencer, or False if BACKLOG posts are
+    # already waiting there and it was refused. done(id) is called once the message is stored on this node (on a
+    # member, when the numbered copy is written here), or done(None) if that never happens
+    if role == "member":
+        with lock:
+            if len(posts) >= BACKLOG:
+                return False
+            tokens[1] += 1
+            token = f"{tokens[0]}-{tokens[1]:x}"
+            payload = f"{token};{target};{time};{user};{message}".encode()
+            posts[token] = (payload, done)
+            if link is not None:
+                outbound.put(link, POST, payload)
+        return None
+    with lock:
+        if target.startswith("@"):
+            i = inbox.send(time, user, target[1:], message)
+        else:
+            i = channels.post(target[1:], time, user, message)
+        if role == "sequencer":
+            _append(i, time, user, target, message)
+            line = f"{i};{time};{user};{target} {message}"
+            for state in _standbys():
+                outbound.put(state, frames.DELIVERY, line.encode(), [line])
+            uncommitted.append((i, line))
+            if commit != "sync" or not _standbys():
+                _commit(i)
+            elif not wait:
+                pass
+            elif not acked.wait_for(lambda: committed >= i, SYNC_TIMEOUT):
+                print(f"[CLUSTER]: No standby acked {i} in {SYNC_TIMEOUT}s, committing without them")
+                _commit(i)
+    channels.wake.set()
+    if done is not None:
+        done(i)
+    return i
+def _apply(line: str):
+    # a numbered message from the sequencer
+    i, time, user, rest = line.split(";", 3)
+    i = int(i)
+    if i <= applied:
+        return
+    target, _, message = rest.partition(" ")
+    with lock:
+        _append(i, time, user, target, message)
+        if target.startswith("@"):
+            inbox.send(time, user, target[1:], message, i)
+        else:
+            channels.post(target[1:], time, user, message, i)
+        waiting = numbering.pop(i, ())
+    channels.wake.set()
+    for done in waiting:
+        done(i)
+def _numbered(payload: bytes):
+    # the sequencer numbered one of this member's posts, it's stored here once that id has been applied
+    token, i = payload.decode().split(";")
+    i = int(i)
+    with lock:
+        post = posts.pop(token, None)
+        done = post and post[1]
+        if done is not None and i > applied:
+            numbering.setdefault(i, []).append(done)
+            return
+    if done is not None:
+        done(i)
+def read(user: str):
+    # the user's DMs were delivered or read here, so every node moves its positions too
+    if role is None:
+        return
+    delivered_to, read_to, count = inbox.position(user)
+    payload = f"{user};{delivered_to};{read_to};{count}".encode()
+    if role == "member":
+        if link is not None:
+            outbound.put(link, READ, payload)
+        return
+    for state in list(members.values()):
+        outbound.put(state, READ, payload)
+def _read(payload: bytes, origin: dict = None):
+    user, delivered_to, read_to, count = payload.decode().split(";")
+    inbox.set_read(user, int(delivered_to), int(read_to), int(count))
+    if role == "sequencer":
+        for state in list(members.values()):
+            if state is not origin:
+                outbound.put(state, READ, payload)
+def _beat(state: dict, payload: bytes):
+    global view
+    state["seen"] = time.time()
+    rows = [line.split(";") for line in payload.decode().split("\n") if line]
+    if role == "sequencer":
+        state["newest"], state["sessions"] = int(rows[0][1]), int(rows[0][2])
+    else:
+        view = [(node, int(newest), int(count), flag == "1") for node, newest, count, flag in rows]
+def _replay(sock, start: int, end: int):
+    # stream.db from start to end straight onto the socket, before the member's writer starts
+    with db.open_log(STREAM_LOG) as f:
+        f.seek(start)
+        chunk = []
+        size = 0
+        while f.tell() < end:
+            line = f.readline().rstrip(b"\n")
+            if line:
+                chunk.append(line)
+                size += len(line) + 1
+            if size >= REPLAY_CHUNK or (chunk and f.tell() >= end):
+                sock.sendall(frames.pack(frames.DELIVERY, b"\n".join(chunk)))
+                chunk, size = [], 0
+def _member(conn, addr):
+    # the sequencer's end of one member's connection
+    conn.settimeout(TIMEOUT)
+    try:
+        first = frames.read(conn)
+    except (OSError, ValueError):
+        first = None
+    if first is None or first[0] != JOIN:
+        conn.close()
+        return
+    conn.settimeout(None)
+    node, newest, flag = first[1].decode().split(";")
+    state = {"sock": conn, "user": node, "lock": threading.Lock(), "stream": None, "codec": None,
+             "policy": "disconnect", "seen": time.time(), "newest": int(newest), "sessions": 0,
+             "standby": flag == "1", "acked": int(newest)}
+    outbound.attach(state, writer=False)
+    with lock:
+        old = members.get(node)
+        if old is not None:
+            outbound.close(old)
+        members[node] = state
+        # everything numbered from here on queues up behind the replay, members that aren't standbys only get
+        # what's committed
+        k = _count(int(newest))
+        last = _count(applied if state["standby"] else committed)
+        start = _pair(k)[1] if k < last else None
+        end = _pair(last)[1] if last < saved_ids + len(ids) else db.log_size(STREAM_LOG)
+    if int(newest) > applied:
+        print(f"[CLUSTER]: {node} has ids up to {newest}, past this sequencer's {applied}")
+    try:
+        if start is not None:
+            _replay(conn, start, end)
+        outbound.start(state)
+        print(f"[CLUSTER]: {node} joined from {addr[0]}:{addr[1]}{' as a standby' if state['standby'] else ''}, "
+              f"{max(0, last - k)} messages behind")
+        while (got := frames.read(conn)) is not None:
+            kind, payload = got
+            if kind == POST:
+                token, target, time_sent, user, message = payload.decode().split(";", 4)
+                with lock:
+                    i = numbered.get(token)
+                if i is None:
+                    # a post sent again after the member reconnected is only numbered the first time
+                    i = publish(target, time_sent, user, message, wait=False)
+                    with lock:
+                        numbered[token] = i
+                        while len(numbered) > NUMBERED_LIMIT:
+                            numbered.popitem(last=False)
+                outbound.put(state, NUMBERED, f"{token};{i}".encode())
+            elif kind == ACK:
+                with lock:
+                    state["acked"] = int(payload)
+                    _recommit()
+            elif kind == READ:
+                _read(payload, state)
+            elif kind == BEAT:
+                _beat(state, payload)
+    except (OSError, ValueError) as e:
+        print(f"[CLUSTER]: {node} failed: {e}")
+    finally:
+        with lock:
+            if members.get(node) is state:
+                del members[node]
+                _recommit()
+        outbound.close(state)
+        conn.close()
+        print(f"[CLUSTER]: {node} left")
+def _serve(port: int):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(("127.0.0.1", port))
+    server_socket.listen(16)
+    print(f"[CLUSTER]: {name} is the sequencer, members join on 127.0.0.1:{port}, {commit} commits")
+    while True:
+        conn, addr = server_socket.accept()
+        threading.Thread(target=_member, args=(conn, addr), daemon=True).start()
+def _follow():
+    # a member's connection to the sequencer, reconnecting until the node is promoted
+    global link
+    k = 0
+    lost = time.time()
+    while role == "member":
+        address = addresses[k % len(addresses)]
+        try:
+            conn = socket.create_connection(address, timeout=TIMEOUT)
+            conn.settimeout(None)
+        except OSError as e:
+            print(f"[CLUSTER]: Sequencer at {address[0]}:{address[1]} unreachable: {e}")
+            k += 1
+            if standby and failover is not None and time.time() - lost > failover:
+                promote()
+                return
+            time.sleep(HEARTBEAT / len(addresses))
+            continue
+        state = {"sock": conn, "user": "sequencer", "lock": threading.Lock(), "stream": None, "codec": None,
+                 "seen": time.time()}
+        outbound.attach(state)
+        with lock:
+            outbound.put(state, JOIN, f"{name};{applied};{int(standby)}".encode())
+            # everything not numbered yet, the sequencer knows the tokens of the ones it already has
+            for payload, _ in posts.values():
+                outbound.put(state, POST, payload)
+            link = state
+        print(f"[CLUSTER]: {name} following the sequencer at {address[0]}:{address[1]} from id {applied}")
+        try:
+            while (got := frames.read(conn)) is not None:
+                kind, payload = got
+                if kind == frames.DELIVERY:
+                    for line in payload.decode().split("\n"):
+                        if line:
+                            _apply(line)
+                    ack_wanted.set()
+                elif kind == NUMBERED:
+                    _numbered(payload)
+                elif kind == READ:
+                    _read(payload)
+                elif kind == BEAT:
+                    _beat(state, payload)
+        except (OSError, ValueError) as e:
+            print(f"[CLUSTER]: Lost the sequencer: {e}")
+        finally:
+            with lock:
+                link = None
+            outbound.close(state)
+            conn.close()
+        lost = time.time()
+        time.sleep(HEARTBEAT / len(addresses))
+def _acks():
+    # one ack for however many messages came in within ACK_DELAY
+    while True:
+        ack_wanted.wait()
+        time.sleep(ACK_DELAY)
+        ack_wanted.clear()
+        state = link
+        if state is not None:
+            outbound.put(state, ACK, str(applied).encode())
+def promote():
+    # turns this standby into the sequencer, members that list it in --join find it on their next reconnect
+    global role, committed
+    if role != "member" or promote_port is None:
+        print("[CLUSTER]: Only a standby (--standby port) can be promoted")
+        return
+    with lock:
+        role = "sequencer"
+        committed = applied
+        db.id = max(db.id, applied)
+        state = link
+        # posts the old sequencer may or may not have numbered, their clients send them again
+        lost = [done for _, done in posts.values() if done is not None]
+        lost += [done for waiting in numbering.values() for done in waiting]
+        posts.clear()
+        numbering.clear()
+    if state is not None:
+        outbound.close(state)
+    for done in lost:
+        done(None)
+    print(f"[CLUSTER]: {name} promoted to sequencer at id {applied}")
+    threading.Thread(target=_serve, args=(promote_port,), daemon=True).start()
+def _beats():
+    while True:
+        time.sleep(HEARTBEAT)
+        now = time.time()
+        if role == "sequencer":
+            rows = [f"{name};{applied};{sessions()};0"]
+            for node, state in list(members.items()):
+                if now - state["seen"] > TIMEOUT or outbound.stalled(state):
+                    print(f"[CLUSTER]: Dropping {node}, last heard {now - state['seen']:.1f}s ago")
+                    outbound.close(state)
+                    continue
+                rows.append(f"{node};{state['newest']};{state['sessions']};{int(state['standby'])}")
+            for state in list(members.values()):
+                outbound.put(state, BEAT, "\n".join(rows).encode())
+        elif (state := link) is not None:
+            if now - state["seen"] > TIMEOUT or outbound.stalled(state):
+                print(f"[CLUSTER]: No heartbeat from the sequencer for {now - state['seen']:.1f}s, reconnecting")
+                outbound.close(state)
+                continue
+            outbound.put(state, BEAT, f"{name};{applied};{sessions()}".encode())
+def start(sequencer_port: int = None, count_sessions=None):
+    global sessions
+    if role is None:
+        return
+    if count_sessions is not None:
+        sessions = count_sessions
+    if role == "sequencer":
+        threading.Thread(target=_serve, args=(sequencer_port,), daemon=True).start()
+    else:
+        threading.Thread(target=_follow, daemon=True).start()
+        threading.Thread(target=_acks, daemon=True).start()
+    threading.Thread(target=_beats, daemon=True).start()
+def report() -> str:
+    # the nodes and how far behind each is, for /nodes
+    if role is None:
+        return "Not running in cluster mode"
+    if role == "sequencer":
+        rows = [(name, applied, sessions(), False)]
+        rows += [(n, s["newest"], s["sessions"], s["standby"]) for n, s in list(members.items())]
+    else:
+        rows = view or [(name, applied, sessions(), standby)]
+    newest = max(row[1] for row in rows)
+    first = " (sequencer)" if role == "sequencer" or view else "" # a member that hasn't heard from it only knows itself
+    lines = [f"{node}{first if k == 0 else ''}{' (standby)' if flag else ''}{' (this node)' if node == name else ''}: "
+             f"newest id {i}, {newest - i} behind, {count} clients" for k, (node, i, count, flag) in enumerate(rows)]
+    if role == "sequencer":
+        lines.append(f"{commit} commits, committed up to {committed}, {len(uncommitted)} waiting for standbys")
+    return "\n".join(lines)
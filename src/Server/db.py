@@ -1,4 +1,21 @@
+import lzma, os, struct, sys, threading, zlib
+from bisect import bisect_right
 id = 1
+lock = threading.RLock() # add_message is called from every client's listener thread
+# Logs are kept as a compressed cold part (<log>.cold, zlib blocks of about COLD_BLOCK bytes cut on line
+# boundaries, found through <log>.cold.idx) followed by the live file. Offsets always count from the start of
+# the whole log, base() is the offset the live file starts at, and LogReader reads across both.
+# Older cold blocks can move on to the archive: <log>.archive/ holds lzma segments of about ARCHIVE_SEGMENT
+# bytes, named "start-end-lines-newest time.xz" so nothing has to be opened to know what's in them, and only
+# opened when a read gets that far back. Retention (see retention.py) drops whole archive segments and cold
+# blocks from the front, offsets don't change and first_offset() is where what's left starts.
+COLD_AFTER = 8 * 1024 * 1024 # live files past this get everything but the last KEEP_HOT bytes compressed
+KEEP_HOT = 1024 * 1024 # the recent end stays plain, it's what deliveries and catch-up read
+COLD_BLOCK = 64 * 1024
+COLD_ENTRY = struct.Struct("<QQQII") # offset, first id, position in .cold, compressed size, size
+ARCHIVE_SEGMENT = 1024 * 1024 # lzma takes ~25ms to open one, and that only happens for reads this far back
+cold = {} # {log path: [cold block entries]}
+archived = {} # {log path: [(start, end, lines, newest time, file name)]}, oldest first
 def fetch_message(message):
     i = ""
     mode = 0
@@ -37,30 +54,440 @@ def fetch_id(message):
             break
         i += v
     return int(i)
-def add_message(time, user, message):
-    f = open("database.db", "a+")
-    i = len(f.readlines())
+def add_message(time, user, message, path: str = "database.db", i: int = None):
+    # returns the new message's id and the byte offset its line starts at
+    # path is the channel's log, ids are shared by every channel. i is for messages that already have an id,
+    # like the ones a cluster node gets from its sequencer
     global id
-    f.write(f"\n{id+1};{time};{user};{message}") # Modes start at 0 with ID
-    f.close()
-    id += 1
-def remove_message(i: int):
-    f = open("database.db", "a+")
-    lisp = f.readlines()
-    f2 = open("database.db", "w")
-    f2.write("")
-    f2.close()
-    for v in lisp:
-        if fetch_id(v) != i:
-            f.write(v)
-    f.close()
-def fetch_message(i: int):
-    f = open("database.db", "r")
-    lisp = f.readlines()
-    for v in lisp:
-        if fetch_id(v) == i:
-            return v
-    return -1
+    with lock:
+        if i is None:
+            i = id + 1
+        # binary, so offsets are bytes of UTF-8 wherever this runs: text mode would write "\r\n" on Windows and
+        # the locale's encoding
+        with open(path, "ab") as f:
+            offset = base(path) + f.seek(0, 2) + 1 # +1 for the newline written in front of the message
+            f.write(f"\n{i};{time};{user};{message}".encode("utf-8")) # Modes start at 0 with ID
+        id = max(id, i)
+        return i, offset
+def parse_message(line: str):
+    # "id;time;user;message" -> (id, time, user, message) in one split instead of four scans
+    i, t, user, message = line.rstrip("\n").split(";", 3)
+    return int(i), float(t), user, message
+def read_at(f, offset: int) -> str:
+    # f is a LogReader (or the live file opened with "rb"), offsets come from add_message. "" if retention
+    # dropped it
+    if f.seek(offset) != offset:
+        return ""
+    return f.readline().decode().rstrip("\n")
+def _cold_entries(path: str) -> list:
+    with lock:
+        entries = cold.get(path)
+        if entries is None:
+            entries = []
+            _finish_reclaim(path)
+            try:
+                with open(path + ".cold.idx", "rb") as f:
+                    data = f.read()
+                # a torn last entry from a crash is ignored, the next compaction writes over it
+                entries = [COLD_ENTRY.unpack_from(data, k) for k in range(0, len(data) - COLD_ENTRY.size + 1, COLD_ENTRY.size)]
+            except FileNotFoundError:
+                pass
+            cold[path] = entries
+            _recover(path, entries)
+        return entries
+def _recover(path: str, entries: list):
+    # a crash between indexing new cold blocks and replacing the live file leaves the compressed part in
+    # both, spotted by the live file still holding the end of the last block where the cold part ends
+    if not entries or not os.path.exists(path):
+        return
+    start, _, position, packed, size = entries[-1]
+    end = start + size
+    if os.path.getsize(path) < end:
+        return
+    with open(path + ".cold", "rb") as f:
+        f.seek(position)
+        tail = zlib.decompress(f.read(packed))[-64:]
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[end - len(tail):end] == tail:
+        with open(path + ".tmp", "wb") as f:
+            f.write(data[end:])
+        os.replace(path + ".tmp", path)
+def _finish_reclaim(path: str):
+    # a crash in the middle of _reclaim(): the new index not in place yet means none of it happened,
+    # only the new .cold left means the index was already switched
+    if os.path.exists(path + ".cold.idx.new"):
+        for name in (path + ".cold.idx.new", path + ".cold.new"):
+            if os.path.exists(name):
+                os.remove(name)
+    elif os.path.exists(path + ".cold.new"):
+        os.replace(path + ".cold.new", path + ".cold")
+def _archive_entries(path: str) -> list:
+    with lock:
+        entries = archived.get(path)
+        if entries is None:
+            entries = []
+            folder = path + ".archive"
+            if os.path.isdir(folder):
+                for name in os.listdir(folder):
+                    try:
+                        start, end, lines, newest = name.removesuffix(".xz").split("-")
+                        entries.append((int(start, 16), int(end, 16), int(lines), float(newest), name))
+                    except ValueError:
+                        continue # a .tmp
+            entries.sort()
+            # a crash after writing a segment but before its blocks left the cold index leaves it overlapping
+            # them, the cold copy is the one that counts
+            cold_entries = _cold_entries(path)
+            for entry in [e for e in entries if cold_entries and e[0] >= cold_entries[0][0]]:
+                os.remove(os.path.join(folder, entry[4]))
+                entries.remove(entry)
+            archived[path] = entries
+        return entries
+def first_offset(path: str) -> int:
+    # where the log starts now, everything before was dropped by retention
+    archive = _archive_entries(path)
+    if archive:
+        return archive[0][0]
+    entries = _cold_entries(path)
+    return entries[0][0] if entries else 0
+def base(path: str) -> int:
+    entries = _cold_entries(path)
+    if not entries:
+        return 0
+    start, _, _, _, size = entries[-1]
+    return start + size
+def log_size(path: str) -> int:
+    with lock:
+        try:
+            return base(path) + os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+def compress_cold(path: str, keep: int = KEEP_HOT) -> int:
+    # moves all but the last keep bytes of the live file into compressed blocks, returns how many bytes moved
+    with lock:
+        entries = _cold_entries(path)
+        start = base(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        cut = data.rfind(b"\n", 0, len(data) - keep)
+        if cut <= 0:
+            return 0
+        position = _cold_end(entries)
+        new = []
+        with open(path + ".cold", "r+b" if os.path.exists(path + ".cold") else "wb") as f:
+            f.truncate(position)
+            f.seek(position)
+            i = 0
+            while i < cut:
+                j = min(cut, i + COLD_BLOCK)
+                if j < cut:
+                    # end the block where the next line starts, a line longer than a block gets one to itself
+                    k = data.rfind(b"\n", i + 1, j)
+                    if k == -1:
+                        k = data.find(b"\n", j, cut)
+                    j = k if k != -1 else cut
+                block = data[i:j]
+                packed = zlib.compress(block, 9)
+                try:
+                    first = int(block.lstrip(b"\n").split(b";", 1)[0])
+                except ValueError:
+                    first = 0
+                new.append((start + i, first, position, len(packed), len(block)))
+                f.write(packed)
+                position += len(packed)
+                i = j
+            f.flush()
+            os.fsync(f.fileno())
+        with open(path + ".cold.idx", "r+b" if os.path.exists(path + ".cold.idx") else "wb") as f:
+            f.truncate(len(entries) * COLD_ENTRY.size)
+            f.seek(len(entries) * COLD_ENTRY.size)
+            f.write(b"".join(COLD_ENTRY.pack(*entry) for entry in new))
+            f.flush()
+            os.fsync(f.fileno())
+        with open(path + ".tmp", "wb") as f:
+            f.write(data[cut:])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        entries.extend(new)
+        return cut
+def _cold_end(entries: list) -> int:
+    # where the next block goes in .cold, past every indexed one (a block remove_message() rewrote is written
+    # at the end, so it isn't always the last entry's)
+    return max((position + packed for _, _, position, packed, _ in entries), default=0)
+def _read_block(f, entry) -> bytes:
+    f.seek(entry[2])
+    return zlib.decompress(f.read(entry[3]))
+def archive_cold(path: str, count: int) -> int:
+    # moves the oldest count cold blocks into one archive segment, returns how many bytes moved. The newest cold
+    # block always stays, base() comes from it. Only the compaction thread moves cold blocks, so they're read
+    # and compressed without holding the lock
+    entries = _cold_entries(path)
+    count = min(count, len(entries) - 1)
+    if count <= 0:
+        return 0
+    # loaded before the new segment is there, loading it after would take it for one a crash left behind
+    _archive_entries(path)
+    moving = entries[:count]
+    with open(path + ".cold", "rb") as f:
+        data = b"".join(_read_block(f, entry) for entry in moving)
+    start, end = moving[0][0], entries[count][0]
+    try:
+        newest = parse_message(data[data.rfind(b"\n") + 1:].decode())[1]
+    except ValueError:
+        newest = 0
+    lines = data.count(b"\n") # every record starts with its newline
+    name = f"{start:016x}-{end:016x}-{lines}-{newest:.0f}.xz"
+    folder = path + ".archive"
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, name + ".tmp"), "wb") as f:
+        f.write(lzma.compress(data, preset=6))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(os.path.join(folder, name + ".tmp"), os.path.join(folder, name))
+    with lock:
+        if _cold_entries(path)[:count] != moving:
+            # remove_message() rewrote one of them meanwhile, they go on a later pass
+            os.remove(os.path.join(folder, name))
+            return 0
+        archive = _archive_entries(path)
+        _drop_cold(path, count)
+        archive.append((start, end, lines, float(f"{newest:.0f}"), name))
+    _reclaim(path)
+    return end - start
+def drop_before(path: str, offset: int) -> int:
+    # drops every archive segment and cold block that ends by offset, oldest first, returns the new first_offset()
+    with lock:
+        archive = _archive_entries(path)
+        while archive and archive[0][1] <= offset:
+            os.remove(os.path.join(path + ".archive", archive.pop(0)[4]))
+        entries = _cold_entries(path)
+        count = 0
+        while count < len(entries) - 1 and entries[count + 1][0] <= offset:
+            count += 1
+        if count:
+            _drop_cold(path, count)
+    _reclaim(path)
+    return first_offset(path)
+def _drop_cold(path: str, count: int):
+    # called with the lock held, the index is written whole and renamed over the old one
+    entries = _cold_entries(path)
+    _write_index(path, entries[count:])
+    del entries[:count]
+def _write_index(path: str, entries: list):
+    # called with the lock held
+    with open(path + ".cold.idx.tmp", "wb") as f:
+        f.write(b"".join(COLD_ENTRY.pack(*entry) for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".cold.idx.tmp", path + ".cold.idx")
+def _reclaim(path: str):
+    # dropped blocks stay in .cold until they're more than half of it, then the rest is copied to a new one
+    entries = _cold_entries(path)
+    if not entries:
+        return
+    dead = min(entry[2] for entry in entries)
+    if dead < 16 * COLD_BLOCK or dead * 2 < os.path.getsize(path + ".cold"):
+        return
+    with open(path + ".cold", "rb") as f, open(path + ".cold.new", "wb") as out:
+        f.seek(dead)
+        while chunk := f.read(1024 * 1024):
+            out.write(chunk)
+        out.flush()
+        os.fsync(out.fileno())
+    moved = [(start, first, position - dead, packed, size) for start, first, position, packed, size in entries]
+    with open(path + ".cold.idx.new", "wb") as f:
+        f.write(b"".join(COLD_ENTRY.pack(*entry) for entry in moved))
+        f.flush()
+        os.fsync(f.fileno())
+    with lock:
+        os.replace(path + ".cold.idx.new", path + ".cold.idx")
+        os.replace(path + ".cold.new", path + ".cold")
+        entries[:] = moved
+def last_id(path: str) -> int:
+    # id of the newest message in a log, read from its end
+    size = log_size(path)
+    back = 4096
+    with open_log(path) as f:
+        while True:
+            start = max(f.start, size - back)
+            f.seek(start)
+            lines = f.read().split(b"\n")
+            for line in reversed(lines[1:] if start > f.start else lines): # the first one may be cut in half
+                try:
+                    return int(line.split(b";", 1)[0])
+                except ValueError:
+                    continue
+            if start == f.start:
+                return 0
+            back *= 4
+def open_log(path: str):
+    return LogReader(path)
+class LogReader:
+    # reads a whole log by offset, seek()/readline()/read()/iteration like a file opened with "rb"
+    # it keeps the live file it opened, so a compaction while it's open doesn't move anything under it
+    # offsets before start (dropped by retention) can't be sought to, seek() goes to start instead
+    def __init__(self, path: str):
+        with lock:
+            self.entries = list(_cold_entries(path))
+            self.archive = list(_archive_entries(path))
+            self.base = base(path)
+            try:
+                self.live = open(path, "rb")
+            except FileNotFoundError:
+                self.live = None
+            self.cold = open(path + ".cold", "rb") if self.entries else None
+        self.path = path
+        self.starts = [entry[0] for entry in self.entries]
+        self.archive_starts = [entry[0] for entry in self.archive]
+        self.cold_start = self.starts[0] if self.starts else self.base
+        self.start = self.archive_starts[0] if self.archive else self.cold_start
+        self.pos = self.start
+        self.block = (-1, b"") # the last block decompressed, readline() mostly stays in one
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def close(self):
+        for f in (self.live, self.cold):
+            if f is not None:
+                f.close()
+    def seek(self, offset: int, whence: int = 0) -> int:
+        self.pos = max(offset, self.start)
+        return self.pos
+    def tell(self) -> int:
+        return self.pos
+    def _block(self, offset: int):
+        if offset < self.cold_start:
+            return self._archived(offset)
+        k = bisect_right(self.starts, offset) - 1
+        start, _, position, packed, _ = self.entries[k]
+        if self.block[0] != start:
+            self.cold.seek(position)
+            self.block = (start, zlib.decompress(self.cold.read(packed)))
+        return self.block
+    def _archived(self, offset: int):
+        start, end, _, _, name = self.archive[bisect_right(self.archive_starts, offset) - 1]
+        if self.block[0] != start:
+            try:
+                with open(os.path.join(self.path + ".archive", name), "rb") as f:
+                    self.block = (start, lzma.decompress(f.read()))
+            except FileNotFoundError:
+                # dropped by retention since this reader was opened, it reads as empty lines
+                self.block = (start, b"\n" * (min(end, self.cold_start) - start))
+        return self.block
+    def readline(self) -> bytes:
+        if self.pos >= self.base:
+            if self.live is None:
+                return b""
+            self.live.seek(self.pos - self.base)
+            line = self.live.readline()
+            self.pos += len(line)
+            return line
+        start, data = self._block(self.pos)
+        i = self.pos - start
+        j = data.find(b"\n", i)
+        if j == -1:
+            # the line carries on in the next block (or the live file), which starts with its newline
+            line = data[i:]
+            self.pos += len(line)
+            return line + self.readline()
+        self.pos += j + 1 - i
+        return data[i:j + 1]
+    def read(self, size: int = -1) -> bytes:
+        end = self.pos + size if size >= 0 else None
+        out = []
+        while self.pos < self.base and (end is None or self.pos < end):
+            start, data = self._block(self.pos)
+            piece = data[self.pos - start:] if end is None else data[self.pos - start:end - start]
+            out.append(piece)
+            self.pos += len(piece)
+        if self.live is not None and (end is None or self.pos < end):
+            self.live.seek(self.pos - self.base)
+            rest = self.live.read(-1 if end is None else end - self.pos)
+            self.pos += len(rest)
+            out.append(rest)
+        return b"".join(out)
+    def __iter__(self):
+        while line := self.readline():
+            yield line
+def _find(f, i: int):
+    # -> (offset, line) of message i in the log f (a LogReader) reads, None if it isn't there. Cold blocks know
+    # the first id in them, so the scan starts in the right one, only ids from before the cold part go through
+    # the archive
+    k = bisect_right([entry[1] for entry in f.entries], i) - 1
+    f.seek(f.entries[k][0] if k >= 0 else f.start)
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line:
+            return None
+        try:
+            found = int(line.split(b";", 1)[0])
+        except ValueError:
+            continue # the newline every record starts with
+        if found >= i:
+            return (offset, line.rstrip(b"\n")) if found == i else None
+def fetch_message(i: int, path: str = "database.db"):
+    # the line of message i, -1 if it isn't in the log (or retention dropped it)
+    with open_log(path) as f:
+        found = _find(f, i)
+    return found[1].decode() if found is not None else -1
+def remove_message(i: int, path: str = "database.db") -> bool:
+    # blanks message i's text where it is, in the live file, a cold block or an archive segment. Nothing moves,
+    # so offsets in the inbox and search indexes and clients' cursors stay right. False if it isn't in the log
+    with lock:
+        with open_log(path) as f:
+            found = _find(f, i)
+            if found is None:
+                return False
+            offset, line = found
+            start = offset + len(b";".join(line.split(b";", 3)[:3])) + 1
+            end = offset + len(line)
+            while start < end:
+                if start >= f.base:
+                    with open(path, "r+b") as live:
+                        live.seek(start - f.base)
+                        live.write(b" " * (end - start))
+                    break
+                if start >= f.cold_start:
+                    start = _blank_cold(path, bisect_right(f.starts, start) - 1, start, end)
+                else:
+                    start = _blank_archived(path, bisect_right(f.archive_starts, start) - 1, start, end)
+    return True
+def _blank_cold(path: str, k: int, start: int, end: int) -> int:
+    # called with the lock held, blanks start to end in cold block k, returns where the block ends. The block
+    # is written again at the end of .cold and the index pointed at it, the old copy is left for _reclaim()
+    entries = _cold_entries(path)
+    block, first, _, _, size = entries[k]
+    stop = min(end, block + size)
+    with open(path + ".cold", "r+b") as f:
+        data = bytearray(_read_block(f, entries[k]))
+        data[start - block:stop - block] = b" " * (stop - start)
+        packed = zlib.compress(bytes(data), 9)
+        position = _cold_end(entries)
+        f.seek(position)
+        f.write(packed)
+        f.flush()
+        os.fsync(f.fileno())
+    entries[k] = (block, first, position, len(packed), size)
+    _write_index(path, entries)
+    return stop
+def _blank_archived(path: str, k: int, start: int, end: int) -> int:
+    # called with the lock held, the same for archive segment k, which is compressed again under its own name
+    segment, segment_end, _, _, name = _archive_entries(path)[k]
+    stop = min(end, segment_end)
+    full = os.path.join(path + ".archive", name)
+    with open(full, "rb") as f:
+        data = bytearray(lzma.decompress(f.read()))
+    data[start - segment:stop - segment] = b" " * (stop - start)
+    with open(full + ".tmp", "wb") as f:
+        f.write(lzma.compress(bytes(data), preset=6))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(full + ".tmp", full)
+    return stop
 def validate_message(i: str):
     mode = 0
     type_checks = [int, float, str, str]
@@ -71,6 +498,10 @@ def validate_message(i: str):
             return False
         mode += 1
     return True
-if __name__ == "__main__":
+if __name__ == "__main__" and len(sys.argv) > 2 and sys.argv[1] == "--compress":
+    # python db.py --compress <log> [keep bytes]
+    moved = compress_cold(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else KEEP_HOT)
+    print(f"Compressed {moved} bytes of {sys.argv[2]}, {len(cold[sys.argv[2]])} cold blocks")
+elif __name__ == "__main__":
     print(validate_message("1;1234567890.123;user.name;Hello, world!"))
     print(validate_message("ef;123456hi7890.12a;21;no"))
\ No newline at end of file
@@ -0,0 +1,65 @@
+import threading, time
+from collections import OrderedDict
+# Message ids that clients put on their SENDs, so a message sent again after a lost ack is only stored once.
+# Each id is remembered for WINDOW seconds, and at most LIMIT of them, oldest forgotten first. Ids are only
+# unique per user, so they're kept as "user;id". Clients resend within seconds, far inside the window, and not
+# at all once a message is older than it. An id is in flight from when its message is taken in until it's
+# published, and only counts as seen after that. The window is saved with every checkpoint, so resends after a
+# restart are still recognised.
+WINDOW = 600
+LIMIT = 200000
+lock = threading.Lock()
+seen = OrderedDict() # {"user;id": when it was first seen}, oldest first, only ids whose message is published
+in_flight = {} # {"user;id": when}, messages taken in but not published (or given up on) yet
+counts = {"new": 0, "duplicate": 0, "in flight": 0, "forgotten": 0}
+
+def _expire(now: float):
+    # called with the lock held
+    while seen and (len(seen) >= LIMIT or now - next(iter(seen.values())) > WINDOW):
+        seen.popitem(last=False)
+        counts["forgotten"] += 1
+def claim(user: str, message_id: str) -> str:
+    # "new" the first time user sends message_id within the window, and it's in flight until done() or forget().
+    # "seen" for a resend of a published message, "in flight" for a resend of one that isn't published yet
+    now = time.time()
+    key = f"{user};{message_id}"
+    with lock:
+        _expire(now)
+        if key in seen:
+            counts["duplicate"] += 1
+            return "seen"
+        if key in in_flight:
+            counts["in flight"] += 1
+            return "in flight"
+        in_flight[key] = now
+        return "new"
+def done(user: str, message_id: str):
+    # the message with this id is published, resends of it are dropped from now on
+    key = f"{user};{message_id}"
+    with lock:
+        in_flight.pop(key, None)
+        if key not in seen:
+            seen[key] = time.time()
+            counts["new"] += 1
+def forget(user: str, message_id: str):
+    # the message with this id wasn't published, a resend gets another go
+    with lock:
+        in_flight.pop(f"{user};{message_id}", None)
+def save() -> dict:
+    # the window for the checkpoint, {"user;id": when}
+    with lock:
+        _expire(time.time())
+        return dict(seen)
+def load(saved: dict):
+    # the window from the last checkpoint
+    now = time.time()
+    with lock:
+        for key, when in sorted(saved.items(), key=lambda item: item[1]):
+            if now - when <= WINDOW:
+                seen[key] = when
+def report() -> str:
+    # for /limits
+    with lock:
+        return f"Message ids: {len(seen)} remembered, {len(in_flight)} in flight, {counts['new']} new, " \
+               f"{counts['duplicate']} resends dropped, {counts['in flight']} resends while in flight, " \
+               f"{counts['forgotten']} forgotten"
@@ -0,0 +1,60 @@
+import struct
+# Framing for the session port, where a client keeps one connection open for everything.
+# Every frame is a 4 byte big endian payload length, a 1 byte kind and the payload.
+# The same file lives in src/Server and src/Client.
+HEAD = struct.Struct(">IB")
+MAX_FRAME = 16 * 1024 * 1024
+SESSION_PORT = 10741
+# client -> server
+HELLO = ord("H") # "username;codecs;dictionary id;newest id;#channel #channel", always the first frame
+MESSAGE = ord("M") # what the user typed, "#channel text" or plain text for general
+SEND = ord("S") # "message id;text", a MESSAGE the client made a unique id for, acked with ACKED. Sending it again
+                # with the same id (after a timeout, or on a new connection) stores it only once
+COMMAND = ord("C") # "request number;/command args", answered with a REPLY carrying the same number
+PONG = ord("O") # the client's time, answers a PING
+UPLOAD = ord("U") # "sha256;offset;" and the next bytes of a file, after /upload said where to start from
+# server -> client
+WELCOME = ord("W") # "codec;dictionary id;error", then the dictionary itself if the client's was out of date
+REPLY = ord("R") # "request number;reply"
+ACKED = ord("K") # "message id", the SEND with that id is stored (or was already)
+DELIVERY = ord("D") # new lines, compressed in the connection's stream if a codec was agreed on
+PING = ord("P")
+GAP = ord("G") # "missed lines;first id;last id", in place of deliveries a slow client fell too far behind on
+FILE = ord("F") # "sha256;offset;size;" and the bytes of an attachment from offset on, answering /download
+
+def pack(kind: int, payload: bytes) -> bytes:
+    return HEAD.pack(len(payload), kind) + payload
+def _check(length: int):
+    if length > MAX_FRAME:
+        raise ValueError(f"frame of {length} bytes is over the limit")
+def read(sock):
+    # blocking read of one frame -> (kind, payload), None once the other end hangs up
+    head = _recv_exactly(sock, HEAD.size)
+    if head is None:
+        return None
+    length, kind = HEAD.unpack(head)
+    _check(length)
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        return None
+    return kind, payload
+def _recv_exactly(sock, n: int):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:])
+        if k == 0:
+            return None
+        got += k
+    return bytes(buf)
+async def read_async(reader):
+    # the same for an asyncio StreamReader, None once the other end hangs up
+    import asyncio # only clients run an event loop, the server doesn't need it imported
+    try:
+        head = await reader.readexactly(HEAD.size)
+        length, kind = HEAD.unpack(head)
+        _check(length)
+        return kind, await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
@@ -1,6 +1,14 @@
-import threading, random, time
+import threading, random, time, hashlib, hmac, os
+try:
+    import numpy
+except ImportError: # numpy is optional, gen_hashes falls back to gen_hash
+    numpy = None
 found = False
 prime = 0
+_tables = None # see _step_tables()
+SCRYPT = (2 ** 14, 8, 1) # n, r, p for hash_password, about 16MB and 50ms a password
+SCRYPT_MAXMEM = 64 * 1024 * 1024
+PBKDF2_ITERATIONS = 600000 # where there's no scrypt
 def random_prime():
     rand = random.getrandbits(2047)
     rand = (rand << 1) | 1
@@ -86,7 +94,8 @@ def decrypt(ciphertext, private_key) -> str:
     m_int = pow(ciphertext, d, n)
     message = m_int.to_bytes((m_int.bit_length() + 7) // 8, byteorder='big').decode()
     return message
-def gen_hash(i: bytes|str, s: int) -> bytes:
+def _ascii(i) -> bytearray|int:
+    # gen_hash's input as a bytearray padded to 3 bytes, or its error code
     inp = b""
     if type(i) == str:
         inp = i.encode("ascii")
@@ -98,20 +107,102 @@ def gen_hash(i: bytes|str, s: int) -> bytes:
         inp = i
     else:
         return -1
-    c = 0
     inp = bytearray(inp)
     if len(inp) < 3:
         for _ in range(3 - len(inp)):
             inp.append(45)
+    return inp
+def _step_tables() -> list:
+    # [k * 128 + byte]: what one step of pass k with that input byte turns each output byte into
+    global _tables
+    if _tables is None:
+        _tables = [bytes(((x + byte) % 127 * byte * k) % 127 % 95 + 32 for x in range(256))
+                   for k in range(5) for byte in range(128)]
+    return _tables
+def gen_hash(i: bytes|str, s: int) -> bytes:
+    # s > 0 output bytes. Step t of the 5 passes over the input changes output byte t % s, so each output byte
+    # is its seed run through every s-th step, looked up in _step_tables() instead of worked out. Pass 0
+    # multiplies by 0, so any byte it reaches becomes 32 and only the steps after its last one there matter
+    inp = _ascii(i)
+    if type(inp) == int:
+        return inp
+    n = len(inp)
+    tables = _step_tables()
+    steps = [tables[k * 128 + byte] for k in range(1, 5) for byte in inp] # step t is steps[t - n]
     output = bytearray((((inp[0] * inp[1] + inp[2]) // 3) % 95 + 32).to_bytes() * s)
-    for k in range(5):
-        for byte in inp:
-            output[c] = (output[c] + byte) % 127
-            output[c] = (output[c] * byte * k) % 127
-            output[c] %= 95
-            output[c] += 32
-            c += 1
-            if c == len(output):
-                c = 0
-    # output.append(((inp[0] * inp[1] + inp[2]) // 3) % 95 + 32)
+    for c in range(min(s, 5 * n)):
+        if c < n:
+            x, t = 32, c + s * ((n - 1 - c) // s + 1)
+        else:
+            x, t = output[c], c
+        for table in steps[t - n::s]:
+            x = table[x]
+        output[c] = x
     return bytes(output)
+def gen_hashes(inputs: list, s: int) -> list:
+    # gen_hash for every input, in order. With NumPy, inputs of the same length are hashed together: s steps
+    # at a time (they all touch different output bytes) across every input in one table lookup
+    if numpy is None:
+        return [gen_hash(i, s) for i in inputs]
+    out = [None] * len(inputs)
+    by_length = {}
+    for index, i in enumerate(inputs):
+        inp = _ascii(i)
+        if type(inp) == int:
+            out[index] = inp
+        else:
+            by_length.setdefault(len(inp), []).append((index, inp))
+    table = numpy.frombuffer(b"".join(_step_tables()), numpy.uint8).reshape(5, 128, 256)
+    for n, group in by_length.items():
+        rows = numpy.frombuffer(b"".join(inp for _, inp in group), numpy.uint8).reshape(len(group), n)
+        seeds = ((rows[:, 0].astype(numpy.int64) * rows[:, 1] + rows[:, 2]) // 3) % 95 + 32
+        output = numpy.repeat(seeds.astype(numpy.uint8)[:, None], s, axis=1)
+        output[:, :min(n, s)] = 32 # pass 0
+        t = numpy.arange(n, 5 * n)
+        for start in range(0, len(t), s):
+            chunk = t[start:start + s]
+            c = chunk % s
+            output[:, c] = table[chunk // n, rows[:, chunk % n], output[:, c]]
+        for (index, _), row in zip(group, output):
+            out[index] = row.tobytes()
+    return out
+def hash_password(password: str, salt: bytes = None) -> str:
+    # for storing passwords, gen_hash is fast and unsalted on purpose. scrypt where OpenSSL has it, PBKDF2
+    # otherwise, and the result says which: "scrypt$n$r$p$salt$key" or "pbkdf2_sha256$iterations$salt$key"
+    salt = salt or os.urandom(16)
+    if hasattr(hashlib, "scrypt"):
+        n, r, p = SCRYPT
+        key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=SCRYPT_MAXMEM)
+        return f"scrypt${n}${r}${p}${salt.hex()}${key.hex()}"
+    key = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt.hex()}${key.hex()}"
+def check_password(password: str, stored: str) -> bool:
+    # False for a wrong password, and for a stored hash that isn't one hash_password made (cut short, edited,
+    # or with scrypt parameters OpenSSL won't take)
+    try:
+        kind, *params, salt, key = stored.split("$")
+        salt, key = bytes.fromhex(salt), bytes.fromhex(key)
+        if kind == "scrypt":
+            n, r, p = map(int, params)
+            got = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=SCRYPT_MAXMEM)
+        elif kind == "pbkdf2_sha256":
+            got = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, int(params[0]))
+        else:
+            return False
+    except (ValueError, IndexError, OverflowError):
+        return False
+    return hmac.compare_digest(got, key)
+if __name__ == "__main__":
+    # python hashes.py times gen_hash and gen_hashes, test/test_hashes.py checks they match the original
+    rng = random.Random(1)
+    inputs = [f"user-{n}:secret-{rng.getrandbits(40):x}" for n in range(20000)]
+    for name, run in (("gen_hash", lambda: [gen_hash(i, 32) for i in inputs]),
+                      ("gen_hashes", lambda: gen_hashes(inputs, 32))):
+        started = time.perf_counter()
+        run()
+        took = time.perf_counter() - started
+        print(f"{name:>10}: {len(inputs)} hashes in {took:.3f}s, {len(inputs) / took:.0f}/s")
+    started = time.perf_counter()
+    stored = hash_password("correct horse")
+    print(f"hash_password: {stored.split('$')[0]} in {time.perf_counter() - started:.3f}s, "
+          f"checks {check_password('correct horse', stored)}, rejects {not check_password('wrong', stored)}")
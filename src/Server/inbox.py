@@ -0,0 +1,134 @@
+import os, struct, threading
+from array import array
+import db, users
+# Direct messages. Every DM is one line in dms.db, "id;time;sender;@recipient message", and both users get
+# its byte offset appended to their inbox index (inbox/<user>.idx, 8 bytes per DM), so a user's DMs are a
+# seek into their own index instead of a scan of everyone's. inbox/<user>.read holds how many of the user's
+# entries have been delivered, how many they've read (with /inbox) and the unread count, which is kept in memory
+# and never recounted. Delivering DMs doesn't read them, only opening the inbox does. The .read files are
+# written at checkpoints (see checkpoint.py), and recover() brings them up to date with the DMs after.
+DM_LOG = "dms.db"
+INBOX_DIR = "inbox"
+ENTRY = struct.Struct("<Q")
+lock = threading.Lock()
+totals = {} # {user: entries in their index}
+sent = {} # {user: entries delivered}
+read = {} # {user: entries read}
+unread = {} # {user: DMs to them past read}
+dirty = set() # users whose .read file is behind, save() writes them
+
+def _path(user: str, ext: str) -> str:
+    # user ends up in a file name, so it has to be a real username and nothing like "../"
+    if users.NAME.fullmatch(user) is None:
+        raise ValueError(f"not a username: {user!r}")
+    return os.path.join(INBOX_DIR, user + ext)
+def _load(user: str):
+    # called with the lock held, reads a user's counters the first time they're needed
+    if user in totals:
+        return
+    try:
+        totals[user] = os.path.getsize(_path(user, ".idx")) // ENTRY.size
+    except FileNotFoundError:
+        totals[user] = 0
+    try:
+        with open(_path(user, ".read")) as f:
+            counters = list(map(int, f.read().split()))
+        if len(counters) == 2: # from before the read position was kept apart from the delivered one
+            counters.insert(1, 0)
+        sent[user], read[user], unread[user] = counters
+    except (FileNotFoundError, ValueError):
+        sent[user], read[user], unread[user] = 0, 0, 0
+def save():
+    # called with the lock and db.lock held while checkpointing, so the .read files match dms.db there
+    for user in dirty:
+        path = _path(user, ".read")
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{sent[user]} {read[user]} {unread[user]}")
+        os.replace(path + ".tmp", path)
+    dirty.clear()
+def _index(sender: str, recipient: str, offset: int, recovering: bool = False):
+    # called with the lock held, adds the DM at offset to both inboxes (when recovering, unless it's there already)
+    entry = ENTRY.pack(offset)
+    for user in {sender, recipient}:
+        _load(user)
+        if recovering and totals[user] and _offsets(user, totals[user] - 1, totals[user])[0] >= offset:
+            continue
+        with open(_path(user, ".idx"), "ab") as f:
+            f.write(entry)
+        totals[user] += 1
+    if recipient != sender:
+        unread[recipient] += 1
+        dirty.add(recipient)
+def send(time: str, sender: str, recipient: str, message: str, i: int = None) -> int:
+    os.makedirs(INBOX_DIR, exist_ok=True)
+    with lock: # a checkpoint sees a DM in both dms.db and the unread counts, or in neither
+        i, offset = db.add_message(time, sender, f"@{recipient} {message}", DM_LOG, i)
+        _index(sender, recipient, offset)
+    return i
+def recover(offset: int, line: str):
+    # a DM written after the last checkpoint: counted as unread again, and indexed if a crash came before that
+    _, _, sender, text = db.parse_message(line)
+    os.makedirs(INBOX_DIR, exist_ok=True)
+    with lock:
+        _index(sender, text.partition(" ")[0][1:], offset, True)
+def _offsets(user: str, start: int, end: int):
+    offsets = array("Q")
+    if end <= start:
+        return offsets
+    with open(_path(user, ".idx"), "rb") as f:
+        f.seek(start * ENTRY.size)
+        offsets.frombytes(f.read((end - start) * ENTRY.size))
+    return offsets
+def _lines(offsets) -> list:
+    with db.open_log(DM_LOG) as f:
+        return [db.read_at(f, offset) for offset in offsets]
+def recent(user: str, count: int = 20) -> list:
+    # the user's last count DMs, sent and received, oldest first
+    with lock:
+        _load(user)
+        end = totals[user]
+        offsets = _offsets(user, max(0, end - count), end)
+    return _lines(offsets)
+def unread_count(user: str) -> int:
+    with lock:
+        _load(user)
+        return unread[user]
+def has_new(user: str) -> bool:
+    with lock:
+        _load(user)
+        return sent[user] < totals[user]
+def position(user: str):
+    # -> (entries delivered, entries read, unread count)
+    with lock:
+        _load(user)
+        return sent[user], read[user], unread[user]
+def set_read(user: str, delivered_to: int, read_to: int, count: int):
+    # the user's DMs were delivered or read up to there on another cluster node
+    with lock:
+        _load(user)
+        if delivered_to > sent[user]:
+            sent[user] = delivered_to
+            dirty.add(user)
+        if read_to > read[user]:
+            read[user], unread[user] = read_to, count
+            dirty.add(user)
+def mark_read(user: str):
+    # the user opened their inbox, everything in it so far is read
+    with lock:
+        _load(user)
+        if read[user] < totals[user] or unread[user]:
+            read[user], unread[user] = totals[user], 0
+            dirty.add(user)
+def fetch(user: str):
+    # -> (undelivered DM lines, new delivered position), hand the position to delivered() once they're out
+    with lock:
+        _load(user)
+        start, end = sent[user], totals[user]
+        offsets = _offsets(user, start, end)
+    return _lines(offsets), end
+def delivered(user: str, position: int):
+    # they're still unread, a client being sent a DM doesn't mean anyone saw it
+    with lock:
+        if position > sent[user]:
+            sent[user] = position
+            dirty.add(user)
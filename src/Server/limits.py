@@ -0,0 +1,99 @@
+import threading, time
+# Ingest limits, checked before anything a client sends is parsed or stored.
+# Messages and commands go through token buckets per client, per IP and for the whole node. Each bucket refills
+# at its rate and holds up to BURST seconds of it, and a message takes one token from all three or none.
+# New connections are admitted in the accept loops, before any thread is started for them: at most
+# MAX_HANDSHAKES can be between accept and their hello, and one IP can open CONNECT_RATE a second.
+# Rejections are only counted, report() shows them for /limits. A rate of 0 turns that limit off.
+CLIENT_RATE = 20 # messages a second from one connection
+IP_RATE = 1000 # the session port only listens on localhost, so this is most of what reaches it
+GLOBAL_RATE = 5000
+CONNECT_RATE = 200 # new connections a second from one IP
+BURST = 2
+MAX_HANDSHAKES = 256
+ACCEPT_BACKLOG = 1024 # connections the kernel queues before accept
+HANDSHAKE_TIMEOUT = 5 # a connection that hasn't said hello by then loses its handshake slot
+IDLE_BUCKETS = 10000 # past this many buckets, full ones are forgotten
+lock = threading.Lock()
+buckets = {} # {(limit, key): [tokens, last refill]}
+handshakes = 0 # connections accepted that haven't finished their hello
+counts = {"admitted": 0, "busy": 0, "connect rate": 0, "allowed": 0, "client rate": 0, "ip rate": 0,
+          "global rate": 0}
+limited = {} # {client: messages it had rejected}, the worst ones show up in /limits
+
+def configure(client_rate=None, ip_rate=None, global_rate=None, connect_rate=None, max_handshakes=None):
+    # from --client-rate, --ip-rate, --global-rate, --connect-rate and --max-handshakes, None keeps the default
+    global CLIENT_RATE, IP_RATE, GLOBAL_RATE, CONNECT_RATE, MAX_HANDSHAKES
+    CLIENT_RATE = CLIENT_RATE if client_rate is None else float(client_rate)
+    IP_RATE = IP_RATE if ip_rate is None else float(ip_rate)
+    GLOBAL_RATE = GLOBAL_RATE if global_rate is None else float(global_rate)
+    CONNECT_RATE = CONNECT_RATE if connect_rate is None else float(connect_rate)
+    MAX_HANDSHAKES = MAX_HANDSHAKES if max_handshakes is None else int(max_handshakes)
+def _bucket(limit: str, key, rate: float, now: float) -> list:
+    # called with the lock held, the bucket refilled up to now
+    bucket = buckets.get((limit, key))
+    if bucket is None:
+        if len(buckets) > IDLE_BUCKETS:
+            _prune(now)
+        bucket = buckets[(limit, key)] = [rate * BURST, now]
+    else:
+        bucket[0] = min(rate * BURST, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    return bucket
+def _prune(now: float):
+    # buckets that have refilled all the way are the same as new ones
+    for key, (tokens, last) in list(buckets.items()):
+        rate = {"client": CLIENT_RATE, "ip": IP_RATE, "connect": CONNECT_RATE}.get(key[0], GLOBAL_RATE)
+        if tokens + (now - last) * rate >= rate * BURST:
+            del buckets[key]
+def allow(client, ip: str) -> bool:
+    # takes a token for one message or command from client's, ip's and the global bucket, False if any is empty
+    now = time.monotonic()
+    with lock:
+        taking = [(f"{limit} rate", _bucket(limit, key, rate, now)) for limit, key, rate in
+                  (("client", client, CLIENT_RATE), ("ip", ip, IP_RATE), ("global", None, GLOBAL_RATE)) if rate]
+        for name, bucket in taking:
+            if bucket[0] < 1:
+                counts[name] += 1
+                limited[client] = limited.get(client, 0) + 1
+                return False
+        for _, bucket in taking:
+            bucket[0] -= 1
+        counts["allowed"] += 1
+        return True
+def admit(ip: str) -> str:
+    # a connection that was just accepted, "" lets it in and it holds a handshake slot until handshaken() is
+    # called, otherwise why it was turned away
+    global handshakes
+    with lock:
+        if MAX_HANDSHAKES and handshakes >= MAX_HANDSHAKES:
+            counts["busy"] += 1
+            return "Server busy, try again"
+        if CONNECT_RATE:
+            bucket = _bucket("connect", ip, CONNECT_RATE, time.monotonic())
+            if bucket[0] < 1:
+                counts["connect rate"] += 1
+                return "Too many connections, try again"
+            bucket[0] -= 1
+        handshakes += 1
+        counts["admitted"] += 1
+        return ""
+def handshaken():
+    # an admitted connection said hello or went away, either way it's done with its slot
+    global handshakes
+    with lock:
+        handshakes -= 1
+def forget(client):
+    # the client disconnected
+    with lock:
+        buckets.pop(("client", client), None)
+        limited.pop(client, None)
+def report(limit: int = 10) -> str:
+    # for /limits
+    with lock:
+        rates = ", ".join(f"{name} {rate:g}/s" if rate else f"{name} off" for name, rate in
+                          (("client", CLIENT_RATE), ("ip", IP_RATE), ("global", GLOBAL_RATE), ("connect", CONNECT_RATE)))
+        rows = [f"Limits: {rates}, {handshakes}/{MAX_HANDSHAKES or 'unlimited'} handshakes in flight",
+                ", ".join(f"{count} {name}" for name, count in counts.items())]
+        worst = sorted(limited.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return "\n".join(rows + [f"{client}: {count} messages limited" for client, count in worst])
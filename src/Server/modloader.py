@@ -0,0 +1,272 @@
+import importlib, os, queue, sys, time, threading
+# Runs the mods in mods/, see mods/template.py.txt for the hooks a mod can define
+# Mods listed in mods/manifest.json ({"mod name": ["hook", ...]}) are only imported the first time one of
+# their hooks fires, anything not in the manifest is imported at startup like before.
+# Regenerate the manifest with: python modloader.py --manifest [mods dir]
+HOOKS = ("message_got", "successful_heartbeat", "client_connected")
+HOOK_BUDGET = 0.005 # seconds the server waits for a hook, one that takes longer is only queued for a while
+SLOW_FOR = 30 # seconds a hook that went over budget is only queued, then it's waited for again
+QUEUE_LIMIT = 1000 # calls a mod can have waiting for its worker, more are dropped
+RELOAD_INTERVAL = 2 # seconds between checks for changed mod files
+MANIFEST = "manifest.json"
+CO_COROUTINE = 0x80 # inspect.CO_COROUTINE, without importing inspect
+mods_dir = "mods"
+mods = {} # {mod name: module}
+mtimes = {} # {mod name: mtime of the file when it was loaded}
+lazy = {} # {mod name: hooks from the manifest} for mods that haven't been imported yet
+manifest_mtime = None
+dispatch = {hook: () for hook in HOOKS} # {hook: ((mod name, function or None if not imported yet, is async), ...)}
+slow = {} # {(mod name, hook): when it went over budget}, the server doesn't wait for these for SLOW_FOR seconds
+stats = {} # {(mod name, hook): [calls, total seconds, max seconds, errors, dropped]}
+stats_lock = threading.Lock() # stats are written by the mods' workers and read by report()
+queues = {} # {mod name: Queue of (hook, function, args, Event set when it's done or None)}
+send_message = None # the server sets this, it is handed to every mod as its send_message()
+lock = threading.Lock()
+reload_lock = threading.RLock()
+_loop = None
+
+def _async_loop():
+    # async hooks all share one event loop on its own thread, asyncio is only imported if a mod needs it
+    global _loop
+    with lock:
+        if _loop is None:
+            import asyncio
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+def _queue(name: str):
+    # each mod has a worker thread that runs its sync hooks in order, so one mod's slow hooks only hold up its own
+    with lock:
+        calls = queues.get(name)
+        if calls is None:
+            calls = queues[name] = queue.Queue(QUEUE_LIMIT)
+            threading.Thread(target=_worker, args=(name, calls), daemon=True, name=f"mod-{name}").start()
+    return calls
+def _worker(name: str, calls):
+    while True:
+        hook, func, args, done = calls.get()
+        _run(name, hook, func, args)
+        if done is not None:
+            done.set()
+def _record(name: str, hook: str, elapsed: float, failed: bool = False, dropped: bool = False):
+    with stats_lock:
+        s = stats.get((name, hook))
+        if s is None:
+            s = stats[(name, hook)] = [0, 0.0, 0.0, 0, 0]
+        if dropped:
+            s[4] += 1
+            return
+        s[0] += 1
+        s[1] += elapsed
+        if elapsed > s[2]:
+            s[2] = elapsed
+        if failed:
+            s[3] += 1
+def _run(name: str, hook: str, func, args) -> float:
+    # a broken mod must never take the server down with it
+    start = time.perf_counter()
+    failed = False
+    try:
+        func(*args)
+    except Exception as e:
+        failed = True
+        print(f"[MODS]: {name}.{hook} failed: {e}")
+    elapsed = time.perf_counter() - start
+    _record(name, hook, elapsed, failed)
+    return elapsed
+async def _run_async(name: str, hook: str, func, args):
+    start = time.perf_counter()
+    failed = False
+    try:
+        await func(*args)
+    except Exception as e:
+        failed = True
+        print(f"[MODS]: {name}.{hook} failed: {e}")
+    _record(name, hook, time.perf_counter() - start, failed)
+def _resolve(name: str, hook: str):
+    # first time a lazy mod's hook fires, import it and hand back the real function
+    with reload_lock:
+        if name in lazy:
+            try:
+                _import(name, os.path.join(mods_dir, name + ".py"))
+                print(f"[MODS]: Loaded {name} on first {hook}")
+            except Exception as e:
+                mtimes[name] = os.path.getmtime(os.path.join(mods_dir, name + ".py"))
+                print(f"[MODS]: Could not load {name}: {e}")
+            del lazy[name]
+            _build_dispatch()
+    for mod_name, func, is_async in dispatch[hook]:
+        if mod_name == name:
+            return func, is_async
+    return None, False
+def fire(hook: str, *args):
+    # called from the server's hot paths, so the no-mods case is a single lookup
+    handlers = dispatch[hook]
+    if not handlers:
+        return
+    for name, func, is_async in handlers:
+        if func is None:
+            func, is_async = _resolve(name, hook)
+            if func is None:
+                continue
+        if is_async:
+            import asyncio
+            asyncio.run_coroutine_threadsafe(_run_async(name, hook, func, args), _async_loop())
+        else:
+            # a hook that hangs holds the server up for HOOK_BUDGET and no longer, and finishes on the mod's worker
+            marked = slow.get((name, hook))
+            done = None if marked is not None and time.monotonic() - marked < SLOW_FOR else threading.Event()
+            try:
+                _queue(name).put_nowait((hook, func, args, done))
+            except queue.Full:
+                _record(name, hook, 0.0, dropped=True)
+                continue
+            if done is None:
+                continue
+            if done.wait(HOOK_BUDGET):
+                slow.pop((name, hook), None)
+            else:
+                slow[(name, hook)] = time.monotonic()
+                if marked is None:
+                    print(f"[MODS]: {name}.{hook} is over its {HOOK_BUDGET * 1000:.0f}ms budget, not waiting for it for {SLOW_FOR}s")
+def _build_dispatch():
+    table = {hook: [] for hook in HOOKS}
+    for name in sorted(set(mods) | set(lazy)):
+        if name in lazy:
+            for hook in lazy[name]:
+                if hook in table:
+                    table[hook].append((name, None, False))
+            continue
+        for hook in HOOKS:
+            func = getattr(mods[name], hook, None)
+            if callable(func):
+                code = getattr(func, "__code__", None)
+                table[hook].append((name, func, code is not None and bool(code.co_flags & CO_COROUTINE)))
+    for name in {name for handlers in table.values() for name, _, is_async in handlers if not is_async}:
+        _queue(name) # ready before the first hook fires, or starting it would count against that hook's budget
+    # swap the whole table in one go, fire() never sees a half built one
+    global dispatch
+    dispatch = {hook: tuple(handlers) for hook, handlers in table.items()}
+def _import(name: str, path: str):
+    module_name = f"{os.path.basename(mods_dir)}.{name}"
+    if module_name in sys.modules:
+        module = importlib.reload(sys.modules[module_name])
+    else:
+        module = importlib.import_module(module_name)
+    if send_message is not None:
+        module.send_message = send_message
+    mods[name] = module
+    mtimes[name] = os.path.getmtime(path)
+def _forget(name: str):
+    mods.pop(name, None)
+    mtimes.pop(name, None)
+    lazy.pop(name, None)
+    for key in [k for k in list(slow) if k[0] == name]:
+        slow.pop(key, None)
+    with stats_lock:
+        for key in [k for k in stats if k[0] == name]:
+            del stats[key]
+def read_manifest(directory: str) -> dict:
+    import json
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+def scan_hooks(path: str) -> list:
+    # which hooks a mod file defines, read from the source so nothing gets imported
+    import ast
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    return [node.name for node in tree.body
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name in HOOKS]
+def write_manifest(directory: str = "mods") -> dict:
+    import json
+    manifest = {}
+    for file in sorted(os.listdir(directory)):
+        if file.endswith(".py") and not file.startswith("__"):
+            manifest[file[:-3]] = scan_hooks(os.path.join(directory, file))
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+def load(directory: str = "mods"):
+    global mods_dir
+    mods_dir = directory
+    reload()
+    print(f"[MODS]: Loaded {len(mods)} mod(s), {len(lazy)} waiting for their first hook")
+def reload() -> bool:
+    # picks up new, changed and deleted mods, returns True if anything changed
+    with reload_lock:
+        return _reload()
+def _reload() -> bool:
+    global manifest_mtime
+    changed = False
+    manifest_path = os.path.join(mods_dir, MANIFEST)
+    current = os.path.getmtime(manifest_path) if os.path.exists(manifest_path) else None
+    manifest = read_manifest(mods_dir) if current != manifest_mtime else None
+    found = {}
+    for file in os.listdir(mods_dir):
+        if file.endswith(".py") and not file.startswith("__"):
+            found[file[:-3]] = os.path.join(mods_dir, file)
+    for name in list(mods) + list(lazy):
+        if name not in found:
+            _forget(name)
+            print(f"[MODS]: Unloaded {name}")
+            changed = True
+    if manifest is not None:
+        # the manifest changed, mods that haven't been imported yet follow the new hook lists
+        manifest_mtime = current
+        for name in list(lazy):
+            if name in manifest:
+                lazy[name] = manifest[name]
+        changed = True
+    else:
+        manifest = {}
+    for name, path in found.items():
+        if name in lazy:
+            continue
+        try:
+            if mtimes.get(name) == os.path.getmtime(path):
+                continue
+            reloading = name in mods
+            _forget(name)
+            if name in manifest and not reloading:
+                lazy[name] = manifest[name]
+                changed = True
+                continue
+            _import(name, path)
+            print(f"[MODS]: {'Reloaded' if reloading else 'Loaded'} {name}")
+        except Exception as e:
+            # remember the broken file so it isn't retried until it changes again
+            mtimes[name] = os.path.getmtime(path)
+            print(f"[MODS]: Could not load {name}: {e}")
+        changed = True
+    if changed:
+        _build_dispatch()
+    return changed
+def watch(interval: float = RELOAD_INTERVAL):
+    # hot reload, checks the mod files' mtimes in the background
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                reload()
+            except OSError as e:
+                print(f"[MODS]: Reload failed: {e}")
+    threading.Thread(target=loop, daemon=True).start()
+def report() -> str:
+    lines = []
+    with stats_lock:
+        rows = sorted((key, list(s)) for key, s in stats.items())
+    now = time.monotonic()
+    for (name, hook), (calls, total, worst, errors, dropped) in rows:
+        where = "queued" if now - slow.get((name, hook), -SLOW_FOR) < SLOW_FOR else "waited for"
+        average = total / calls * 1000 if calls else 0.0
+        lines.append(f"{name}.{hook}: {calls} calls, avg {average:.2f}ms, max {worst * 1000:.2f}ms, {errors} errors, "
+                     f"{dropped} dropped ({where})")
+    return "\n".join(lines)
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--manifest":
+        directory = sys.argv[2] if len(sys.argv) > 2 else "mods"
+        for name, hooks in write_manifest(directory).items():
+            print(f"{name}: {', '.join(hooks) or 'no hooks'}")
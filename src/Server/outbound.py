@@ -0,0 +1,161 @@
+import socket, threading, time
+from collections import deque
+import compress, frames
+# Outbound queues for session connections. Only a session's writer thread sends on its socket, everything
+# else queues frames and moves on, so a client that stops reading only ever stalls its own writer.
+# Queued deliveries are bounded by LIMIT bytes. A delivery always fits in a queue with no deliveries in it,
+# past that POLICY decides what a slow client gets:
+#   "drop"       the oldest queued deliveries are thrown away
+#   "coalesce"   every queued delivery is replaced by one GAP frame, "missed lines;first id;last id", and the
+#                client /syncs that stretch back (DMs in it are left to /inbox)
+#   "disconnect" the session is closed
+# A session whose oldest queued frame has waited STALL seconds is closed whatever the policy.
+# Files (see put_file) go out a FILE_CHUNK at a time with sendfile, and after each chunk the rest goes to the
+# back of the queue, so a big download takes turns with deliveries and pings instead of holding them up.
+LIMIT = 1024 * 1024
+POLICY = "coalesce"
+STALL = 10
+FILE_CHUNK = 256 * 1024
+
+def attach(state: dict, writer: bool = True):
+    # adds the queue to a session's state and starts its writer, or leaves that to start() when something has
+    # to go out on the socket directly first. state["policy"] overrides POLICY
+    state.update({"queue": deque(), "queued": 0, "ready": threading.Condition(state["lock"]), "closed": False,
+                  "dropped": 0, "gaps": 0, "sent": 0, "peak": 0})
+    if writer:
+        start(state)
+def start(state: dict):
+    threading.Thread(target=_writer, args=(state,), daemon=True).start()
+def _ids(lines: list):
+    # -> (first, last) message id in delivered lines, which can start with "#channel;" or "@dm;"
+    ids = [int(line.split(";", 2)[1] if line[0] in "#@" else line.split(";", 1)[0]) for line in lines]
+    return min(ids), max(ids)
+def newest(lines: list) -> int:
+    # the last message id in delivered lines, how far the client has been sent
+    return _ids(lines)[1]
+def put(state: dict, kind: int, payload: bytes, lines: list = None):
+    # queues a frame, lines are the delivered lines for a DELIVERY
+    with state["ready"]:
+        if state["closed"]:
+            return
+        queue = state["queue"]
+        entry = [kind, payload, 0, 0, 0, time.time()] # kind, payload, line count, first id, last id, queued at
+        if kind == frames.DELIVERY:
+            entry[2:5] = [len(lines), *_ids(lines)]
+            policy = state.get("policy", POLICY)
+            if state["queued"] and state["queued"] + len(payload) > LIMIT:
+                if policy == "disconnect":
+                    print(f"[SERVER]: Closing slow session @{state['user']}, {state['queued']} bytes behind")
+                    _close(state)
+                    return
+                if policy == "drop":
+                    while state["queued"] and state["queued"] + len(payload) > LIMIT:
+                        _remove(state, next(e for e in queue if e[0] == frames.DELIVERY))
+                else:
+                    gap = next((e for e in queue if e[0] == frames.GAP), None)
+                    if gap is None:
+                        state["gaps"] += 1
+                        gap = [frames.GAP, b"", 0, entry[3], entry[4], entry[5]]
+                        queue.append(gap)
+                    state["dropped"] += entry[2]
+                    for old in [e for e in queue if e[0] == frames.DELIVERY] + [entry]:
+                        if old is not entry:
+                            _remove(state, old)
+                        gap[2] += old[2]
+                        gap[3], gap[4] = min(gap[3], old[3]), max(gap[4], old[4])
+                    state["ready"].notify()
+                    return
+            state["queued"] += len(payload)
+            state["peak"] = max(state["peak"], state["queued"])
+        queue.append(entry)
+        state["ready"].notify()
+def put_file(state: dict, kind: int, name: str, path: str, offset: int, end: int):
+    # queues bytes offset to end of a file, sent as kind frames of "name;offset;end;" and up to FILE_CHUNK bytes
+    with state["ready"]:
+        if state["closed"] or offset >= end:
+            return
+        state["queue"].append([kind, (name, path, offset, end), 0, 0, 0, time.time()])
+        state["ready"].notify()
+def _send_file(state: dict, kind: int, name: str, path: str, offset: int, end: int):
+    # one chunk, the file's bytes go from the page cache to the socket without passing through here
+    # (socket.sendfile is os.sendfile on a plain connection, and copies through a buffer with TLS)
+    size = min(FILE_CHUNK, end - offset)
+    try:
+        f = open(path, "rb")
+    except OSError as e:
+        print(f"[SERVER]: Can't send {path}: {e}")
+        return
+    with f:
+        head = f"{name};{offset};{end};".encode()
+        state["sock"].sendall(frames.HEAD.pack(len(head) + size, kind) + head)
+        if state["sock"].sendfile(f, offset, size) != size:
+            raise OSError(f"{path} is shorter than {end} bytes") # the frame can't be finished, nor the connection
+    state["sent"] += frames.HEAD.size + len(head) + size
+def _remove(state: dict, entry: list):
+    # called with the lock held, takes a queued delivery out unsent
+    state["queue"].remove(entry)
+    state["queued"] -= len(entry[1])
+    state["dropped"] += entry[2]
+def _writer(state: dict):
+    while True:
+        with state["ready"]:
+            while not state["queue"] and not state["closed"]:
+                state["ready"].wait()
+            if state["closed"]:
+                return
+            kind, payload, count, first, last, _ = state["queue"].popleft()
+            if kind == frames.DELIVERY:
+                state["queued"] -= len(payload)
+            elif type(payload) is tuple:
+                name, path, offset, end = payload
+                if offset + FILE_CHUNK < end:
+                    state["queue"].append([kind, (name, path, offset + FILE_CHUNK, end), 0, 0, 0, time.time()])
+        if type(payload) is tuple:
+            try:
+                _send_file(state, kind, *payload)
+            except OSError:
+                close(state)
+                return
+            continue
+        if kind == frames.GAP:
+            payload = f"{count};{first};{last}".encode()
+        elif kind == frames.DELIVERY and state["stream"] is not None:
+            # only this thread touches the compression stream, so frames go into it in the order they're sent
+            payload = compress.frame(state["stream"], state["codec"], payload)
+        try:
+            state["sock"].sendall(frames.pack(kind, payload))
+            state["sent"] += len(payload) + frames.HEAD.size
+        except OSError:
+            close(state)
+            return
+def close(state: dict):
+    with state["ready"]:
+        _close(state)
+def _close(state: dict):
+    # shutting the socket down wakes up the session's reader and anything blocked sending, the reader cleans up
+    state["closed"] = True
+    state["ready"].notify_all()
+    try:
+        state["sock"].shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+def behind(state: dict) -> float:
+    # seconds the oldest queued frame has waited, 0 with nothing queued
+    queue = state["queue"]
+    try:
+        return time.time() - queue[0][5] if queue else 0
+    except IndexError: # the writer took it in between
+        return 0
+def stalled(state: dict) -> bool:
+    return behind(state) > STALL
+def report(sessions, limit: int = 20) -> str:
+    # the sessions furthest behind, for /lag, sessions is the server's registry
+    rows = []
+    for entry in sessions.snapshot():
+        key, state = entry.key, entry.state
+        if state["queued"] or state["dropped"] or state["gaps"]:
+            rows.append((state["queued"], f"{key} @{state['user']}: {state['queued']} bytes in {len(state['queue'])} "
+                         f"frames, {behind(state):.1f}s behind, peak {state['peak']}, {state['dropped']} lines "
+                         f"dropped, {state['gaps']} gaps, {state['sent']} bytes sent"))
+    rows.sort(reverse=True)
+    return "\n".join(row for _, row in rows[:limit]) or f"No lagging sessions ({len(sessions)} connected)"
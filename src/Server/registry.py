@@ -0,0 +1,59 @@
+import threading, time
+# Connected clients. A Registry maps a client's key (the session key "ip:port" on the session port, the address
+# for legacy clients, which can only have one connection per address) to an Entry. Adding, removing and looking
+# up are dict operations under a lock. snapshot() hands out a tuple of the entries that's only rebuilt after
+# something joined or left, so the delivery loop and /clients can go over every client without copying or
+# holding the lock while they do.
+
+class Entry:
+    __slots__ = ("key", "address", "user", "conn", "state", "since", "seen", "cursor", "received", "sent")
+    def __init__(self, key: str, address: str, user: str = None, conn=None, state: dict = None, cursor: int = 0):
+        self.key = key
+        self.address = address
+        self.user = user
+        self.conn = conn # the session's socket, None for legacy clients, which get a new connection every time
+        self.state = state # the session's outbound queue, see outbound.py
+        self.since = self.seen = time.time() # connected at, and last heard from (a pong or heartbeat)
+        self.cursor = cursor # newest message id sent to it
+        self.received = 0 # messages and commands from it
+        self.sent = 0 # lines delivered to it
+    def __repr__(self) -> str:
+        return f"{self.key} @{self.user or self.address}"
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.cached = () # what snapshot() returns, None once entries changed
+    def add(self, entry: Entry) -> Entry:
+        with self.lock:
+            self.entries[entry.key] = entry
+            self.cached = None
+        return entry
+    def remove(self, key: str):
+        # the entry that was there, or None, so two threads noticing the same client leave can both call it
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.cached = None
+            return entry
+    def get(self, key: str):
+        return self.entries.get(key)
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+    def __len__(self) -> int:
+        return len(self.entries)
+    def snapshot(self) -> tuple:
+        # every entry as of now. The tuple is shared, and only rebuilt after an add() or remove()
+        cached = self.cached
+        if cached is None:
+            with self.lock:
+                if self.cached is None:
+                    self.cached = tuple(self.entries.values())
+                cached = self.cached
+        return cached
+    def report(self, limit: int = 50) -> str:
+        # for /clients and the debug print
+        now = time.time()
+        rows = [f"{entry!r}: connected {now - entry.since:.0f}s, seen {now - entry.seen:.1f}s ago, up to id "
+                f"{entry.cursor}, {entry.received} received, {entry.sent} lines sent" for entry in self.snapshot()[:limit]]
+        return "\n".join(rows) or "No clients"
@@ -0,0 +1,118 @@
+import json, os, time
+from itertools import chain
+import db, channels
+# Retention for channel logs. A channel's policy keeps its messages by age ("days"), count ("messages") and
+# size ("mb" of messages, uncompressed), and "archive days" moves cold blocks older than that into the archive
+# tier (see db.py). Everything is done a whole cold block or archive segment at a time, oldest first: a block
+# goes once all of it is past one of the limits, so a channel keeps a little more than its policy says. The live
+# file and the newest cold block are never dropped.
+# Policies come from --retain-days, --retain-messages, --retain-mb and --archive-days for every channel, and
+# retention.json for single ones: {"random": {"days": 7}, "general": {"messages": 100000, "archive days": 30}}.
+# DMs and the cluster's stream log are kept whole, inbox positions and the stream index point into them.
+POLICY_FILE = "retention.json"
+LIMITS = ("days", "messages", "mb", "archive days")
+defaults = dict.fromkeys(LIMITS)
+policies = {} # {channel: {limit: value}} from POLICY_FILE
+summaries = {} # {(log path, block offset): (lines, newest time)} for cold blocks, decompressed once to find out
+
+def configure(days=None, messages=None, mb=None, archive_days=None):
+    # the defaults from the command line, then the per channel ones from POLICY_FILE
+    for limit, value in zip(LIMITS, (days, messages, mb, archive_days)):
+        defaults[limit] = None if value is None else float(value)
+    try:
+        with open(POLICY_FILE) as f:
+            loaded = json.load(f)
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        print(f"[RETENTION]: {POLICY_FILE} is not valid JSON, ignoring it: {e}")
+        return
+    for channel, limits in loaded.items():
+        policies[channel.removeprefix("#").lower()] = {k: float(v) for k, v in limits.items() if k in LIMITS and v is not None}
+def policy(channel: str) -> dict:
+    return {**defaults, **policies.get(channel, {})}
+def _summary(path: str, f, entry) -> tuple:
+    # (lines, newest time) of a cold block
+    key = (path, entry[0])
+    found = summaries.get(key)
+    if found is None:
+        data = db._read_block(f, entry)
+        try:
+            newest = db.parse_message(data[data.rfind(b"\n") + 1:].decode())[1]
+        except ValueError:
+            newest = 0
+        found = summaries[key] = (data.count(b"\n"), newest)
+    return found
+def _live_lines(path: str) -> int:
+    try:
+        with open(path, "rb") as f:
+            return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1024 * 1024), b""))
+    except FileNotFoundError:
+        return 0
+def _cut(path: str, rules: dict, now: float) -> int:
+    # the offset everything before can be dropped up to, going from the newest cold block back into the archive.
+    # A unit is dropped once its newest message is too old, or the ones after it fill the count or size already
+    entries = db._cold_entries(path)
+    if not entries:
+        return 0
+    archive = [(start, end, lines, newest) for start, end, lines, newest, _ in db._archive_entries(path)]
+    counting = rules["days"] is not None or rules["messages"] is not None
+    with open(path + ".cold", "rb") as f:
+        # a summary costs a decompression the first time, only age and count need them
+        summary = (lambda entry: _summary(path, f, entry)) if counting else (lambda entry: (0, now))
+        newer_lines = _live_lines(path) + summary(entries[-1])[0] if rules["messages"] is not None else 0
+        newer_bytes = db.log_size(path) - entries[-1][0]
+        cold_units = ((entry[0], entry[0] + entry[4], *summary(entry)) for entry in reversed(entries[:-1]))
+        for start, end, lines, newest in chain(cold_units, reversed(archive)):
+            if (rules["days"] is not None and newest < now - rules["days"] * 86400 or
+                    rules["messages"] is not None and newer_lines >= rules["messages"] or
+                    rules["mb"] is not None and newer_bytes >= rules["mb"] * 1024 * 1024):
+                return end
+            newer_lines += lines
+            newer_bytes += end - start
+    return 0
+def enforce(channel: str, path: str) -> str:
+    # applies the channel's policy to its log, what was done for the log line, "" for nothing. Run by the
+    # compaction thread only, nothing else changes cold blocks
+    rules = policy(channel)
+    if all(value is None for value in rules.values()) or not os.path.exists(path + ".cold.idx"):
+        return ""
+    now = time.time()
+    done = []
+    before = db.first_offset(path)
+    if any(rules[limit] is not None for limit in ("days", "messages", "mb")):
+        cut = _cut(path, rules, now)
+        if cut > before:
+            done.append(f"dropped {db.drop_before(path, cut) - before} bytes")
+            for key in [key for key in summaries if key[0] == path and key[1] < cut]:
+                del summaries[key]
+    if rules["archive days"] is not None:
+        # whole segments' worth of blocks old enough, the rest waits until there's enough of it
+        moved = 0
+        while True:
+            entries = db._cold_entries(path)
+            with open(path + ".cold", "rb") as f:
+                count, size = 0, 0
+                while (count < len(entries) - 1 and size < db.ARCHIVE_SEGMENT and
+                       _summary(path, f, entries[count])[1] < now - rules["archive days"] * 86400):
+                    size += entries[count][4]
+                    count += 1
+            if size < db.ARCHIVE_SEGMENT:
+                break
+            moved += db.archive_cold(path, count)
+        if moved:
+            done.append(f"archived {moved} bytes")
+    return ", ".join(done)
+def report() -> str:
+    # for /retention, every channel's policy and how its log is split between the tiers
+    rows = []
+    for channel in channels.known():
+        path = channels.log_path(channel)
+        rules = ", ".join(f"{limit} {value:g}" for limit, value in policy(channel).items() if value is not None)
+        entries = db._cold_entries(path)
+        archive = db._archive_entries(path)
+        live = db.log_size(path) - db.base(path)
+        rows.append(f"#{channel}: {rules or 'kept forever'}. From offset {db.first_offset(path)}: {len(archive)} archive "
+                    f"segments ({sum(e[1] - e[0] for e in archive)} bytes), {len(entries)} cold blocks "
+                    f"({sum(e[4] for e in entries)} bytes), {live} bytes live")
+    return "\n".join(rows)
@@ -0,0 +1,321 @@
+import os, re, struct, threading
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from itertools import accumulate
+import db
+# Inverted index over the message log, so searching doesn't mean re-parsing every line of database.db
+# Messages are numbered by their position in the log (doc numbers), each term maps to the sorted doc numbers
+# it appears in, and doc numbers map to byte offsets in the log so hits are a seek away.
+# On disk the index is a list of segments, each holding the docs added since the last one with every list
+# delta encoded. Anything that never made it into a segment is re-read from the log on startup. Opening only
+# reads the segments' offsets, /sync needs those, their posting lists are read by the first search.
+WORD = re.compile(r"\w+")
+ESCAPE = re.compile(r"\\(.)")
+QUERY = re.compile(r'"([^"]*)"|(\S+)')
+FLUSH_EVERY = 10000 # new messages kept in memory before they get written out as a segment
+MAX_SEGMENTS = 8 # past this many segments they all get merged back into one
+MAX_TERM = 0xFFFF // 4 # longer words (pasted blobs) aren't indexed, segments store a term's length in 2 bytes
+MAGIC = b"CIX1"
+HEAD = struct.Struct("<QQI") # first doc, doc count, term count
+LIST_HEAD = struct.Struct("<cI") # array typecode, count
+
+def tokens(message: str) -> list:
+    # messages are stored escaped (see fix_string), undo that before splitting into words
+    message = ESCAPE.sub(lambda m: "\n" if m.group(1) == "n" else m.group(1), message)
+    return WORD.findall(message.lower())
+def user_term(user: str) -> str:
+    # usernames live in the same index, the @ keeps them apart from words
+    return "@" + user.lower()
+def _pack(values, base: int = 0) -> bytes:
+    # delta encode, then store in the narrowest array type the biggest gap fits in
+    deltas = [b - a for a, b in zip([base] + list(values[:-1]), values)]
+    biggest = max(deltas, default=0)
+    code = "B" if biggest < 1 << 8 else "H" if biggest < 1 << 16 else "I" if biggest < 1 << 32 else "Q"
+    return LIST_HEAD.pack(code.encode(), len(deltas)) + array(code, deltas).tobytes()
+def _unpack(data, pos: int, base: int, code: str):
+    kind, count = LIST_HEAD.unpack_from(data, pos)
+    pos += LIST_HEAD.size
+    deltas = array(kind.decode())
+    end = pos + count * deltas.itemsize
+    deltas.frombytes(data[pos:end])
+    values = array(code, accumulate(deltas, initial=base))
+    del values[0]
+    return values, end
+class Index:
+    def __init__(self, log: str = "database.db", directory: str = "search"):
+        self.log = log
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.offsets = array("Q") # doc number -> byte offset of its line in the log
+        self.postings = {} # term -> array of doc numbers, ascending
+        self.sorted_terms = [] # for prefix queries, new terms wait in new_terms until the next one
+        self.new_terms = set()
+        self.flushed = 0 # docs below this are in segments on disk
+        self.segments = []
+        self.unread = [] # segments whose posting lists aren't in postings yet, see _read_postings()
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(".seg"))
+        for name in names:
+            try:
+                loaded = self._load_offsets(os.path.join(self.directory, name))
+            except (ValueError, struct.error) as e:
+                # cut short or garbled, by a crash or the disk. Its messages get read from the log again
+                print(f"[SEARCH]: Segment {name} is unreadable ({e})")
+                loaded = False
+            if not loaded:
+                # or left over from a compaction cut short, what it held is in the merged segment, or gets read
+                # from the log again
+                os.remove(os.path.join(self.directory, name))
+                print(f"[SEARCH]: Removed stale segment {name}")
+                continue
+            self.segments.append(name)
+        self.flushed = len(self.offsets)
+        self.unread = list(self.segments)
+        added = self.catch_up()
+        print(f"[SEARCH]: {len(self.offsets)} messages indexed ({added} read from the log)")
+    def _load_offsets(self, path: str) -> bool:
+        # reads a segment up to the end of its offsets, False for one that doesn't carry on where the ones
+        # loaded so far end
+        with open(path, "rb") as f:
+            data = f.read(4 + HEAD.size + LIST_HEAD.size)
+            if data[:4] != MAGIC:
+                raise ValueError(f"{path} is not a search segment")
+            first, count, _ = HEAD.unpack_from(data, 4)
+            kind, count = LIST_HEAD.unpack_from(data, 4 + HEAD.size)
+            size = count * array(kind.decode()).itemsize
+            data += f.read(size)
+        if len(data) < 4 + HEAD.size + LIST_HEAD.size + size:
+            raise ValueError("it ends in the middle of its offsets")
+        offsets, _ = _unpack(data, 4 + HEAD.size, 0, "Q")
+        # doc numbers start over after trim(), log offsets only ever go up
+        if first != len(self.offsets) or self.offsets and offsets and offsets[0] <= self.offsets[-1]:
+            return False
+        self.offsets.extend(offsets)
+        return True
+    def _read_postings(self):
+        # called with the lock held, before anything that needs every doc's terms. The segments opened at
+        # startup come first, then what was added since
+        if not self.unread:
+            return
+        postings = {}
+        for name in self.unread:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                data = f.read()
+            first, _, term_count = HEAD.unpack_from(data, 4)
+            kind, count = LIST_HEAD.unpack_from(data, 4 + HEAD.size)
+            pos = 4 + HEAD.size + LIST_HEAD.size + count * array(kind.decode()).itemsize
+            for _ in range(term_count):
+                size = data[pos] | data[pos + 1] << 8
+                term = data[pos + 2:pos + 2 + size].decode()
+                docs, pos = _unpack(data, pos + 2 + size, first, "I")
+                if term in postings:
+                    postings[term].extend(docs)
+                else:
+                    postings[term] = docs
+        for term, docs in self.postings.items():
+            if term in postings:
+                postings[term].extend(docs)
+            else:
+                postings[term] = docs
+        self.postings = postings
+        self.sorted_terms = sorted(postings)
+        self.new_terms = set()
+        self.unread = []
+    def catch_up(self) -> int:
+        # index whatever is in the log past the last indexed message
+        if db.log_size(self.log) == 0:
+            return 0
+        added = 0
+        with db.open_log(self.log) as f:
+            if self.offsets:
+                f.seek(self.offsets[-1])
+                f.readline() # already indexed
+            pos = f.tell()
+            for raw in f:
+                start = pos
+                pos += len(raw)
+                line = raw.decode(errors="replace").strip("\n")
+                if not line:
+                    continue
+                try:
+                    _, _, user, message = db.parse_message(line)
+                except ValueError:
+                    continue
+                self.add(start, user, message)
+                added += 1
+        return added
+    def add(self, offset: int, user: str, message: str):
+        with self.lock:
+            doc = len(self.offsets)
+            self.offsets.append(offset)
+            postings = self.postings
+            for term in set(tokens(message)) | {user_term(user)}:
+                if len(term) > MAX_TERM:
+                    continue
+                docs = postings.get(term)
+                if docs is None:
+                    postings[term] = array("I", (doc,))
+                    self.new_terms.add(term)
+                else:
+                    docs.append(doc)
+            if doc + 1 - self.flushed >= FLUSH_EVERY:
+                self._flush()
+    def flush(self):
+        with self.lock:
+            self._flush()
+    def _flush(self):
+        first = self.flushed
+        last = len(self.offsets)
+        if last == first:
+            return
+        terms = []
+        for term, docs in self.postings.items():
+            i = bisect_left(docs, first)
+            if i < len(docs):
+                terms.append((term, docs[i:]))
+        self._write(f"{first:012d}.seg", first, self.offsets[first:last], terms)
+        self.flushed = last
+        if len(self.segments) > MAX_SEGMENTS:
+            self._compact()
+    def _write(self, name: str, first: int, offsets, terms):
+        out = [MAGIC, HEAD.pack(first, len(offsets), len(terms)), _pack(offsets)]
+        for term, docs in terms:
+            encoded = term.encode()
+            out.append(struct.pack("<H", len(encoded)) + encoded + _pack(docs, first))
+        path = os.path.join(self.directory, name)
+        # write, sync then rename, a crash or power cut never leaves half a segment behind
+        with open(path + ".tmp", "wb") as f:
+            f.write(b"".join(out))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.segments.append(name)
+    def _compact(self):
+        self._read_postings()
+        old = self.segments
+        self.segments = []
+        self._write(f"{0:012d}.seg.new", 0, self.offsets[:self.flushed],
+                    [(term, docs[:bisect_left(docs, self.flushed)]) for term, docs in self.postings.items()])
+        # the merged segment goes in first, a crash before the old ones are gone leaves them for open() to spot
+        os.replace(os.path.join(self.directory, f"{0:012d}.seg.new"), os.path.join(self.directory, f"{0:012d}.seg"))
+        for name in old:
+            if name != f"{0:012d}.seg":
+                os.remove(os.path.join(self.directory, name))
+        self.segments = [f"{0:012d}.seg"]
+    def trim(self, start: int) -> int:
+        # forgets the messages before offset start, which retention dropped from the log. Doc numbers are only
+        # used in here, so what's left is renumbered from 0 and written back out as one segment
+        with self.lock:
+            dead = bisect_left(self.offsets, start)
+            if not dead:
+                return 0
+            self._read_postings()
+            self.offsets = self.offsets[dead:]
+            for term, docs in list(self.postings.items()):
+                i = bisect_left(docs, dead)
+                if i == len(docs):
+                    del self.postings[term]
+                else:
+                    self.postings[term] = array("I", (doc - dead for doc in docs[i:]))
+            self.sorted_terms = sorted(self.postings)
+            self.new_terms = set()
+            self.flushed = max(0, self.flushed - dead)
+            self._compact()
+            return dead
+    def _terms_with_prefix(self, prefix: str) -> list:
+        if self.new_terms:
+            self.sorted_terms = list(merge(self.sorted_terms, sorted(self.new_terms)))
+            self.new_terms = set()
+        terms = []
+        i = bisect_left(self.sorted_terms, prefix)
+        while i < len(self.sorted_terms) and self.sorted_terms[i].startswith(prefix):
+            terms.append(self.sorted_terms[i])
+            i += 1
+        return terms
+    def _clause(self, word: str):
+        # one query word -> the posting lists a matching doc is in one of, None for a word that's really a phrase
+        if word.startswith("from:"):
+            word = "@" + word[5:]
+        if word.endswith("*") and len(word) > 1:
+            return [self.postings[t] for t in self._terms_with_prefix(word[:-1].lower())]
+        if word.startswith("@"):
+            return [self.postings.get(user_term(word[1:]), array("I"))]
+        found = tokens(word)
+        if len(found) != 1:
+            return None # punctuation, or really a phrase ("don't"), left to the phrase check
+        return [self.postings.get(found[0], array("I"))]
+    def first_after(self, i: int) -> int:
+        # doc number of the first message with an id above i, found by binary search since ids only go up
+        lo, hi = 0, len(self.offsets)
+        with db.open_log(self.log) as f:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                line = db.read_at(f, self.offsets[mid])
+                if not line or db.parse_message(line)[0] <= i: # dropped lines are older than anything kept
+                    lo = mid + 1
+                else:
+                    hi = mid
+        return lo
+    def search(self, query: str, limit: int = 20) -> list:
+        # words are ANDed, word* is a prefix, @user or from:user filters by sender, "a b" is a phrase
+        # returns up to limit matching log lines, newest first
+        clauses = []
+        phrases = []
+        with self.lock:
+            self._read_postings()
+            for phrase, word in QUERY.findall(query):
+                if not phrase:
+                    lists = self._clause(word)
+                    if lists is not None:
+                        clauses.append(lists)
+                        continue
+                words = tokens(phrase or word)
+                if words:
+                    # each word of a phrase narrows it down, the order is checked on the lines that are left
+                    phrases.append(" ".join(words))
+                    clauses += [[self.postings.get(w, array("I"))] for w in set(words)]
+            # add() only appends to these and trim() replaces them, so they can be walked without the lock
+            offsets = self.offsets
+        if not clauses:
+            return []
+        # the rarest clause drives, the others are checked by binary search, the likeliest to fail first
+        clauses.sort(key=lambda lists: sum(map(len, lists)))
+        first, rest = clauses[0], clauses[1:]
+        results = []
+        with db.open_log(self.log) as f:
+            for doc in reversed(first[0]) if len(first) == 1 else _newest_first(first):
+                for lists in rest:
+                    if len(lists) == 1:
+                        docs = lists[0]
+                        i = bisect_left(docs, doc)
+                        if i == len(docs) or docs[i] != doc:
+                            break
+                    elif not _has(lists, doc):
+                        break
+                else:
+                    line = db.read_at(f, offsets[doc])
+                    if not line:
+                        continue # dropped by retention, trim() hasn't caught up
+                    if phrases:
+                        words = " " + " ".join(tokens(db.parse_message(line)[3])) + " "
+                        if not all(f" {p} " in words for p in phrases):
+                            continue
+                    results.append(line)
+                    if len(results) == limit:
+                        break
+        return results
+def _newest_first(lists):
+    # the docs in any of lists, descending, without merging them up front
+    last = None
+    for doc in merge(*(reversed(docs) for docs in lists), reverse=True):
+        if doc != last:
+            last = doc
+            yield doc
+def _has(lists, doc: int) -> bool:
+    for docs in lists:
+        i = bisect_left(docs, doc)
+        if i < len(docs) and docs[i] == doc:
+            return True
+    return False
@@ -1,14 +1,36 @@
-import threading, socket, time, db, os, importlib, signal, sys
-from c16 import ctypes, c16
+import startup
+startup.begin()
+import threading, socket, time, db, os, signal, sys, modloader, channels, users, inbox, compress, frames, outbound, cluster, limits, dedup, checkpoint, registry, retention, blobs
+# c16 (the C encoder) and hashes are heavy and unused at startup, import them where they're needed
+startup.mark("imports")
+def option(flag: str, default=None):
+    # "--flag value" from the command line
+    if flag in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(flag) + 1]
+    return default
 exiting = False
-clients = []
+clients = registry.Registry() # legacy clients, by address
 debug = 0
 server_sockets = []  # Keep track of all server sockets for cleanup
+compression = {} # {client: codec it asked for in its Ping}, deliveries to clients not in here go out plain
+COMPACT_INTERVAL = 60 # seconds between checks for logs with a big enough live part to compress
+SYNC_LIMIT = 1000 # most messages per channel a /sync sends back, a new client doesn't need all of history
+SESSION_TICK = 0.05 # longest a new message waits before going out to session clients
+SESSION_HEARTBEAT = 1 # seconds between pings on the session port
+SESSION_TIMEOUT = 10 # sessions that haven't answered a ping for this long get closed
+SESSION_PORT = int(option("--session-port", frames.SESSION_PORT)) # more than one node on a host needs different ones
+sessions = registry.Registry() # session port clients, by session key "ip:port". Each entry's state is
+# {"sock", "user", "address", "codec", "stream", "lock"} + its outbound queue
+tls = None # ssl context for the session port, with --tls-cert
 
 def signal_handler(sig, frame):
     global exiting, server_sockets
+    if exiting:
+        return # a second ^C while the checkpoint is being written would deadlock on its locks
     print("\n[SERVER]: Shutting down gracefully...")
     exiting = True
+    channels.flush()
+    save_checkpoint()
     # Close all server sockets
     for sock in server_sockets:
         try:
@@ -19,12 +41,22 @@ def signal_handler(sig, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
+if hasattr(signal, "SIGHUP"):
+    # kill -HUP reloads changed mods right away instead of waiting for the watcher
+    signal.signal(signal.SIGHUP, lambda sig, frame: modloader.reload())
+if hasattr(signal, "SIGUSR1"):
+    # kill -USR1 promotes a cluster standby to sequencer
+    signal.signal(signal.SIGUSR1, lambda sig, frame: cluster.promote())
+
 if __name__ == "__main__":
+    def mod_send_message(message: str):
+        # what mods get as send_message(), "#room ..." posts to that channel, anything else to general
+        channel, message = channels.split(fix_string(message))
+        cluster.publish("#" + channel, str(time.time()), "Server", message)
     def load_mods():
-        for file in os.listdir("mods"):
-            if file.endswith(".py") and not file.startswith("__"):
-                module_name = file[:-3]
-                importlib.import_module(f"mods.{module_name}")
+        modloader.send_message = mod_send_message
+        modloader.load("mods")
+        modloader.watch()
     def glue(i: list, s: str = " "):
         o = ""
         for v in i:
@@ -42,6 +74,86 @@ if __name__ == "__main__":
             except KeyError:
                 o += v
         return o
+    def command(client: str, user: str, channel: str, text: str, address: str = None):
+        # chat commands, answered on the same connection and never stored, None if text isn't one
+        # client is who gets subscribed to channels, address is who usernames belong to (the same for old clients)
+        address = address or client
+        name, _, arg = text.partition(" ")
+        if name == "/dictionary":
+            # clients fetch the shared compression dictionary when theirs doesn't match the id in the Pong
+            return compress.encode_dictionary()
+        if name == "/sync":
+            return "\n".join(sync_lines(client, arg))
+        if name == "/lag":
+            return outbound.report(sessions)
+        if name == "/clients":
+            # an empty registry would say "No clients" under the other one's list
+            return "\n".join(connected.report() for connected in (sessions, clients) if len(connected)) or "No clients"
+        if name in ("/upload", "/download"):
+            entry = sessions.get(client)
+            if entry is None:
+                return "Attachments need the session port"
+            digest, _, number = arg.strip().partition(" ")
+            if not number.isdigit():
+                return f"Usage: {name} sha256 {'size' if name == '/upload' else 'offset'}"
+            if name == "/upload":
+                return blobs.begin(digest, int(number))
+            size = blobs.size_of(digest)
+            if size is None:
+                return f"No attachment {digest}"
+            # queued ahead of this reply, the client is ready for it before asking
+            outbound.put_file(entry.state, frames.FILE, digest, blobs.path_of(digest), int(number), size)
+            return str(size)
+        if name == "/retention":
+            return retention.report()
+        if name == "/nodes":
+            return cluster.report()
+        if name == "/limits":
+            return limits.report() + "\n" + dedup.report()
+        if name == "/register":
+            return users.register(address, arg.strip()) or f"Registered @{arg.strip()}"
+        if name in ("/dm", "/inbox", "/unread") and users.address_of(user) != address:
+            return f"Register first with /register {user}"
+        if name == "/dm":
+            recipient, _, message = arg.partition(" ")
+            recipient = recipient.removeprefix("@")
+            if users.NAME.fullmatch(recipient) is None:
+                return f"No user @{recipient}"
+            # in a cluster, users are registered on the node they connect to, so other nodes' users aren't known here
+            if users.address_of(recipient) is None and cluster.role is None:
+                return f"No user @{recipient}"
+            if not message:
+                return "Usage: /dm @user message"
+            if cluster.publish("@" + recipient, str(time.time()), user, message.replace(";", " ")) is False:
+                return "Server busy, try again"
+            return f"Sent to @{recipient}"
+        if name == "/inbox":
+            count = int(arg) if arg.strip().isdigit() else 20
+            lines = inbox.recent(user, count)
+            inbox.mark_read(user)
+            cluster.read(user)
+            return "\n".join("@dm;" + line for line in lines) or "No direct messages"
+        if name == "/unread":
+            return f"{inbox.unread_count(user)} unread"
+        if name == "/search":
+            if not os.path.exists(channels.log_path(channel)):
+                return "No results"
+            return "\n".join(channels.index(channel).search(arg)) or "No results"
+        if name in ("/join", "/leave"):
+            target, rest = channels.split(arg.strip())
+            if rest or not arg.strip().startswith("#"):
+                return f"Usage: {name} #channel"
+            if name == "/join":
+                channels.subscribe(client, target)
+                return f"Joined #{target}"
+            if target == channels.DEFAULT:
+                return f"Can't leave #{channels.DEFAULT}"
+            channels.unsubscribe(client, target)
+            return f"Left #{target}"
+        if name == "/channels":
+            mine = channels.subscriptions.get(client, set())
+            return "\n".join(f"#{c}{' (joined)' if c in mine else ''}" for c in channels.known())
+        return None
     def listen_messages(client):
         PORT = 9980
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
@@ -49,27 +161,378 @@ if __name__ == "__main__":
         server_socket.bind((client, PORT))
         server_socket.listen(3) # we listen and we judge
         print(f"[SERVER]: Listening for messages on {client}:{PORT}")
+        host = client
         while not exiting:
             client, addr = server_socket.accept() # yayyyyyyyyyyyyyy
             data = client.recv(1024)
+            entry = clients.get(host)
+            if entry is not None:
+                entry.received += 1
+            if not limits.allow(host, host):
+                client.sendall(b"Slow down")
+                client.close()
+                continue
             data = fix_string(data.decode()).split(";")
-            if db.validate_message(f"0;0;{glue(data, ';')}"):
-                db.add_message(str(time.time()), data[0], glue(data[1:]))
-                print(f"[SERVER]: Received message from {addr}: {data}")
+            if glue(data[1:], ";").partition(" ")[0] == "/sync":
+                # can be long, so it goes out compressed like a delivery
+                send_payload(client, host, "\n".join(sync_lines(host, glue(data[1:], ";")[6:])).encode())
+                client.close()
+                continue
+            reply = handle(host, data[0], glue(data[1:], ";"))
+            if reply is not None:
+                client.sendall(reply.encode())
+                client.close()
+                continue
             client.send(b"Thx")
-    def get_new_chats(timed):
-        messages = ""
-        f = open("database.db", "r")
-        for i in f.readlines():
-            if db.fetch_time(i) >= timed:
-                messages += i + "\n"
-        return messages
-    def send_messages(client, timed):
+            client.close()
+    def submit(client: str, user: str, text: str, address: str = None, done=None) -> tuple:
+        # one message from a client, already escaped with fix_string -> (status, reply). The status is "command"
+        # for a command, with its reply, "invalid" for a message that wasn't valid, "busy" for one a cluster
+        # member couldn't queue for the sequencer, and "posted" for one that was. done is cluster.publish()'s,
+        # it's only called for "posted"
+        # "#room message" goes to that channel, everything else to general
+        channel, text = channels.split(text)
+        if text.startswith("/"):
+            reply = command(client, user, channel, text, address)
+            if reply is not None:
+                return "command", reply
+        text = text.replace(";", " ")
+        if not db.validate_message(f"0;0;{user};{text}"):
+            return "invalid", "Not a valid message"
+        timed = time.time()
+        channels.subscribe(client, channel) # posting to a channel joins it
+        if cluster.publish("#" + channel, str(timed), user, text, done=done) is False:
+            return "busy", "Server busy, try again"
+        print(f"[SERVER]: Received message from {client} in #{channel}: {text}")
+        modloader.fire("message_got", text, user, timed)
+        return "posted", None
+    def handle(client: str, user: str, text: str, address: str = None):
+        # submit() for callers that only want the reply: commands get theirs, anything else is posted and gets
+        # None, or why it wasn't
+        return submit(client, user, text, address)[1]
+    def send_payload(sock, client, payload: bytes):
+        # compressed if the client asked for it in its Ping
+        codec = compression.get(client)
+        if codec is None:
+            sock.sendall(payload)
+            return
+        for chunk in compress.chunks(codec, payload):
+            sock.sendall(chunk)
+    def sync_lines(client, arg: str) -> list:
+        # "<newest id the client has> #channel ...", joins the channels and returns what the client missed
+        # up to where its deliveries pick up, so nothing comes twice
+        words = arg.split()
+        newest = int(words[0]) if words and words[0].isdigit() else 0
+        wanted = {channels.DEFAULT} | {channels.split(w)[0] for w in words[1:] if w.startswith("#")}
+        wanted |= set(channels.subscriptions.get(client, ())) # with no channels listed, the ones it's in
+        lines = []
+        for channel in sorted(wanted):
+            channels.subscribe(client, channel)
+            end = channels.cursors.get((client, channel))
+            if not end:
+                continue
+            found = channels.index(channel)
+            with found.lock: # retention renumbers docs when it trims the index
+                count = len(found.offsets)
+                doc = max(found.first_after(newest), count - SYNC_LIMIT)
+                start = found.offsets[doc] if doc < count else end
+            if start >= end:
+                continue
+            with db.open_log(channels.log_path(channel)) as f:
+                data = f.read(max(0, end - f.seek(start))).decode() # seek() skips what retention dropped
+            prefix = "" if channel == channels.DEFAULT else f"#{channel};"
+            lines += [prefix + line for line in data.split("\n") if line]
+        return lines
+    def collect(client, names):
+        # everything new for a client in its channels and its users' inboxes -> (lines, channel cursors, inbox positions)
+        lines, moved = channels.fetch(client)
+        dms = {}
+        seen = set() # a DM between two users on the same address is in both their inboxes
+        for user in names:
+            dm_lines, position = inbox.fetch(user)
+            if dm_lines:
+                dms[user] = position
+                lines += ["@dm;" + line for line in dm_lines if line not in seen]
+                seen.update(dm_lines)
+        return lines, moved, dms
+    def collected(client, moved, dms):
+        # the lines from collect() went out
+        channels.delivered(client, moved)
+        for user, position in dms.items():
+            inbox.delivered(user, position)
+            cluster.read(user)
+    def send_messages(client):
+        # sends the client everything new in its channels and its users' inboxes since the last delivery
         PORT = 6090
-        chats = get_new_chats(timed)
-        message_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-        message_socket.connect((client, PORT))
-        message_socket.sendall(chats.encode())
+        lines, moved, dms = collect(client, users.names_at(client))
+        if not lines:
+            channels.delivered(client, moved)
+            return
+        try:
+            message_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+            message_socket.settimeout(5)
+            message_socket.connect((client, PORT))
+            send_payload(message_socket, client, "\n".join(lines).encode())
+            message_socket.close()
+        except OSError as e:
+            print(f"[SERVER]: Delivery to {client} failed: {e}")
+            channels.retry(client, moved)
+            return
+        entry = clients.get(client)
+        if entry is not None:
+            entry.sent += len(lines)
+            entry.cursor = max(entry.cursor, outbound.newest(lines))
+        collected(client, moved, dms)
+    def tls_context():
+        # --tls-cert file [--tls-key file] puts the session port behind TLS. Clients get a session ticket after
+        # their handshake, and reconnecting with it skips the certificate and key exchange. Tickets are
+        # encrypted with a key that lives as long as this process
+        import ssl # only needed with TLS
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(option("--tls-cert"), option("--tls-key"))
+        context.num_tickets = 1
+        return context
+    def session(conn, addr):
+        # one client on the session port: everything it does comes in on this connection and everything
+        # it gets goes out on it, no ports on the client side
+        key = f"{addr[0]}:{addr[1]}"
+        conn.settimeout(limits.HANDSHAKE_TIMEOUT)
+        # frames are small and go out as soon as they're queued, without this the welcome can wait 40ms behind
+        # the session ticket for a delayed ack
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            if tls is not None:
+                # the TLS handshake is the expensive part of connecting, it happens here inside the handshake slot
+                conn = tls.wrap_socket(conn, server_side=True)
+            first = frames.read(conn)
+        except (OSError, ValueError):
+            first = None
+        finally:
+            limits.handshaken()
+        if first is None or first[0] != frames.HELLO or first[1].count(b";") < 4:
+            conn.close()
+            return
+        conn.settimeout(None)
+        if tls is not None:
+            # from here on the session's reader and writer threads share the connection
+            import tlsconn # only needed with TLS
+            conn = tlsconn.Locked(conn)
+        user, codecs, dict_id, newest, wanted = first[1].decode().split(";", 4)
+        # the name is this connection's to go by, it's only written to usernames.db by /register
+        error = users.check(addr[0], user)
+        codec = compress.negotiate(codecs.split(",")) if not error else None
+        state = {"sock": conn, "user": user, "address": addr[0], "codec": codec, "lock": threading.Lock(),
+                 "stream": compress.compressor(codec) if codec else None,
+                 "pending": set()} # ids of SENDs taken in but not stored yet, acked once they are
+        welcome = f"{codec or ''};{compress.dict_id:08x};{error}".encode()
+        if codec is not None and dict_id != f"{compress.dict_id:08x}":
+            welcome += b"\n" + compress.dictionary
+        try:
+            if error:
+                conn.sendall(frames.pack(frames.WELCOME, welcome))
+                return
+            # from here on everything is sent by the session's writer thread, see outbound.py
+            outbound.attach(state)
+            outbound.put(state, frames.WELCOME, welcome)
+            print(f"[SERVER]: Session {key} started for @{user}" +
+                  (f" over {conn.version()}{', resumed' if conn.session_reused else ''}" if tls is not None else ""))
+            modloader.fire("client_connected", user, addr[0])
+            lines = sync_lines(key, f"{newest} {wanted}")
+            entry = sessions.add(registry.Entry(key, addr[0], user, conn, state, int(newest or 0)))
+            if lines:
+                outbound.put(state, frames.DELIVERY, "\n".join(lines).encode(), lines)
+                entry.sent += len(lines)
+                entry.cursor = max(entry.cursor, outbound.newest(lines))
+            while not exiting:
+                got = frames.read(conn)
+                if got is None:
+                    break
+                kind, payload = got
+                if kind in (frames.MESSAGE, frames.SEND, frames.COMMAND):
+                    entry.received += 1
+                if kind in (frames.MESSAGE, frames.SEND, frames.COMMAND) and not limits.allow(key, addr[0]):
+                    # over a limit: dropped before it's decoded, commands still get a reply so nothing waits on it
+                    # and SENDs get no ack, so the client sends them again later
+                    if kind == frames.COMMAND:
+                        outbound.put(state, frames.REPLY, payload.partition(b";")[0] + b";Slow down")
+                    continue
+                if kind == frames.MESSAGE:
+                    handle(key, user, fix_string(payload.decode()), addr[0])
+                elif kind == frames.SEND:
+                    message_id, _, text = payload.decode().partition(";")
+                    claim = dedup.claim(user, message_id)
+                    if claim == "in flight":
+                        # the first try isn't published yet (a reconnect while the old session is still on it), no
+                        # ack until it is, the client sends it again
+                        continue
+                    if claim == "seen":
+                        # stored already, acked again
+                        outbound.put(state, frames.ACKED, message_id.encode())
+                        continue
+                    def stored(i, message_id=message_id):
+                        # the message is stored here (on a cluster member once the sequencer's numbered copy is
+                        # written, committed with sync commits), or never will be when i is None
+                        state["pending"].discard(message_id)
+                        if i is None:
+                            dedup.forget(user, message_id)
+                            return
+                        dedup.done(user, message_id)
+                        outbound.put(state, frames.ACKED, message_id.encode())
+                    state["pending"].add(message_id)
+                    try:
+                        status, _ = submit(key, user, fix_string(text), addr[0], stored)
+                    except BaseException:
+                        if message_id in state["pending"]:
+                            stored(None)
+                        raise
+                    if status == "command":
+                        stored(0)
+                    elif status != "posted":
+                        # never stored, so no ack, and a resend isn't a duplicate
+                        stored(None)
+                elif kind == frames.COMMAND:
+                    number, _, text = payload.decode().partition(";")
+                    reply = handle(key, user, fix_string(text), addr[0])
+                    outbound.put(state, frames.REPLY, f"{number};{reply or ''}".encode())
+                elif kind == frames.UPLOAD:
+                    digest, offset, data = payload.split(b";", 2)
+                    blobs.append(digest.decode(), int(offset), data)
+                elif kind == frames.PONG:
+                    entry.seen = time.time()
+                    modloader.fire("successful_heartbeat", float(payload), addr[0])
+        except (OSError, ValueError) as e:
+            print(f"[SERVER]: Session {key} failed: {e}")
+        finally:
+            sessions.remove(key)
+            channels.drop(key)
+            limits.forget(key)
+            if "queue" in state:
+                outbound.close(state)
+            conn.close()
+            # their acks go nowhere, a resend from the next session is acked once they're stored
+            waiting = f", {len(state['pending'])} messages still being stored" if state.get("pending") else ""
+            print(f"[SERVER]: Session {key} ended{waiting}")
+    def run_sessions():
+        # one thread pings every session and sends each one what's new for it, woken up by new messages
+        last_ping = 0
+        while not exiting:
+            channels.wake.wait(SESSION_TICK)
+            channels.wake.clear()
+            now = time.time()
+            ping = now - last_ping >= SESSION_HEARTBEAT
+            if ping:
+                last_ping = now
+            for entry in sessions.snapshot():
+                key, state = entry.key, entry.state
+                if ping:
+                    stalled = outbound.stalled(state)
+                    if now - entry.seen > SESSION_TIMEOUT or stalled:
+                        # closing the socket ends the session's own thread, which cleans up after it
+                        reason = f"{outbound.behind(state):.1f}s behind" if stalled else f"no pong for {now - entry.seen:.1f}s"
+                        print(f"[SERVER]: Dropping session {key} @{state['user']}, {reason}")
+                        outbound.close(state)
+                        continue
+                    outbound.put(state, frames.PING, b"")
+                if key in channels.pending or inbox.has_new(state["user"]):
+                    # queueing never blocks, a slow client only fills up its own queue
+                    lines, moved, dms = collect(key, [state["user"]])
+                    if lines:
+                        outbound.put(state, frames.DELIVERY, "\n".join(lines).encode(), lines)
+                        entry.sent += len(lines)
+                        entry.cursor = max(entry.cursor, outbound.newest(lines))
+                    collected(key, moved, dms)
+    def serve_sessions():
+        HOST = "127.0.0.1"
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((HOST, SESSION_PORT))
+        server_socket.listen(limits.ACCEPT_BACKLOG) # load tests and bots connect in the thousands at once
+        server_sockets.append(server_socket)
+        print(f"[SERVER]: Sessions on {HOST}:{SESSION_PORT}{' with TLS' if tls is not None else ''}")
+        threading.Thread(target=run_sessions, daemon=True).start()
+        while not exiting:
+            conn, addr = server_socket.accept()
+            reason = limits.admit(addr[0])
+            if reason:
+                # turned away before a thread is started for it
+                try:
+                    conn.sendall(frames.pack(frames.WELCOME, f";{compress.dict_id:08x};{reason}".encode()))
+                except OSError:
+                    pass
+                conn.close()
+                continue
+            threading.Thread(target=session, args=(conn, addr), daemon=True).start()
+    def disconnect(client):
+        # the heartbeat can fail in more than one way at once, removing a client that's gone already is fine
+        clients.remove(client)
+        channels.drop(client)
+        compression.pop(client, None)
+    def compact_logs():
+        # logs whose live file got big have their older part compressed into blocks, see db.py
+        while not exiting:
+            time.sleep(COMPACT_INTERVAL)
+            paths = [channels.log_path(c) for c in channels.known()] + [inbox.DM_LOG, cluster.STREAM_LOG]
+            for path in paths:
+                try:
+                    if os.path.getsize(path) > db.COLD_AFTER:
+                        print(f"[SERVER]: Compressed {db.compress_cold(path)} bytes of {path}")
+                except OSError as e:
+                    if not isinstance(e, FileNotFoundError):
+                        print(f"[SERVER]: Compressing {path} failed: {e}")
+            blobs.prune()
+            # then retention, in the same thread since both change cold blocks
+            for channel in channels.known():
+                path = channels.log_path(channel)
+                try:
+                    done = retention.enforce(channel, path)
+                    if done:
+                        trimmed = channels.index(channel).trim(db.first_offset(path))
+                        print(f"[RETENTION]: #{channel}: {done}, {trimmed} messages left the search index")
+                except OSError as e:
+                    print(f"[RETENTION]: #{channel} failed: {e}")
+    def logs() -> list:
+        return [channels.log_path(c) for c in channels.known()] + [inbox.DM_LOG]
+    def recover():
+        # a crash can leave half a record at the end of a log, that goes first. Then the id counter, the stream
+        # index and inbox read positions come from the last checkpoint, and only what the logs gained since is
+        # read. The newest id in each log is read from its end
+        saved = checkpoint.load()
+        paths = logs() + ([cluster.STREAM_LOG] if cluster.role else [])
+        for path in paths:
+            checkpoint.repair(path)
+        start = checkpoint.start_of(inbox.DM_LOG, saved)
+        if start is not None: # without a checkpoint the .read files are as new as the DMs
+            for offset, line in checkpoint.replay(inbox.DM_LOG, start):
+                inbox.recover(offset, line)
+        newest = {path: db.last_id(path) for path in logs()}
+        cluster.load(saved, newest)
+        dedup.load(saved.get("message ids", {}))
+        db.id = max([db.id, saved.get("id", 0), cluster.applied] + list(newest.values()))
+        print(f"[CHECKPOINT]: Recovered to id {db.id}" + ("" if saved else ", no checkpoint yet"))
+    def save_checkpoint():
+        # everything a checkpoint covers is taken under the same locks, so it all describes one moment
+        with cluster.lock, inbox.lock, db.lock:
+            paths = logs() + ([cluster.STREAM_LOG] if cluster.role else [])
+            state = {"id": db.id, "logs": {path: checkpoint.mark(path) for path in paths}, "stream ids": cluster.save(),
+                     "message ids": dedup.save()}
+            inbox.save()
+        checkpoint.save(state)
+    def checkpoints():
+        while not exiting:
+            time.sleep(checkpoint.INTERVAL)
+            try:
+                save_checkpoint()
+            except OSError as e:
+                print(f"[CHECKPOINT]: Failed: {e}")
+    def load_dictionary():
+        if compress.load_dictionary():
+            return
+        # first start, or nobody trained one yet: learn it from the recent end of the logs
+        data = compress.train_from([channels.log_path(c) for c in channels.known()] + [inbox.DM_LOG])
+        if data:
+            compress.save_dictionary(data)
+            print(f"[SERVER]: Trained a {len(data)} byte compression dictionary")
     def authentication(client: str):
         PORT = 12090
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
@@ -93,33 +556,70 @@ if __name__ == "__main__":
             server_sockets.extend([server_socket, authentication_socket])
             print("[SERVER]: Started authentication socket")
             print(f"[SERVER]: Listening on {HOST}:{PORT}")
+            startup.mark("listening")
+            startup.report()
             while not exiting:
                 # Accept main client connection
                 client, addr = server_socket.accept()
+                if limits.admit(addr[0]):
+                    # turned away before any thread starts. The client still connects for auth, so that
+                    # connection is taken and closed too, or the next client would get this one's
+                    client.close()
+                    authentication_socket.settimeout(limits.HANDSHAKE_TIMEOUT)
+                    try:
+                        authentication_socket.accept()[0].close()
+                    except OSError:
+                        pass
+                    authentication_socket.settimeout(None)
+                    continue
                 print(f"[SERVER]: Client connected from {addr}")
-                
-                # Receive ping from client
-                ping_data = client.recv(1024)
-                print(f"[SERVER]: Received: {ping_data}")
-                
-                # Accept authentication connection
-                auth_client, auth_addr = authentication_socket.accept()
-                print(f"[SERVER]: Auth client connected from {auth_addr}")
-                
-                # Receive auth request
-                auth_data = auth_client.recv(1024)
-                print(f"[SERVER]: Received auth: {auth_data}")
-                
-                timed = time.time()
-                
-                # Send responses
-                client.send(b"Pong")
-                auth_client.send(b"Auth1")
-                
-                # Add client to list
-                global clients
-                clients.append(addr[0])
+                auth_client = None
+                try:
+                    # Receive ping from client
+                    ping_data = client.recv(1024)
+                    print(f"[SERVER]: Received: {ping_data}")
+                    
+                    # Accept authentication connection
+                    auth_client, auth_addr = authentication_socket.accept()
+                    print(f"[SERVER]: Auth client connected from {auth_addr}")
+                    
+                    # Receive auth request
+                    auth_data = auth_client.recv(1024)
+                    print(f"[SERVER]: Received auth: {auth_data}")
+                    
+                    timed = time.time()
+                    
+                    # "Ping zstd,zlib" asks for compressed deliveries, a plain "Ping" gets plain ones like before
+                    codec = compress.negotiate(ping_data.decode(errors="replace")[5:].split(","))
+                    if codec is None:
+                        compression.pop(addr[0], None)
+                        client.send(b"Pong")
+                    else:
+                        compression[addr[0]] = codec
+                        client.send(f"Pong {codec} {compress.dict_id:08x}".encode())
+                    auth_client.send(b"Auth1")
+                except OSError as e:
+                    # the client went away mid-handshake, which is no reason to stop accepting the rest
+                    print(f"[SERVER]: Handshake with {addr} failed: {e}")
+                    client.close()
+                    if auth_client is not None:
+                        auth_client.close()
+                    continue
+                finally:
+                    # the slot admit() took, whatever happened to the handshake
+                    limits.handshaken()
+                # Add client to the registry
+                if addr[0] in clients:
+                    # already connected, its threads are still running, so this is only a fresh auth
+                    client.close()
+                    auth_client.close()
+                    threading.Thread(target=authentication, args=(addr[0],)).start()
+                    continue
+                clients.add(registry.Entry(addr[0], addr[0]))
+                channels.subscribe(addr[0], channels.DEFAULT)
                 print(f"[SERVER]: New client authenticated: {addr}")
+                # no usernames at login yet, so mods get the address for both
+                modloader.fire("client_connected", addr[0], addr[0])
                 
                 # Complete authentication by connecting back to client
                 threading.Thread(target=authentication, args=(addr[0],)).start()
@@ -140,12 +640,11 @@ if __name__ == "__main__":
                 PORT = 8070
                 heartbeat_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
                 heartbeat_socket.settimeout(5)
-                global clients
                 try:
                     heartbeat_socket.connect((client, PORT))
                 except ConnectionRefusedError:
                     print(client)
-                    clients.remove(client)
+                    disconnect(client)
                     print("Connection Refused1")
                     
                     return
@@ -162,30 +661,63 @@ if __name__ == "__main__":
                         data = float(heartbeat_socket.recv(1024).decode())
                     except:
                         continue
+                    entry = clients.get(client)
+                    if entry is not None:
+                        entry.seen = time.time()
+                    modloader.fire("successful_heartbeat", data, client)
                 except TimeoutError:
                     print("Connection Timed Out")
-                    clients.remove(client)
+                    disconnect(client)
                     
                     return
                 except BrokenPipeError:
                     print("Pipe Broke")
-                    clients.remove(client)
+                    disconnect(client)
                     return
                 except TypeError:
                     print("Faulty Client, Float not recieved")
-                    clients.remove(client)
+                    disconnect(client)
                     return
                 except ConnectionResetError:
                     print("Faulty Client, Killed Connection")
-                    clients.remove(client)
+                    disconnect(client)
                     return
-                threading.Thread(target=send_messages, args=(client, data))
                 heartbeat_socket.close()
-    thread = threading.Thread(target=acception)
-    thread.start()
+                # the heartbeat thread does the delivery itself, so one client never has two in flight
+                if client in channels.pending or any(inbox.has_new(user) for user in users.names_at(client)):
+                    send_messages(client)
+    users.load()
+    if option("--tls-cert"):
+        tls = tls_context()
+    limits.configure(option("--client-rate"), option("--ip-rate"), option("--global-rate"), option("--connect-rate"),
+                     option("--max-handshakes"))
+    retention.configure(option("--retain-days"), option("--retain-messages"), option("--retain-mb"), option("--archive-days"))
+    cluster.configure(option("--node"), option("--sequencer-port"), option("--join"), option("--standby"),
+                      option("--commit", "async"), option("--sync-replicas", 1), option("--failover"))
+    # ids carry on from the newest message in any log instead of starting over, clients sync by id
+    recover()
+    startup.mark("recovery")
+    channels.index(channels.DEFAULT)
+    startup.mark("search index")
+    load_dictionary()
+    load_mods()
+    startup.mark("mods")
+    threading.Thread(target=compact_logs, daemon=True).start()
+    threading.Thread(target=checkpoints, daemon=True).start()
+    threading.Thread(target=serve_sessions, daemon=True).start()
+    cluster.start(int(option("--sequencer-port", 0)), lambda: len(sessions))
+    if cluster.role is None:
+        thread = threading.Thread(target=acception)
+        thread.start()
+    else:
+        # the old protocol's ports are fixed, so cluster nodes only take session clients
+        print("[SERVER]: Cluster mode, legacy ports are off")
+        startup.report()
     while True:
         time.sleep(0.2)
         threads = []
         if debug == 1:
-            print(clients)
+            print(sessions.report())
+            print(clients.report())
+            print(modloader.report())
             
@@ -0,0 +1,41 @@
+import time, sys
+# Startup timing for server.py --profile-startup, import this before anything else
+started = time.perf_counter()
+enabled = "--profile-startup" in sys.argv
+phases = [] # (phase name, seconds since start)
+imports = [] # (module, seconds including its own imports, nesting depth) in the order they finished
+_depth = 0
+
+def begin():
+    # wraps __import__ so every module imported from here on gets timed
+    if not enabled:
+        return
+    import builtins
+    real_import = builtins.__import__
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        global _depth
+        if level == 0 and name in sys.modules:
+            return real_import(name, globals, locals, fromlist, level)
+        _depth += 1
+        start = time.perf_counter()
+        try:
+            return real_import(name, globals, locals, fromlist, level)
+        finally:
+            _depth -= 1
+            imports.append(("." * level + (name or "".join(fromlist or ())), time.perf_counter() - start, _depth))
+    builtins.__import__ = timed_import
+def mark(phase: str):
+    if enabled:
+        phases.append((phase, time.perf_counter() - started))
+def report():
+    if not enabled:
+        return
+    print("[STARTUP]: Imports (ms, including nested imports):")
+    for name, seconds, depth in imports:
+        if seconds >= 0.0005:
+            print(f"[STARTUP]:   {'  ' * depth}{name}: {seconds * 1000:.1f}")
+    last = 0.0
+    for phase, at in phases:
+        print(f"[STARTUP]: {phase}: +{(at - last) * 1000:.1f}ms (at {at * 1000:.1f}ms)")
+        last = at
+    print(f"[STARTUP]: Cold start to accepting connections: {last * 1000:.1f}ms")
@@ -0,0 +1,65 @@
+import select, socket, ssl, threading
+# A TLS session's socket. A session has a reader thread and a writer thread (see outbound.py), and an SSLSocket
+# can't be used from two threads at once: reads and writes both go through the connection's one OpenSSL state,
+# and a read can have to send (alerts, key updates) as much as a write can have to receive. Locked runs the
+# socket non-blocking and makes every call into OpenSSL under a lock, and waits for the socket to be ready
+# outside it, so a reader blocked waiting for the client never holds up the writer.
+# Only the server needs this, the client does all its I/O on its event loop.
+
+def _wait(sock, write: bool):
+    # poll() where there is one, select() can't watch descriptors past FD_SETSIZE and there are thousands of sessions
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT if write else select.POLLIN)
+        poller.poll()
+    else:
+        select.select([] if write else [sock], [sock] if write else [], [])
+class Locked:
+    def __init__(self, sock: ssl.SSLSocket):
+        self.sock = sock
+        self.lock = threading.Lock()
+        sock.setblocking(False)
+    def recv_into(self, buffer) -> int:
+        while True:
+            with self.lock:
+                try:
+                    return self.sock.recv_into(buffer)
+                except ssl.SSLWantReadError:
+                    write = False
+                except ssl.SSLWantWriteError:
+                    write = True
+            _wait(self.sock, write)
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            with self.lock:
+                try:
+                    # all of it or nothing, OpenSSL takes the same bytes again after a want-write
+                    view = view[self.sock.send(view):]
+                    continue
+                except ssl.SSLWantWriteError:
+                    write = True
+                except ssl.SSLWantReadError:
+                    write = False
+            _wait(self.sock, write)
+    def sendfile(self, file, offset: int = 0, count: int = None) -> int:
+        # the bytes have to be encrypted here anyway, so this is what SSLSocket.sendfile would do
+        file.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            chunk = file.read(65536 if count is None else min(65536, count - sent))
+            if not chunk:
+                break
+            self.sendall(chunk)
+            sent += len(chunk)
+        return sent
+    def shutdown(self, how: int):
+        # of the TCP connection underneath, which wakes up both threads whatever they're waiting for
+        # (SSLSocket.shutdown would also take the TLS state away from under them)
+        socket.socket.shutdown(self.sock, how)
+    def close(self):
+        with self.lock:
+            self.sock.close()
+    def __getattr__(self, name: str):
+        # version(), session_reused and the rest, which don't read or write
+        return getattr(self.sock, name)
@@ -0,0 +1,48 @@
+import re, threading
+# The user store, usernames.db with one "IP;username;password hash" line per user (see todo/usernames.md)
+# There are no passwords yet, so the hash is left empty. A name belongs to the address that registered it.
+USER_FILE = "usernames.db"
+NAME = re.compile(r"[\w-]{1,32}")
+lock = threading.Lock()
+by_name = {} # {username: address}
+by_address = {} # {address: set of usernames}
+
+def load(path: str = USER_FILE):
+    global USER_FILE
+    USER_FILE = path
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.count(";") >= 2:
+                    address, name, _ = line.rstrip("\n").split(";", 2)
+                    by_name[name] = address
+                    by_address.setdefault(address, set()).add(name)
+    except FileNotFoundError:
+        pass
+    print(f"[USERS]: {len(by_name)} registered user(s)")
+def register(address: str, name: str) -> str:
+    # returns an error message, or "" if name is now (or already was) address's
+    if NAME.fullmatch(name) is None:
+        return "Usernames are 1-32 letters, digits, _ or -"
+    with lock:
+        owner = by_name.get(name)
+        if owner == address:
+            return ""
+        if owner is not None:
+            return f"@{name} is taken"
+        with open(USER_FILE, "a") as f:
+            f.write(f"{address};{name};\n")
+        by_name[name] = address
+        by_address.setdefault(address, set()).add(name)
+    return ""
+def check(address: str, name: str) -> str:
+    # whether a connection can go by name without registering it: any name that's valid and not someone else's.
+    # Returns an error message, or ""
+    if NAME.fullmatch(name) is None:
+        return "Usernames are 1-32 letters, digits, _ or -"
+    owner = by_name.get(name)
+    return f"@{name} is taken" if owner is not None and owner != address else ""
+def address_of(name: str):
+    return by_name.get(name)
+def names_at(address: str) -> set:
+    return set(by_address.get(address, ()))
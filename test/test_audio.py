@@ -0,0 +1,70 @@
+import os, sys, threading, time, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "voice-chat-test"))
+import numpy as np
+import audio
+
+BLOCK = 64
+RATE = 48000
+
+def run(engine, blocks: int):
+    # lets the fake sound card call back at least blocks times, as fast as it can
+    engine.start()
+    deadline = time.monotonic() + 5
+    while engine.blocks < blocks and time.monotonic() < deadline:
+        time.sleep(0.001)
+    engine.stop()
+def new_engine(capture_size: int, playback_size: int, prefill: int = 0):
+    return audio.AudioEngine(audio.SharedBuf(capture_size), audio.SharedBuf(playback_size), threading.Condition(),
+                             threading.Condition(), RATE, BLOCK, prefill, backend="fake", realtime=False, keep=True)
+
+class SharedBuf(unittest.TestCase):
+    def test_wraps_around(self):
+        buf = audio.SharedBuf(10)
+        buf.extbuf(np.arange(7, dtype=np.float32))
+        np.testing.assert_array_equal(buf.getx(5), np.arange(5))
+        buf.extbuf(np.arange(7, 13, dtype=np.float32))
+        self.assertEqual(buf.getlen(), 8)
+        self.assertEqual(buf.getfree(), 1)
+        out = np.zeros(8, dtype=np.float32)
+        buf.readinto(out)
+        np.testing.assert_array_equal(out, np.arange(5, 13))
+        self.assertEqual(buf.getlen(), 0)
+
+class Engine(unittest.TestCase):
+    def test_capture_round_trip(self):
+        engine = new_engine(BLOCK * 16 + 1, BLOCK * 4)
+        run(engine, 8)
+        # the callback only writes whole blocks, so what's captured is the fake mic's tone from the start
+        captured = engine.capture_buf.getx(engine.capture_buf.getlen())
+        step = 2 * np.pi * 440.0 / RATE
+        expected = 0.2 * np.sin(step * np.arange(len(captured)))
+        self.assertGreaterEqual(len(captured), BLOCK * 8)
+        np.testing.assert_allclose(captured, expected, atol=1e-4)
+    def test_overruns_when_nobody_sends(self):
+        engine = new_engine(BLOCK * 4 + 1, BLOCK * 4)
+        run(engine, 20)
+        # four blocks fit, every block after that is dropped whole and counted
+        self.assertEqual(engine.capture_buf.getlen(), BLOCK * 4)
+        self.assertEqual(engine.overruns, engine.blocks - 4)
+        self.assertEqual(engine.underruns, 0)
+    def test_playback_round_trip_then_underrun(self):
+        engine = new_engine(BLOCK * 64 + 1, BLOCK * 16 + 1, prefill=BLOCK * 4)
+        ramp = np.linspace(-1, 1, BLOCK * 6, dtype=np.float32)
+        engine.playback_buf.extbuf(ramp)
+        run(engine, 10)
+        played = np.concatenate(engine.stream.played)
+        # what was buffered comes out in order, then silence once it runs dry, which counts as one underrun
+        np.testing.assert_array_equal(played[:len(ramp)], ramp)
+        self.assertFalse(played[len(ramp):].any())
+        self.assertEqual(engine.underruns, 1)
+    def test_prefill_holds_playback_back(self):
+        engine = new_engine(BLOCK * 64 + 1, BLOCK * 16 + 1, prefill=BLOCK * 4)
+        engine.playback_buf.extbuf(np.ones(BLOCK * 3, dtype=np.float32))
+        run(engine, 5)
+        # never reached the prefill, so nothing played and nothing underran
+        self.assertFalse(np.concatenate(engine.stream.played).any())
+        self.assertEqual(engine.playback_buf.getlen(), BLOCK * 3)
+        self.assertEqual(engine.underruns, 0)
+
+if __name__ == "__main__":
+    unittest.main()
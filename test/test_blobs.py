@@ -0,0 +1,87 @@
+import hashlib, os, sys, tempfile, time, unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "Server"))
+import blobs
+
+DATA = bytes(range(256)) * 40
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+class Blobs(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(folder.name)
+        patch = mock.patch("builtins.print")
+        patch.start()
+        self.addCleanup(patch.stop)
+        blobs.uploads.clear()
+        blobs._locks.clear()
+    def restart(self):
+        # what's in memory goes, blobs/ stays
+        blobs.uploads.clear()
+        blobs._locks.clear()
+    def test_begin_checks(self):
+        self.assertTrue(blobs.begin(DIGEST.upper(), len(DATA)).startswith("Bad hash"))
+        self.assertTrue(blobs.begin(DIGEST, 0).startswith("Attachments are"))
+        self.assertTrue(blobs.begin(DIGEST, blobs.MAX_SIZE + 1).startswith("Attachments are"))
+        self.assertIsNone(blobs.size_of("../" + DIGEST))
+    def test_whole_upload(self):
+        self.assertEqual(blobs.begin(DIGEST, len(DATA)), "0")
+        blobs.append(DIGEST, 0, DATA)
+        self.assertEqual(blobs.size_of(DIGEST), len(DATA))
+        with open(blobs.path_of(DIGEST), "rb") as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertEqual((blobs.uploads, blobs._locks), ({}, {}))
+        # sent again, it's already all here
+        self.assertEqual(blobs.begin(DIGEST, len(DATA)), str(len(DATA)))
+    def test_resume(self):
+        blobs.begin(DIGEST, len(DATA))
+        blobs.append(DIGEST, 0, DATA[:4000])
+        blobs.append(DIGEST, 0, DATA[:4000]) # a resend, not where the upload is
+        blobs.append(DIGEST, 5000, DATA[5000:6000]) # past it
+        self.assertEqual(blobs.begin(DIGEST, len(DATA)), "4000")
+        blobs.append(DIGEST, 4000, DATA[4000:7000])
+        self.restart()
+        # the hash catches up with what's on disk, so the rest still checks out
+        self.assertEqual(blobs.begin(DIGEST, len(DATA)), "7000")
+        blobs.append(DIGEST, 7000, DATA[7000:])
+        self.assertEqual(blobs.size_of(DIGEST), len(DATA))
+        self.assertFalse(os.path.exists(blobs._partial(DIGEST)))
+    def test_append_without_begin(self):
+        blobs.append(DIGEST, 0, DATA)
+        self.assertIsNone(blobs.size_of(DIGEST))
+        self.assertFalse(os.path.exists(blobs._partial(DIGEST)))
+        self.assertEqual(blobs._locks, {})
+    def test_hash_mismatch(self):
+        blobs.begin(DIGEST, len(DATA))
+        blobs.append(DIGEST, 0, DATA[:-1] + b"x")
+        self.assertIsNone(blobs.size_of(DIGEST))
+        self.assertFalse(os.path.exists(blobs._partial(DIGEST)))
+        self.assertEqual(blobs.begin(DIGEST, len(DATA)), "0")
+    def test_too_long(self):
+        blobs.begin(DIGEST, len(DATA))
+        blobs.append(DIGEST, 0, DATA + b"x")
+        self.assertEqual(blobs.begin(DIGEST, len(DATA)), "0")
+    def test_prune(self):
+        other = hashlib.sha256(b"other").hexdigest()
+        for digest in (DIGEST, other):
+            blobs.begin(digest, len(DATA))
+            blobs.append(digest, 0, DATA[:100])
+        old = time.time() - blobs.PARTIAL_TTL - 1
+        os.utime(blobs._partial(other), (old, old))
+        blobs.prune()
+        self.assertFalse(os.path.exists(blobs._partial(other)))
+        self.assertNotIn(other, blobs.uploads)
+        self.assertEqual(blobs.begin(other, len(DATA)), "0")
+        # the one still going is left alone
+        self.assertIn(DIGEST, blobs.uploads)
+        self.assertEqual(blobs.begin(DIGEST, len(DATA)), "100")
+        # after a restart it's only on disk until someone carries on with it
+        self.restart()
+        blobs.prune()
+        self.assertEqual(blobs._locks, {})
+        self.assertEqual(blobs.begin(DIGEST, len(DATA)), "100")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os, sys, tempfile, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "Server"))
+import channels, db
+
+class Channels(unittest.TestCase):
+    def setUp(self):
+        # logs and search indexes go in the working directory
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(folder.name)
+        for found in (channels.subscribers, channels.subscriptions, channels.cursors, channels.pending,
+                      channels.indexes, db.cold, db.archived):
+            found.clear()
+        db.id = 1
+    def post(self, channel: str, message: str) -> int:
+        return channels.post(channel, "1.0", "ann", message)
+    def test_split(self):
+        self.assertEqual(channels.split("#Room hello there"), ("room", "hello there"))
+        self.assertEqual(channels.split("#room"), ("room", ""))
+        self.assertEqual(channels.split("hello #room"), ("general", "hello #room"))
+        self.assertEqual(channels.split("#no/slashes hi"), ("general", "#no/slashes hi"))
+    def test_new_subscribers_start_at_the_end(self):
+        self.post("general", "before")
+        channels.subscribe("a", "general")
+        self.assertEqual(channels.fetch("a"), ([], {}))
+        i = self.post("general", "after")
+        lines, moved = channels.fetch("a")
+        self.assertEqual(lines, [f"{i};1.0;ann;after"])
+        self.assertEqual(moved, {"general": db.log_size("database.db")})
+    def test_only_subscribers_are_woken(self):
+        channels.subscribe("a", "general")
+        channels.subscribe("b", "room")
+        channels.wake.clear()
+        self.post("room", "hi")
+        self.assertTrue(channels.wake.is_set())
+        self.assertEqual(channels.pending, {"b": {"room"}})
+        self.assertTrue(os.path.exists(os.path.join("channels", "room.db")))
+        self.assertEqual(channels.known(), ["general", "room"])
+    def test_cursor_moves_on_delivered(self):
+        channels.subscribe("a", "general")
+        channels.subscribe("a", "room")
+        first = self.post("general", "one")
+        second = self.post("room", "two")
+        lines, moved = channels.fetch("a")
+        # ids are shared by every channel, lines from other channels say where they're from
+        self.assertEqual(lines, [f"{first};1.0;ann;one", f"#room;{second};1.0;ann;two"])
+        channels.delivered("a", moved)
+        third = self.post("room", "three")
+        self.assertEqual(channels.fetch("a")[0], [f"#room;{third};1.0;ann;three"])
+    def test_retry_fetches_the_same_lines(self):
+        channels.subscribe("a", "general")
+        i = self.post("general", "one")
+        lines, moved = channels.fetch("a")
+        self.assertEqual(channels.fetch("a"), ([], {})) # nothing new until it's marked again
+        channels.retry("a", moved)
+        self.assertEqual(channels.fetch("a"), (lines, moved))
+        channels.delivered("a", moved)
+        channels.retry("a", moved)
+        self.assertEqual(channels.fetch("a")[0], [])
+        self.assertEqual(lines, [f"{i};1.0;ann;one"])
+    def test_unsubscribe_and_drop(self):
+        channels.subscribe("a", "general")
+        channels.subscribe("a", "room")
+        self.post("room", "hi")
+        channels.unsubscribe("a", "room")
+        self.assertEqual(channels.fetch("a"), ([], {}))
+        self.post("general", "hi")
+        channels.drop("a")
+        self.assertNotIn("a", channels.pending)
+        self.assertEqual(channels.cursors, {})
+        channels.retry("a", {"general": 0}) # a send that failed after it went away
+        self.assertEqual(channels.pending, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os, sys, unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "Server"))
+import dedup
+
+class Dedup(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patch = mock.patch.object(dedup, "time", mock.Mock(time=lambda: self.now))
+        patch.start()
+        self.addCleanup(patch.stop)
+        dedup.seen.clear()
+        dedup.in_flight.clear()
+        dedup.counts.update(dict.fromkeys(dedup.counts, 0))
+    def test_in_flight_then_seen(self):
+        self.assertEqual(dedup.claim("ann", "1"), "new")
+        self.assertEqual(dedup.claim("ann", "1"), "in flight")
+        self.assertEqual(dedup.claim("bob", "1"), "new") # ids are only unique per user
+        dedup.done("ann", "1")
+        self.assertEqual(dedup.claim("ann", "1"), "seen")
+        self.assertEqual(dedup.counts, {"new": 1, "duplicate": 1, "in flight": 1, "forgotten": 0})
+    def test_forget_lets_a_resend_in(self):
+        dedup.claim("ann", "1")
+        dedup.forget("ann", "1")
+        self.assertEqual(dedup.claim("ann", "1"), "new")
+        self.assertNotIn("ann;1", dedup.seen)
+    def test_window(self):
+        dedup.claim("ann", "1")
+        dedup.done("ann", "1")
+        self.now += dedup.WINDOW
+        self.assertEqual(dedup.claim("ann", "1"), "seen")
+        self.now += 1
+        self.assertEqual(dedup.claim("ann", "1"), "new")
+        self.assertEqual(dedup.counts["forgotten"], 1)
+    def test_limit(self):
+        with mock.patch.object(dedup, "LIMIT", 3):
+            for i in "123":
+                dedup.claim("ann", i)
+                dedup.done("ann", i)
+                self.now += 1
+            # making room for the next one forgets the oldest
+            self.assertEqual(dedup.claim("ann", "4"), "new")
+            self.assertEqual(list(dedup.seen), ["ann;2", "ann;3"])
+            self.assertEqual(dedup.claim("ann", "1"), "new")
+            self.assertEqual(dedup.claim("ann", "3"), "seen")
+    def test_checkpoint(self):
+        for i in "123":
+            dedup.claim("ann", i)
+            dedup.done("ann", i)
+            self.now += 100
+        dedup.claim("ann", "4") # in flight, not saved: its message isn't in the checkpoint either
+        saved = dedup.save()
+        self.assertEqual(saved, {"ann;1": 1000.0, "ann;2": 1100.0, "ann;3": 1200.0})
+        dedup.seen.clear()
+        dedup.in_flight.clear()
+        self.now = 1000.0 + dedup.WINDOW + 50 # the restart took a while, the first one is past the window
+        dedup.load(dict(reversed(saved.items())))
+        self.assertEqual(list(dedup.seen), ["ann;2", "ann;3"])
+        self.assertEqual(dedup.claim("ann", "2"), "seen")
+        self.assertEqual(dedup.claim("ann", "1"), "new")
+        self.assertEqual(dedup.claim("ann", "4"), "new")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os, random, sys, unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "Server"))
+import hashes
+# python -m unittest discover test
+
+def gen_hash_reference(i: bytes|str, s: int) -> bytes:
+    # gen_hash as it was first written, one step at a time
+    inp = b""
+    if type(i) == str:
+        inp = i.encode("ascii")
+    elif type(i) == bytes:
+        try:
+            i.decode("ascii")
+        except UnicodeDecodeError:
+            return -2
+        inp = i
+    else:
+        return -1
+    c = 0
+    inp = bytearray(inp)
+    if len(inp) < 3:
+        for _ in range(3 - len(inp)):
+            inp.append(45)
+    output = bytearray((((inp[0] * inp[1] + inp[2]) // 3) % 95 + 32).to_bytes() * s)
+    for k in range(5):
+        for byte in inp:
+            output[c] = (output[c] + byte) % 127
+            output[c] = (output[c] * byte * k) % 127
+            output[c] %= 95
+            output[c] += 32
+            c += 1
+            if c == len(output):
+                c = 0
+    # output.append(((inp[0] * inp[1] + inp[2]) // 3) % 95 + 32)
+    return bytes(output)
+class GenHash(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(1)
+        self.cases = [(bytes(rng.randrange(128) for _ in range(rng.randrange(70))), rng.randrange(1, 90)) for _ in range(3000)]
+        self.cases += [("", 8), ("ab", 1), ("x" * 200, 7), ("\xff".encode("latin-1"), 8), (12, 8), ("pass;word", 32)]
+    def test_matches_original(self):
+        for i, size in self.cases:
+            self.assertEqual(hashes.gen_hash(i, size), gen_hash_reference(i, size), (i, size))
+    def test_batch_matches_original(self):
+        inputs = [i for i, size in self.cases if size == 8]
+        self.assertEqual(hashes.gen_hashes(inputs, 8), [gen_hash_reference(i, 8) for i in inputs])
+        for i, size in self.cases[:300]:
+            self.assertEqual(hashes.gen_hashes([i], size), [gen_hash_reference(i, size)], (i, size))
+class Passwords(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.stored = hashes.hash_password("correct horse")
+    def test_checks(self):
+        self.assertTrue(hashes.check_password("correct horse", self.stored))
+        self.assertFalse(hashes.check_password("wrong", self.stored))
+    def test_pbkdf2(self):
+        key = hashes.hashlib.pbkdf2_hmac("sha256", b"pw", b"salt", 1000)
+        stored = f"pbkdf2_sha256$1000${b'salt'.hex()}${key.hex()}"
+        self.assertTrue(hashes.check_password("pw", stored))
+        self.assertFalse(hashes.check_password("px", stored))
+    def test_malformed(self):
+        salt, key = "00" * 16, "00" * 64
+        for stored in ("", "garbage", "scrypt$1$2", f"scrypt$16384$8$1${salt}$zz", f"scrypt$3$8$1${salt}${key}",
+                       f"scrypt$16384$8${salt}${key}", f"scrypt${2 ** 40}$8$1${salt}${key}", "pbkdf2_sha256$$00$00",
+                       "pbkdf2_sha256$x$00$00", "pbkdf2_sha256$00$00", "md5$00$00"):
+            self.assertFalse(hashes.check_password("correct horse", stored), stored)
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os, sys, unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "Server"))
+import limits
+
+class Limits(unittest.TestCase):
+    def setUp(self):
+        # a clock that only moves when a test moves it, and small rates so buckets run dry in a few calls
+        self.now = 100.0
+        patches = [mock.patch.object(limits, "time", mock.Mock(monotonic=lambda: self.now)),
+                   mock.patch.multiple(limits, CLIENT_RATE=2, IP_RATE=100, GLOBAL_RATE=1000, CONNECT_RATE=1,
+                                       MAX_HANDSHAKES=2, handshakes=0)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        limits.buckets.clear()
+        limits.limited.clear()
+        limits.counts.update(dict.fromkeys(limits.counts, 0))
+    def test_burst_then_refill(self):
+        # BURST seconds of the rate up front, then one more for every 1/rate seconds waited
+        self.assertEqual([limits.allow("a", "1.2.3.4") for _ in range(5)], [True] * 4 + [False])
+        self.assertEqual(limits.counts["client rate"], 1)
+        self.assertEqual(limits.limited, {"a": 1})
+        self.now += 0.5
+        self.assertTrue(limits.allow("a", "1.2.3.4"))
+        self.assertFalse(limits.allow("a", "1.2.3.4"))
+        self.now += 60
+        self.assertEqual(sum(limits.allow("a", "1.2.3.4") for _ in range(10)), limits.CLIENT_RATE * limits.BURST)
+    def test_all_or_nothing(self):
+        # a message the ip bucket turns away takes nothing from the client's or the global bucket
+        limits.IP_RATE = 1
+        self.assertTrue(limits.allow("a", "1.2.3.4"))
+        self.assertTrue(limits.allow("a", "1.2.3.4"))
+        self.assertFalse(limits.allow("b", "1.2.3.4"))
+        self.assertEqual(limits.counts["ip rate"], 1)
+        self.assertEqual(limits.buckets[("client", "b")][0], limits.CLIENT_RATE * limits.BURST)
+        self.assertEqual(limits.buckets[("global", None)][0], limits.GLOBAL_RATE * limits.BURST - 2)
+        self.assertTrue(limits.allow("b", "5.6.7.8"))
+    def test_zero_rate_is_off(self):
+        limits.CLIENT_RATE = 0
+        self.assertTrue(all(limits.allow("a", "1.2.3.4") for _ in range(50)))
+        self.assertNotIn(("client", "a"), limits.buckets)
+    def test_forget(self):
+        for _ in range(5):
+            limits.allow("a", "1.2.3.4")
+        limits.forget("a")
+        self.assertNotIn(("client", "a"), limits.buckets)
+        self.assertNotIn("a", limits.limited)
+        self.assertTrue(limits.allow("a", "1.2.3.4"))
+    def test_handshake_slots(self):
+        limits.CONNECT_RATE = 0
+        self.assertEqual(limits.admit("1.2.3.4"), "")
+        self.assertEqual(limits.admit("5.6.7.8"), "")
+        self.assertEqual(limits.admit("9.9.9.9"), "Server busy, try again")
+        self.assertEqual(limits.counts["busy"], 1)
+        limits.handshaken()
+        self.assertEqual(limits.admit("9.9.9.9"), "")
+        self.assertEqual(limits.handshakes, 2)
+    def test_connect_rate(self):
+        limits.MAX_HANDSHAKES = 0
+        self.assertEqual([limits.admit("1.2.3.4") for _ in range(3)], ["", "", "Too many connections, try again"])
+        self.assertEqual(limits.admit("5.6.7.8"), "")
+        self.now += 1
+        self.assertEqual(limits.admit("1.2.3.4"), "")
+        self.assertEqual(limits.counts["admitted"], 4)
+        self.assertEqual(limits.counts["connect rate"], 1)
+    def test_full_buckets_are_pruned(self):
+        limits.allow("a", "1.2.3.4")
+        limits.allow("b", "1.2.3.4")
+        self.now += 0.25 # the ip and global buckets are full again, the client ones aren't
+        limits._prune(self.now)
+        self.assertEqual(set(limits.buckets), {("client", "a"), ("client", "b")})
+        limits.allow("b", "1.2.3.4")
+        self.now += 0.3 # now a's is too
+        limits._prune(self.now)
+        self.assertEqual(set(limits.buckets), {("client", "b")})
+
+if __name__ == "__main__":
+    unittest.main()
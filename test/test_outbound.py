@@ -0,0 +1,94 @@
+import os, socket, sys, threading, unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "Server"))
+import frames, outbound
+
+def delivery(i: int, prefix: str = "") -> tuple:
+    # one line, and its payload padded to 40 bytes so LIMIT counts whole deliveries
+    line = f"{prefix}{i};1.0;ann;hi"
+    return line.encode().ljust(40), [line]
+
+class Outbound(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(outbound, "LIMIT", 100) # room for two deliveries
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.sock, self.peer = socket.socketpair()
+        self.addCleanup(self.sock.close)
+        self.addCleanup(self.peer.close)
+    def session(self, policy: str) -> dict:
+        state = {"lock": threading.Lock(), "user": "ann", "sock": self.sock, "stream": None, "policy": policy}
+        outbound.attach(state, writer=False)
+        return state
+    def put(self, state: dict, *ids):
+        for i in ids:
+            outbound.put(state, frames.DELIVERY, *delivery(i))
+    def test_ids(self):
+        self.assertEqual(outbound._ids(["7;1.0;ann;a;b", "#room;3;1.0;bob;c", "@ann;9;1.0;bob;d"]), (3, 9))
+        self.assertEqual(outbound.newest(["5;1.0;ann;x"]), 5)
+    def test_under_the_limit(self):
+        state = self.session("drop")
+        self.put(state, 1, 2)
+        outbound.put(state, frames.PING, b"1.0")
+        self.assertEqual([e[0] for e in state["queue"]], [frames.DELIVERY, frames.DELIVERY, frames.PING])
+        self.assertEqual((state["queued"], state["peak"], state["dropped"]), (80, 80, 0))
+    def test_drop(self):
+        state = self.session("drop")
+        self.put(state, 1)
+        outbound.put(state, frames.PING, b"1.0")
+        self.put(state, 2, 3, 4)
+        # the oldest deliveries make room, other frames stay where they are
+        self.assertEqual([(e[0], e[3]) for e in state["queue"]], [(frames.PING, 0), (frames.DELIVERY, 3), (frames.DELIVERY, 4)])
+        self.assertEqual((state["queued"], state["dropped"], state["gaps"]), (80, 2, 0))
+    def test_coalesce(self):
+        state = self.session("coalesce")
+        outbound.put(state, frames.DELIVERY, *delivery(5, "#room;"))
+        outbound.put(state, frames.PING, b"1.0")
+        self.put(state, 6, 7)
+        # everything queued becomes one gap the client syncs over, and what comes after queues behind it
+        self.assertEqual([e[:5] for e in state["queue"]], [[frames.PING, b"1.0", 0, 0, 0], [frames.GAP, b"", 3, 5, 7]])
+        self.assertEqual((state["queued"], state["dropped"], state["gaps"]), (0, 3, 1))
+        self.put(state, 8, 9, 10)
+        self.assertEqual([e[:5] for e in state["queue"]][1:], [[frames.GAP, b"", 6, 5, 10]])
+        self.assertEqual((state["queued"], state["dropped"], state["gaps"]), (0, 6, 1))
+        self.put(state, 11)
+        self.assertEqual(state["queue"][-1][3], 11)
+        self.assertEqual(state["queued"], 40)
+    def test_disconnect(self):
+        state = self.session("disconnect")
+        with mock.patch("builtins.print"):
+            self.put(state, 1, 2, 3)
+        self.assertTrue(state["closed"])
+        self.assertEqual(self.peer.recv(1), b"") # shut down
+        self.put(state, 4)
+        self.assertEqual(len(state["queue"]), 2)
+    def test_a_big_delivery_still_goes(self):
+        state = self.session("drop")
+        outbound.put(state, frames.DELIVERY, b"x" * 500, ["1;1.0;ann;x"])
+        self.assertEqual(state["queued"], 500)
+        self.put(state, 2)
+        self.assertEqual([e[3] for e in state["queue"]], [2])
+    def test_stalled(self):
+        state = self.session("drop")
+        self.assertEqual(outbound.behind(state), 0)
+        self.put(state, 1)
+        self.assertFalse(outbound.stalled(state))
+        state["queue"][0][5] -= outbound.STALL + 1
+        self.assertTrue(outbound.stalled(state))
+    def test_writer(self):
+        state = self.session("drop")
+        self.put(state, 1)
+        outbound.put(state, frames.PING, b"1.0")
+        outbound.start(state)
+        received = b""
+        while len(received) < 2 * frames.HEAD.size + 43:
+            received += self.peer.recv(4096)
+        size, kind = frames.HEAD.unpack_from(received)
+        self.assertEqual((size, kind), (40, frames.DELIVERY))
+        self.assertEqual(received[frames.HEAD.size:frames.HEAD.size + 40], delivery(1)[0])
+        self.assertEqual(frames.HEAD.unpack_from(received, frames.HEAD.size + 40), (3, frames.PING))
+        outbound.close(state)
+        self.assertEqual(state["queued"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
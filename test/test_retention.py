@@ -0,0 +1,142 @@
+import os, sys, tempfile, time, unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "Server"))
+import db, retention
+
+LOG = "log.db"
+COUNT = 300
+OLD = COUNT * 3600 # the first message's age in seconds, the rest are an hour apart up to now
+
+class Tiers(unittest.TestCase):
+    # small blocks and segments, so a few hundred messages span the archive, cold blocks and the live file
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(folder.name)
+        patch = mock.patch.multiple(db, COLD_BLOCK=512, ARCHIVE_SEGMENT=2048)
+        patch.start()
+        self.addCleanup(patch.stop)
+        for found in (db.cold, db.archived, retention.summaries, retention.policies):
+            found.clear()
+        db.id = 1
+        start = time.time() - OLD
+        self.offsets = {}
+        for k in range(COUNT):
+            i, offset = db.add_message(f"{start + k * 3600:.0f}", "ann", f"message number {k}", LOG)
+            self.offsets[i] = offset
+        self.ids = sorted(self.offsets)
+        with db.open_log(LOG) as f:
+            self.whole = f.read()
+    def reopen(self):
+        # what a restart reads back from disk
+        db.cold.clear()
+        db.archived.clear()
+    def check_all(self, ids=None):
+        for i in self.ids if ids is None else ids:
+            k = self.ids.index(i)
+            self.assertTrue(db.fetch_message(i, LOG).endswith(f";ann;message number {k}"), i)
+            with db.open_log(LOG) as f:
+                self.assertEqual(db.read_at(f, self.offsets[i]), db.fetch_message(i, LOG))
+    def tiers(self):
+        db.compress_cold(LOG, keep=1000)
+        moved = db.archive_cold(LOG, 6)
+        self.assertGreater(moved, 0)
+        return moved
+    def test_compress(self):
+        size = db.log_size(LOG)
+        cut = db.compress_cold(LOG, keep=1000)
+        self.assertGreater(cut, size - 1100)
+        self.assertLess(os.path.getsize(LOG), 1100)
+        self.assertGreater(len(db._cold_entries(LOG)), 10)
+        self.assertEqual(db.log_size(LOG), size)
+        self.reopen()
+        with db.open_log(LOG) as f:
+            self.assertEqual(f.read(), self.whole)
+        self.check_all()
+        self.assertEqual(db.last_id(LOG), self.ids[-1])
+        self.assertEqual(db.fetch_message(self.ids[-1] + 1, LOG), -1)
+    def test_archive(self):
+        moved = self.tiers()
+        entries = db._archive_entries(LOG)
+        self.assertEqual(len(entries), 1)
+        start, end, lines, newest, name = entries[0]
+        self.assertEqual((start, end - start), (0, moved))
+        self.assertEqual(db._cold_entries(LOG)[0][0], end)
+        self.assertTrue(os.path.exists(os.path.join(LOG + ".archive", name)))
+        self.reopen()
+        self.assertEqual(db._archive_entries(LOG), entries)
+        with db.open_log(LOG) as f:
+            self.assertEqual(f.read(), self.whole)
+        self.check_all()
+    def test_remove_in_every_tier(self):
+        self.tiers()
+        end = db._archive_entries(LOG)[0][1]
+        archived = next(i for i in self.ids if self.offsets[i] < end)
+        cold = next(i for i in self.ids if self.offsets[i] > end)
+        live = self.ids[-1]
+        for i in (archived, cold, live):
+            self.assertTrue(db.remove_message(i, LOG))
+        self.assertFalse(db.remove_message(self.ids[-1] + 1, LOG))
+        self.reopen()
+        # blanked where it is, nothing after it moves
+        for i in (archived, cold, live):
+            line = db.fetch_message(i, LOG)
+            self.assertEqual(line.split(";", 3)[3].strip(), "", i)
+            self.assertEqual(len(line), len(self.whole.split(b"\n")[self.ids.index(i) + 1]))
+        self.assertEqual(db.log_size(LOG), len(self.whole))
+        self.check_all([i for i in self.ids if i not in (archived, cold, live)])
+    def test_drop_before(self):
+        self.tiers()
+        blocks = list(db._cold_entries(LOG))
+        # the archive segment and the first two cold blocks end by then, the third doesn't
+        first = db.drop_before(LOG, blocks[2][0] + 1)
+        self.assertEqual(first, blocks[2][0])
+        self.assertEqual(db._archive_entries(LOG), [])
+        self.assertEqual(os.listdir(LOG + ".archive"), [])
+        kept = [i for i in self.ids if self.offsets[i] >= first]
+        self.assertEqual(db.fetch_message(self.ids[0], LOG), -1)
+        self.reopen()
+        self.assertEqual(db.first_offset(LOG), first)
+        self.check_all(kept)
+        with db.open_log(LOG) as f:
+            self.assertEqual(f.seek(0), first)
+            self.assertEqual(f.read(), self.whole[first:])
+            self.assertEqual(db.read_at(f, self.offsets[self.ids[0]]), "")
+    def test_retain_messages(self):
+        self.tiers()
+        with mock.patch.dict(retention.defaults, {"messages": 100}):
+            done = retention.enforce("general", LOG)
+        self.assertTrue(done.startswith("dropped "))
+        kept = [i for i in self.ids if self.offsets[i] >= db.first_offset(LOG)]
+        # whole blocks go, so a few more than the policy are left, and never fewer
+        self.assertGreaterEqual(len(kept), 100)
+        self.assertLess(len(kept), 100 + 50)
+        self.check_all(kept)
+        with mock.patch.dict(retention.defaults, {"messages": 100}):
+            self.assertEqual(retention.enforce("general", LOG), "")
+    def test_retain_days(self):
+        db.compress_cold(LOG, keep=1000)
+        with mock.patch.dict(retention.policies, {"general": {"days": 5}}):
+            done = retention.enforce("general", LOG)
+        self.assertTrue(done.startswith("dropped "))
+        kept = [i for i in self.ids if self.offsets[i] >= db.first_offset(LOG)]
+        oldest = db.parse_message(db.fetch_message(kept[0], LOG))[1]
+        self.assertGreater(oldest, time.time() - 6 * 86400) # at most a block's worth past the limit
+        dropped = db.parse_message(self.whole.split(b"\n")[self.ids.index(kept[0])].decode())[1]
+        self.assertLess(dropped, time.time() - 5 * 86400) # the newest message dropped was past it
+        self.check_all(kept)
+    def test_archive_days(self):
+        db.compress_cold(LOG, keep=1000)
+        with mock.patch.dict(retention.defaults, {"archive days": 5}):
+            done = retention.enforce("general", LOG)
+        self.assertTrue(done.startswith("archived "))
+        archive = db._archive_entries(LOG)
+        self.assertGreater(len(archive), 1)
+        self.assertTrue(all(newest < time.time() - 5 * 86400 for _, _, _, newest, _ in archive))
+        self.assertEqual(db.first_offset(LOG), 0)
+        self.reopen()
+        self.check_all()
+
+if __name__ == "__main__":
+    unittest.main()
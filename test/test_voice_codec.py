@@ -0,0 +1,80 @@
+import contextlib, io, os, socket, sys, threading, unittest
+from unittest import mock
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "voice-chat-test"))
+import numpy as np
+import codec
+with contextlib.redirect_stdout(io.StringIO()): # it says hello on import
+    import client
+
+class FakeOpus:
+    # stands in for opuslib where libopus isn't installed: a "packet" is every other byte of the frame's pcm
+    APPLICATION_VOIP = 0
+    class Encoder:
+        def __init__(self, *args):
+            pass
+        def encode(self, pcm, frame_size):
+            assert len(pcm) == frame_size * 2
+            return pcm[1::2]
+    class Decoder:
+        def __init__(self, *args):
+            pass
+        def decode(self, data, frame_size):
+            assert len(data) == frame_size
+            return bytes(b for high in data for b in (0, high))
+def negotiate(theirs: list) -> str:
+    # client.negotiate_codec against a peer that offers theirs, -> the codec the client picked
+    mine, peer = socket.socketpair()
+    offered = []
+    def other_end():
+        offered.append(client.split_recv_bytes(peer).decode())
+        client.split_send_bytes(peer, ",".join(theirs).encode())
+    thread = threading.Thread(target=other_end)
+    thread.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        client.negotiate_codec(mine)
+    thread.join()
+    mine.close()
+    peer.close()
+    return client.call_codec.name, offered[0].split(",")
+
+class Negotiation(unittest.TestCase):
+    def test_call_rate_runs_opus(self):
+        self.assertIn(client.SAMPLE_RATE, codec.OpusCodec.RATES)
+    def test_picks_opus(self):
+        with mock.patch.object(codec, "opuslib", FakeOpus):
+            name, offered = negotiate(["opus", "mulaw", "pcm16", "f32"])
+        self.assertEqual(offered[0], "opus")
+        self.assertEqual(name, "opus")
+        self.assertIsInstance(client.call_codec, codec.OpusCodec)
+    def test_falls_back_without_opus_on_the_other_end(self):
+        with mock.patch.object(codec, "opuslib", FakeOpus):
+            name, _ = negotiate(["mulaw", "pcm16", "f32"])
+        self.assertEqual(name, "mulaw")
+    @unittest.skipUnless(codec.opuslib, "opuslib and libopus aren't installed")
+    def test_picks_real_opus(self):
+        name, _ = negotiate(codec.available(client.SAMPLE_RATE))
+        self.assertEqual(name, "opus")
+        samples = np.sin(np.arange(client.call_codec.frame_size * 3) / 10).astype(np.float32) * 0.5
+        self.assertEqual(len(client.call_codec.decode(client.call_codec.encode(samples))), len(samples))
+
+class Opus(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(codec, "opuslib", FakeOpus)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.codec = codec.OpusCodec(client.SAMPLE_RATE)
+    def test_waits_for_a_whole_frame(self):
+        self.assertEqual(self.codec.encode(np.zeros(self.codec.frame_size - 1, np.float32)), b"")
+        self.assertEqual(len(self.codec.pending), self.codec.frame_size - 1)
+    def test_encodes_every_whole_frame(self):
+        size = self.codec.frame_size
+        samples = np.linspace(-0.5, 0.5, size * 3 + 7).astype(np.float32)
+        data = self.codec.encode(samples)
+        self.assertEqual(len(self.codec.pending), 7)
+        self.assertEqual(len(data), 3 * (2 + size))
+        decoded = self.codec.decode(data)
+        self.assertEqual(len(decoded), size * 3)
+        np.testing.assert_allclose(decoded, samples[:size * 3], atol=1 / 64)
+
+if __name__ == "__main__":
+    unittest.main()
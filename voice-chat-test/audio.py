@@ -0,0 +1,197 @@
+from threading import Thread, Event
+from time import perf_counter, sleep
+import numpy as np
+
+try:
+    import sounddevice as sd
+except (ImportError, OSError):  # no PortAudio on this box, only the fake backend is usable
+    sd = None
+
+AUDIO_DTYPE = 'float32'
+
+
+class SharedBuf:
+    def __init__(self, size=0):
+        self.size = size
+        self.read_cursor = 0
+        self.write_cursor = 0
+        self.buffer = np.array([0] * size, dtype=AUDIO_DTYPE)
+
+    def clearbuf(self):
+        self.buffer = np.array([0] * self.size, dtype=AUDIO_DTYPE)
+        self.read_cursor = 0
+        self.write_cursor = 0
+
+    def extbuf(self, arr):
+        arr = arr.reshape(-1)
+        arr_len = len(arr)
+        # if ar is too long, truncate it
+        if arr_len > self.size:
+            arr = arr[-self.size:]
+            arr_len = self.size
+        # loop around the buffer if not enough space
+        if arr_len + self.write_cursor > self.size:
+            self.buffer[self.write_cursor:] = arr[:self.size - self.write_cursor]
+            self.buffer[:arr_len - (self.size - self.write_cursor)] = arr[self.size - self.write_cursor:]
+        else:
+            self.buffer[self.write_cursor:self.write_cursor + arr_len] = arr
+        # update write cursor
+        self.write_cursor = (self.write_cursor + arr_len) % self.size
+
+    def getlen(self):
+        if self.write_cursor >= self.read_cursor:
+            return self.write_cursor - self.read_cursor
+        else:
+            return self.size - self.read_cursor + self.write_cursor
+
+    def getfree(self):
+        # one slot always stays empty, otherwise a full buffer would look empty
+        return self.size - 1 - self.getlen()
+
+    def getbuf(self):
+        return self.buffer
+
+    def getx(self, x):
+        # read x bytes from the buffer
+        if self.read_cursor + x > self.size:
+            ret = np.append(self.buffer[self.read_cursor:], self.buffer[:self.read_cursor + x - self.size])
+        else:
+            ret = self.buffer[self.read_cursor:self.read_cursor + x][:]
+        self.read_cursor = (self.read_cursor + x) % self.size
+        return ret
+
+    def readinto(self, out):
+        # copy len(out) samples straight into out, no temporary arrays (used from the audio callback)
+        x = len(out)
+        first = min(x, self.size - self.read_cursor)
+        out[:first] = self.buffer[self.read_cursor:self.read_cursor + first]
+        out[first:] = self.buffer[:x - first]
+        self.read_cursor = (self.read_cursor + x) % self.size
+
+
+class FakeStream:
+    # stands in for sd.Stream on machines without a sound card
+    # capture is a sine tone, playback is thrown away (or kept in .played for inspection)
+    # with realtime=False the callback runs back to back, which is what benchmarks want
+    def __init__(self, samplerate, blocksize, callback, dtype=AUDIO_DTYPE, realtime=True, tone=440.0, keep=False):
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.callback = callback
+        self.dtype = dtype
+        self.realtime = realtime
+        self.tone = tone
+        self.keep = keep
+        self.played = []
+        self.blocks = 0
+        self.latency = (blocksize / samplerate, blocksize / samplerate)
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        period = self.blocksize / self.samplerate
+        indata = np.zeros((self.blocksize, 1), dtype=self.dtype)
+        outdata = np.zeros((self.blocksize, 1), dtype=self.dtype)
+        step = 2 * np.pi * self.tone / self.samplerate
+        phase = 0.0
+        deadline = perf_counter()
+        while not self._stop.is_set():
+            indata[:, 0] = 0.2 * np.sin(phase + step * np.arange(self.blocksize))
+            phase = (phase + step * self.blocksize) % (2 * np.pi)
+            self.callback(indata, outdata, self.blocksize, None, None)
+            if self.keep:
+                self.played.append(outdata[:, 0].copy())
+            self.blocks += 1
+            if self.realtime:
+                deadline += period
+                delay = deadline - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+        self.stop()
+
+
+class AudioEngine:
+    # the sound card callback feeds the capture buffer and drains the playback buffer directly,
+    # so there are no record/play threads sleeping and polling any more
+    def __init__(self, capture_buf, playback_buf, capture_cond, playback_cond, samplerate,
+                 blocksize=128, prefill=0, backend='sounddevice', **fake_options):
+        self.capture_buf = capture_buf
+        self.playback_buf = playback_buf
+        self.capture_cond = capture_cond
+        self.playback_cond = playback_cond
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        # playback waits until this many samples are buffered before starting (and after an underrun)
+        self.prefill = prefill
+        self.primed = False
+        self.blocks = 0
+        self.underruns = 0
+        self.overruns = 0
+        self.callback_time = 0.0
+        self.status_flags = 0
+        if backend == 'fake':
+            self.stream = FakeStream(samplerate, blocksize, self.callback, **fake_options)
+        else:
+            if sd is None:
+                raise RuntimeError("sounddevice/PortAudio not available, use the fake backend")
+            self.stream = sd.Stream(samplerate=samplerate, blocksize=blocksize, channels=1,
+                                    dtype=AUDIO_DTYPE, callback=self.callback)
+
+    def callback(self, indata, outdata, frames, time, status):
+        start = perf_counter()
+        if status:
+            self.status_flags += 1
+        with self.capture_cond:
+            if self.capture_buf.getfree() >= frames:
+                self.capture_buf.extbuf(indata[:, 0])
+            else:
+                # network side fell behind, drop this block rather than overwrite unsent audio
+                self.overruns += 1
+            self.capture_cond.notify()
+        with self.playback_cond:
+            available = self.playback_buf.getlen()
+            if not self.primed and available >= max(self.prefill, frames):
+                self.primed = True
+            if self.primed and available >= frames:
+                self.playback_buf.readinto(outdata[:, 0])
+            else:
+                if self.primed:
+                    self.underruns += 1
+                    self.primed = False
+                outdata.fill(0)
+        self.blocks += 1
+        self.callback_time += perf_counter() - start
+
+    def start(self):
+        self.stream.start()
+
+    def stop(self):
+        self.stream.stop()
+        self.stream.close()
+
+    def latency(self):
+        # seconds from the mic to the wire and from the wire to the speaker on this end
+        device_in, device_out = self.stream.latency
+        block = self.blocksize / self.samplerate
+        return {
+            'capture': device_in + block + self.capture_buf.getlen() / self.samplerate,
+            'playback': device_out + block + self.playback_buf.getlen() / self.samplerate,
+        }
+
+    def report(self):
+        lat = self.latency()
+        per_block = self.callback_time / self.blocks * 1e6 if self.blocks else 0.0
+        return (f"audio: block {self.blocksize} samples, {self.blocks} callbacks ({per_block:.1f}us each), "
+                f"capture latency {lat['capture'] * 1000:.1f}ms, playback latency {lat['playback'] * 1000:.1f}ms, "
+                f"{self.underruns} underruns, {self.overruns} overruns")
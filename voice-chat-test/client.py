@@ -1,12 +1,13 @@
 from threading import Thread, Lock, Condition
 import socket
-import sounddevice as sd
-from time import sleep
-import numpy as np
-from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
+import sys
+from time import sleep, perf_counter
 from socket import timeout
-from Crypto.Util.Padding import pad, unpad
+import numpy as np
+import audio
+import codec
+import framecrypt
+import qos
 
 MAX_BYTES_SEND = 512  # Must be less than 1024 because of networking limits
 MAX_HEADER_LEN = 20  # allocates 20 bytes to store length of data that is transmitted
@@ -25,56 +26,68 @@ SERVER_IP = '0.0.0.0'  # Change this to the external IP of the server
 SERVER_PORT = 9001
 running = True
 item_available = Condition()
-# amount of time CPU sleeps between sending recordings to the server
-SLEEPTIME = 0.001
 AUDIO_DTYPE = 'float32'
 audio_available = Condition()
 # number of bytes to send over network in one go
 TX_BATCH_SIZE = 64
 # number of samples to record
 RECORDING_SIZE = TX_BATCH_SIZE*2
-# sample rate of the audio
-SAMPLE_RATE = 44100
+# sample rate of the audio, 48 kHz because opus doesn't run at 44.1 kHz (see codec.OpusCodec.RATES) and every
+# other codec and sound card does 48 kHz too
+SAMPLE_RATE = 48000
 # size of the shared buffer
 SHARED_BUF_SIZE = RECORDING_SIZE*64
 # player consumer will wait until this many bytes are available in the buffer before playing
 PLAYER_READ_LAG_SIZE = RECORDING_SIZE*32
 # number of bytes to read from the buffer for playback
 PLAYER_READ_BYTE_SIZE = RECORDING_SIZE
+# samples the sound card asks for per callback, override with --blocksize
+BLOCK_SIZE = RECORDING_SIZE
+# "sounddevice" for a real sound card, "fake" (--fake) to run headless
+AUDIO_BACKEND = 'sounddevice'
 
 
 assert(PLAYER_READ_LAG_SIZE >= PLAYER_READ_BYTE_SIZE)
 assert(SHARED_BUF_SIZE >= PLAYER_READ_LAG_SIZE)
 assert(RECORDING_SIZE <= SHARED_BUF_SIZE)
 
-sdstream = sd.Stream(samplerate=SAMPLE_RATE, channels=1, dtype=AUDIO_DTYPE)
-sdstream.start()
+# codec used for this call, picked with the peer in connect()
+call_codec = None
+
+engine = None
+# per call QoS numbers, see qos.CallStats.snapshot()
+call_stats = None
+# written every STATS_INTERVAL seconds, rolls over at 1 MB ({} is the source name)
+STATS_FILE = 'voice_stats_{}.csv'
+STATS_INTERVAL = 1.0
+# in a room frames from several talkers come in interleaved, each stream id gets its own decoder (opus keeps
+# state from frame to frame) and jitter buffer, and what they have buffered is summed for playback
+streams = {}
+# seconds without a frame before a stream stops holding back the mix
+STREAM_TIMEOUT = 0.5
+# samples one stream can get ahead of a quiet one before the quiet one is mixed in as silence
+MIX_MAX_AHEAD = RECORDING_SIZE*8
+# transmit and pong replies share the socket and the cipher's output buffer
+send_lock = Lock()
 
 key = b'thisisthepasswordforAESencryptio'
-iv = get_random_bytes(16)
-cipher = AES.new(key, AES.MODE_CBC, iv)
-cphr = None
-
-
-def get_iv():
-    return get_random_bytes(16)
+# AES-GCM per frame, nonces come from a sequence counter so frames carry no IV or padding
+frame_cipher = framecrypt.FrameCipher(key)
 
 
 def decrypt(enc_data):
-    global cphr
-    if cphr is None:
-        cphr = AES.new(key, AES.MODE_CBC, enc_data[:16])
-    # decoded = cphr.decrypt(enc_data)[16:]
-    decoded = unpad(cphr.decrypt(enc_data)[16:], AES.block_size)
-    return decoded.rstrip()
+    # the result is a view into a reused buffer, the codec copies it out when decoding
+    start = perf_counter()
+    stream_id, seq, decoded = frame_cipher.open(enc_data)
+    if seq & framecrypt.CONTROL:
+        return stream_id, seq, decoded
+    if call_stats is not None:
+        call_stats.received(stream_id, seq, perf_counter() - start)
+    return stream_id, seq, decoded
 
 
-def encrypt(data_string):
-    iv = get_iv()
-    # cphr = AES.new(key, AES.MODE_CBC, iv)
-    d = iv + data_string
-    d = (d + (' ' * (len(d) % 32)).encode())
-    return cipher.encrypt(pad(d, AES.block_size))
+def encrypt(data_string, control=False):
+    return frame_cipher.seal(data_string, control)
 
 
 def split_send_bytes(s, inp):
@@ -120,69 +133,24 @@ def split_recv_bytes(s):
     return dat
 
 
-class SharedBuf:
-    def __init__(self, size=0):
-        self.size = size
-        self.read_cursor = 0
-        self.write_cursor = 0
-        self.buffer = np.array([0] * size, dtype=AUDIO_DTYPE)
-
-    def clearbuf(self):
-        self.buffer = np.array([0] * self.size, dtype=AUDIO_DTYPE)
-        self.read_cursor = 0
-        self.write_cursor = 0
-
-    def extbuf(self, arr):
-        arr = arr.reshape(-1)
-        arr_len = len(arr)
-        # if ar is too long, truncate it
-        if arr_len > self.size:
-            arr = arr[-self.size:]
-            arr_len = self.size
-        # loop around the buffer if not enough space
-        if arr_len + self.write_cursor > self.size:
-            self.buffer[self.write_cursor:] = arr[:self.size - self.write_cursor]
-            self.buffer[:arr_len - (self.size - self.write_cursor)] = arr[self.size - self.write_cursor:]
-        else:
-            self.buffer[self.write_cursor:self.write_cursor + arr_len] = arr
-        # update write cursor
-        self.write_cursor = (self.write_cursor + arr_len) % self.size
-
-    def getlen(self):
-        if self.write_cursor >= self.read_cursor:
-            return self.write_cursor - self.read_cursor
-        else:
-            return self.size - self.read_cursor + self.write_cursor
-
-    def getbuf(self):
-        return self.buffer
-
-    def getx(self, x):
-        # read x bytes from the buffer
-        if self.read_cursor + x > self.size:
-            ret = np.append(self.buffer[self.read_cursor:], self.buffer[:self.read_cursor + x - self.size])
-        else:
-            ret = self.buffer[self.read_cursor:self.read_cursor + x][:]
-        self.read_cursor = (self.read_cursor + x) % self.size
-        return ret
-
-
-
-# record t bytes of audio
-def record(t):
-    global running
-    if running:
-        recorded = sdstream.read(t)[0]
-        return recorded
+def send_frame(socket, data, control=False):
+    with send_lock:
+        start = perf_counter()
+        encrypted_str = encrypt(data, control)
+        if not control and call_stats is not None:
+            call_stats.sent(perf_counter() - start)
+        split_send_bytes(socket, encrypted_str)
 
 
 def transmit(buf, socket):
     global running
-    pickled = buf.tobytes()
-    encrypted_str = encrypt(pickled)
+    encoded = call_codec.encode_frame(buf)
+    if not encoded:
+        # codec is still buffering up a full frame
+        return
 
     try:
-        split_send_bytes(socket, encrypted_str)
+        send_frame(socket, encoded)
     except timeout:
         print("SOCKET TIMEOUT")
         running = False
@@ -191,139 +159,214 @@ def transmit(buf, socket):
         running = False
 
 
-def record_transmit_thread(serversocket):
-    print("***** STARTING RECORD TRANSMIT THREAD *****")
-    tbuf = SharedBuf(SHARED_BUF_SIZE)
+def record_transmit_thread(serversocket, tbuf):
+    # the audio callback fills tbuf, this thread only ships it
+    print("***** STARTING TRANSMIT THREAD *****")
     global running
+    while running:
+        with item_available:
+            # if buffer is empty, wait for it to be filled
+            if not item_available.wait_for(lambda: tbuf.getlen() >= TX_BATCH_SIZE, timeout=2):
+                continue
+            payload = tbuf.getx(TX_BATCH_SIZE)
+        transmit(payload, serversocket)
 
-    def recorder_producer(buf):
-        global running
-        while running:
-            sleep(SLEEPTIME/100)
-            # record does not need a lock because it is not a shared resource
-            data = record(RECORDING_SIZE)
-            if data is not None:
-                with item_available:
-                    # if buffer is full, wait for it to be emptied
-                    if item_available.wait_for(lambda: buf.getlen() <= SHARED_BUF_SIZE, timeout=2):
-                        buf.extbuf(data)
-                    item_available.notify()
-        print("RECORDER ENDS HERE")
-
-    def transmitter_consumer(buf, serversocket):
-        global running
-        while running:
-            sleep(SLEEPTIME)
-            with item_available:
-                # if buffer is empty, wait for it to be filled
-                item_available.wait_for(lambda: buf.getlen() >= TX_BATCH_SIZE, timeout=2)
-                payload = buf.getx(TX_BATCH_SIZE)
-                item_available.notify()
-            transmit(payload, serversocket)
-
-        print("TRANSMITTER ENDS HERE")
-
-    rec_thread = Thread(target=recorder_producer, args=(tbuf,))
-    tr_thread = Thread(target=transmitter_consumer, args=(tbuf, serversocket))
-
-    rec_thread.start()
-    tr_thread.start()
-
-    rec_thread.join()
-    tr_thread.join()
-    return
-
-
-# use a sound library to play the buffer
-def play(buf):
-    global running
-    if running:
-        sdstream.write(buf)
+    print("TRANSMITTER ENDS HERE")
+
+
+def control(socket, payload):
+    # pings for us get echoed straight back, pongs for our pings give us the round trip time
+    if call_stats is None:
+        return
+    if payload.startswith(qos.PING):
+        reply = call_stats.answer(payload)
+        if reply is not None:
+            send_frame(socket, reply, control=True)
+    elif payload.startswith(qos.PONG):
+        call_stats.pong(payload)
+
+
+def stats_thread(serversocket):
+    # pings the other end and appends a stats row every STATS_INTERVAL
+    log = qos.StatsLog(STATS_FILE.format(source_name), qos.CallStats.FIELDS)
+    pinged = 0
+    while running:
+        sleep(STATS_INTERVAL)
+        # one peer per ping, in turn, once we've heard from any
+        peers = list(streams)
+        if peers:
+            pinged += 1
+            try:
+                send_frame(serversocket, call_stats.ping(peers[pinged % len(peers)]), control=True)
+            except (timeout, OSError):
+                pass
+        log.write(call_stats.snapshot(engine))
+    log.close()
+
+
+def start_stats():
+    global call_stats
+    # opus sends one frame per 20 ms, everything else one per batch
+    frame_samples = getattr(call_codec, 'frame_size', TX_BATCH_SIZE)
+    call_stats = qos.CallStats(frame_samples / SAMPLE_RATE, frame_cipher.stream_id)
+
+
+class Stream:
+    # one talker in the room
+    def __init__(self):
+        self.codec = codec.new(call_codec.name, SAMPLE_RATE, AUDIO_DTYPE)
+        self.jitter = audio.SharedBuf(SHARED_BUF_SIZE)
+        self.heard = perf_counter()
 
 
 prev_receive = -1
 def receive(socket):
+    # yields (stream id, decoded samples) per frame, None when nothing came in
     global running
-    buf = None
     while running:
         try:
             dat = split_recv_bytes(socket)
-            dat = decrypt(dat)
-            buf = np.frombuffer(dat, dtype=AUDIO_DTYPE)  # read decrypted numpy array
-            yield buf
+            stream_id, seq, dat = decrypt(dat)
+            if seq & framecrypt.CONTROL:
+                control(socket, bytes(dat))
+                continue
+            stream = streams.get(stream_id)
+            if stream is None:
+                stream = streams[stream_id] = Stream()
+            stream.heard = perf_counter()
+            yield stream_id, stream.codec.decode_frame(dat)  # decode back into a float32 numpy array
         except timeout:
             print("SOCKET TIMEOUT")
             yield None
         except ValueError:
-            yield buf
+            yield None
         except ConnectionResetError:
             print("Recipient disconnected")
             yield None
 
 
-def receive_play_thread(serversocket):
-    print("***** STARTING RECEIVE PLAY THREAD *****")
-    rbuf = SharedBuf(SHARED_BUF_SIZE)
-
-    def receiver_producer(buff, serversocket):
-        global running
-        rece_generator = receive(serversocket)
-
-        data = None
-        while running:
-            sleep(SLEEPTIME)
-            try:
-                data = next(rece_generator)
-            except StopIteration:
-                pass
-
-            if data is None:
-                continue
-            with audio_available:
-                # producer does not wait for the buffer to be emptied and just overwrites it if it is full
-                buff.extbuf(data)
-                audio_available.notify()
-
-        print("RECEIVER ENDS HERE")
+def mix(rbuf):
+    # sums what every stream has buffered into rbuf. Only as much as the streams still talking all have is mixed,
+    # so one talker's frames arriving early don't get played against silence from another that's a little late
+    now = perf_counter()
+    if not streams:
+        return
+    talking = [s.jitter.getlen() for s in streams.values() if now - s.heard <= STREAM_TIMEOUT]
+    ahead = max(s.jitter.getlen() for s in streams.values())
+    n = ahead if not talking or ahead > MIX_MAX_AHEAD else min(talking)
+    if n:
+        out = np.zeros(n, dtype=AUDIO_DTYPE)
+        for s in streams.values():
+            got = min(n, s.jitter.getlen())
+            if got:
+                out[:got] += s.jitter.getx(got)
+        np.clip(out, -1.0, 1.0, out=out)
+        with audio_available:
+            # producer does not wait for the buffer to be emptied and just overwrites it if it is full
+            rbuf.extbuf(out)
+            audio_available.notify()
+    for stream_id in [i for i, s in streams.items() if now - s.heard > STREAM_TIMEOUT and not s.jitter.getlen()]:
+        del streams[stream_id]
+
+
+def receive_play_thread(serversocket, rbuf):
+    # this thread only fills rbuf, the audio callback plays it
+    print("***** STARTING RECEIVE THREAD *****")
+    global running
+    rece_generator = receive(serversocket)
 
-    def player_consumer(buff):
-        while running:
-            sleep(SLEEPTIME/100)
+    data = None
+    while running:
+        try:
+            data = next(rece_generator)
+        except StopIteration:
+            break
 
-            with audio_available:
-                if buff.getlen() < PLAYER_READ_BYTE_SIZE:
-                    # if buffer is empty, wait for it to be filled
-                    audio_available.wait_for(lambda: buff.getlen() >= PLAYER_READ_LAG_SIZE, timeout=2)
-                read_aud = buff.getx(PLAYER_READ_BYTE_SIZE)
-            # playback does not need a lock because it is not a shared resource
-            play(read_aud)
+        if data is not None:
+            stream_id, samples = data
+            streams[stream_id].jitter.extbuf(samples)
+        mix(rbuf)
 
-        print("PLAYER ENDS HERE")
+    print("RECEIVER ENDS HERE")
 
-    global running
 
-    rece_thread = Thread(target=receiver_producer, args=(rbuf, serversocket))
-    play_thread = Thread(target=player_consumer, args=(rbuf,))
-    rece_thread.start()
-    play_thread.start()
-    rece_thread.join()
-    play_thread.join()
-    return
+def start_audio(**fake_options):
+    global engine
+    tbuf = audio.SharedBuf(SHARED_BUF_SIZE)
+    rbuf = audio.SharedBuf(SHARED_BUF_SIZE)
+    engine = audio.AudioEngine(tbuf, rbuf, item_available, audio_available, SAMPLE_RATE,
+                               blocksize=BLOCK_SIZE, prefill=PLAYER_READ_LAG_SIZE,
+                               backend=AUDIO_BACKEND, **fake_options)
+    engine.start()
+    return tbuf, rbuf
 
 
 def main():
     serversocket = connect()
     global running
-    t_thread = Thread(target=record_transmit_thread, args=(serversocket,))
-    p_thread = Thread(target=receive_play_thread, args=(serversocket,))
+    tbuf, rbuf = start_audio()
+    start_stats()
+    t_thread = Thread(target=record_transmit_thread, args=(serversocket, tbuf))
+    p_thread = Thread(target=receive_play_thread, args=(serversocket, rbuf))
+    s_thread = Thread(target=stats_thread, args=(serversocket,), daemon=True)
     t_thread.start()
     p_thread.start()
+    s_thread.start()
     input("press enter to exit")
     running = False
-    sdstream.stop()
+    engine.stop()
     t_thread.join()
     p_thread.join()
     serversocket.close()
+    print(call_codec.report())
+    for stream_id, stream in streams.items():
+        print(stream_id.hex(), stream.codec.report())
+    print(engine.report())
+    print(call_stats.snapshot(engine))
+
+
+def bench(seconds=5.0, codec_name='mulaw'):
+    # headless loopback of the whole pipeline: fake mic -> codec -> encrypt -> decrypt -> codec -> fake speaker
+    global call_codec, running
+    call_codec = codec.new(codec_name, SAMPLE_RATE, AUDIO_DTYPE)
+    tbuf, rbuf = start_audio()
+    start_stats()
+    receiver = framecrypt.FrameCipher(key)
+    frames = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        with item_available:
+            if not item_available.wait_for(lambda: tbuf.getlen() >= TX_BATCH_SIZE, timeout=2):
+                continue
+            payload = tbuf.getx(TX_BATCH_SIZE)
+        encoded = call_codec.encode_frame(payload)
+        if not encoded:
+            continue
+        t = perf_counter()
+        sealed = bytes(encrypt(encoded))
+        call_stats.sent(perf_counter() - t)
+        t = perf_counter()
+        stream_id, seq, opened = receiver.open(sealed)
+        call_stats.received(stream_id, seq, perf_counter() - t)
+        with audio_available:
+            rbuf.extbuf(call_codec.decode_frame(opened))
+        frames += 1
+    engine.stop()
+    print(f"{frames} frames through the pipeline in {seconds}s")
+    print(call_codec.report())
+    print(engine.report())
+    print(call_stats.snapshot(engine))
+
+
+def negotiate_codec(s):
+    # both ends send the codecs they can run and pick the best shared one
+    global call_codec
+    mine = codec.available(SAMPLE_RATE)
+    split_send_bytes(s, ','.join(mine).encode('utf8'))
+    theirs = split_recv_bytes(s).decode('utf8').split(',')
+    name = codec.negotiate(mine, theirs)
+    call_codec = codec.new(name, SAMPLE_RATE, AUDIO_DTYPE)
+    print(f"using codec {name}")
 
 
 def connect():
@@ -346,12 +389,11 @@ def connect():
     val = s.recv(2)
     if val.decode() != 'go':
         raise TypeError
+    negotiate_codec(s)
     # returns socket fd
     s.settimeout(5.0)
     return s
 
-
-main()
 # 2 separate websocket connections for receiving and sending files
 # 2 separate threads to handle transmission and playback of the audio files
 
@@ -362,4 +404,14 @@ main()
 # disconnect server
 
 
-print("client terminating")
\ No newline at end of file
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if '--fake' in args:
+        AUDIO_BACKEND = 'fake'
+    if '--blocksize' in args:
+        BLOCK_SIZE = int(args[args.index('--blocksize') + 1])
+    if '--bench' in args:
+        bench()
+    else:
+        main()
+    print("client terminating")
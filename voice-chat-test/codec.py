@@ -0,0 +1,163 @@
+from time import perf_counter
+import numpy as np
+
+try:
+    import opuslib
+except ImportError:  # opus is optional, the pure numpy codecs always work
+    opuslib = None
+
+# codecs in order of preference, the first one both peers support wins
+PREFERENCE = ['opus', 'mulaw', 'pcm16', 'f32']
+MULAW_MU = 255
+
+
+class Codec:
+    # base class, also the "f32" codec which ships the raw float32 samples untouched
+    name = 'f32'
+
+    def __init__(self, sample_rate, dtype='float32'):
+        self.sample_rate = sample_rate
+        self.dtype = dtype
+        # per frame cost, filled in by encode_frame/decode_frame
+        self.frames_encoded = 0
+        self.frames_decoded = 0
+        self.encode_time = 0.0
+        self.decode_time = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @classmethod
+    def supported(cls, sample_rate):
+        return True
+
+    def encode(self, samples):
+        return samples.astype(self.dtype, copy=False).tobytes()
+
+    def decode(self, data):
+        # copy, the decrypted frame lives in a buffer that gets reused for the next one
+        return np.frombuffer(data, dtype=self.dtype).copy()
+
+    def encode_frame(self, samples):
+        start = perf_counter()
+        data = self.encode(samples.reshape(-1))
+        self.encode_time += perf_counter() - start
+        self.frames_encoded += 1
+        self.bytes_in += samples.size * 4
+        self.bytes_out += len(data)
+        return data
+
+    def decode_frame(self, data):
+        start = perf_counter()
+        samples = self.decode(data)
+        self.decode_time += perf_counter() - start
+        self.frames_decoded += 1
+        return samples
+
+    def ratio(self):
+        # compression ratio against raw float32
+        if self.bytes_out == 0:
+            return 1.0
+        return self.bytes_in / self.bytes_out
+
+    def report(self):
+        enc = self.encode_time / self.frames_encoded * 1e6 if self.frames_encoded else 0.0
+        dec = self.decode_time / self.frames_decoded * 1e6 if self.frames_decoded else 0.0
+        return (f"codec {self.name}: {self.frames_encoded} frames out, {self.frames_decoded} frames in, "
+                f"{self.ratio():.1f}x smaller, encode {enc:.1f}us/frame, decode {dec:.1f}us/frame")
+
+
+class Pcm16Codec(Codec):
+    # 16 bit linear pcm, halves the bandwidth with no audible loss
+    name = 'pcm16'
+
+    def encode(self, samples):
+        return (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+    def decode(self, data):
+        return np.frombuffer(data, dtype='<i2').astype(self.dtype) / np.float32(32768)
+
+
+class MulawCodec(Codec):
+    # G.711 style mu-law companding, 8 bits per sample
+    name = 'mulaw'
+    # decoding is a straight lookup, build the table once for every instance
+    _table = None
+
+    def __init__(self, sample_rate, dtype='float32'):
+        super().__init__(sample_rate, dtype)
+        if MulawCodec._table is None:
+            y = np.arange(256, dtype=np.float32) / np.float32(127.5) - 1
+            MulawCodec._table = (np.sign(y) * (np.power(1 + MULAW_MU, np.abs(y)) - 1) / MULAW_MU).astype(np.float32)
+
+    def encode(self, samples):
+        x = np.clip(samples, -1.0, 1.0)
+        y = np.sign(x) * np.log1p(MULAW_MU * np.abs(x)) / np.log1p(MULAW_MU)
+        return np.rint((y + 1) * 127.5).astype(np.uint8).tobytes()
+
+    def decode(self, data):
+        return MulawCodec._table[np.frombuffer(data, dtype=np.uint8)].astype(self.dtype, copy=False)
+
+
+class OpusCodec(Codec):
+    # only used when opuslib (and libopus) is installed on both ends
+    name = 'opus'
+    RATES = (8000, 12000, 16000, 24000, 48000)
+    FRAME_MS = 20
+
+    def __init__(self, sample_rate, dtype='float32'):
+        super().__init__(sample_rate, dtype)
+        self.frame_size = sample_rate * self.FRAME_MS // 1000
+        self.encoder = opuslib.Encoder(sample_rate, 1, opuslib.APPLICATION_VOIP)
+        self.decoder = opuslib.Decoder(sample_rate, 1)
+        # opus needs whole frames, so hold on to samples until one is ready
+        self.pending = np.zeros(0, dtype=np.float32)
+
+    @classmethod
+    def supported(cls, sample_rate):
+        return opuslib is not None and sample_rate in cls.RATES
+
+    def encode(self, samples):
+        # every whole frame that's pending goes out in this one transport frame, each opus packet behind its
+        # 2 byte length so the other end can decode them one by one
+        self.pending = np.append(self.pending, samples)
+        whole = len(self.pending) // self.frame_size * self.frame_size
+        if whole == 0:
+            return b''
+        frames, self.pending = self.pending[:whole], self.pending[whole:]
+        pcm = (np.clip(frames, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+        step = self.frame_size * 2
+        out = bytearray()
+        for i in range(0, len(pcm), step):
+            packet = self.encoder.encode(pcm[i:i + step], self.frame_size)
+            out += len(packet).to_bytes(2, 'little') + packet
+        return bytes(out)
+
+    def decode(self, data):
+        data = bytes(data)
+        pcm = []
+        i = 0
+        while i + 2 <= len(data):
+            size = int.from_bytes(data[i:i + 2], 'little')
+            pcm.append(self.decoder.decode(data[i + 2:i + 2 + size], self.frame_size))
+            i += 2 + size
+        return np.frombuffer(b''.join(pcm), dtype='<i2').astype(self.dtype) / np.float32(32768)
+
+
+CODECS = {c.name: c for c in (OpusCodec, MulawCodec, Pcm16Codec, Codec)}
+
+
+def available(sample_rate):
+    # names of the codecs this end can run, best first
+    return [name for name in PREFERENCE if CODECS[name].supported(sample_rate)]
+
+
+def negotiate(mine, theirs):
+    # both ends run this with the same lists, so both pick the same codec
+    for name in PREFERENCE:
+        if name in mine and name in theirs:
+            return name
+    return 'f32'
+
+
+def new(name, sample_rate, dtype='float32'):
+    return CODECS[name](sample_rate, dtype)
@@ -0,0 +1,87 @@
+import struct
+from Crypto.Random import get_random_bytes
+
+try:
+    # reusable AES-GCM context that can write straight into our buffers
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError:
+    AESGCM = None
+    from Crypto.Cipher import AES
+
+# frame layout: stream id (4) | sequence number (4) | ciphertext | tag (16)
+# the nonce is the stream id followed by the sequence number widened to 8 bytes, so nothing
+# random travels with each frame and there is no padding, AES-GCM works on any length
+HEADER = struct.Struct('>4sI')
+TAG_LEN = 16
+OVERHEAD = HEADER.size + TAG_LEN
+MAX_FRAME = 64 * 1024
+# control frames (pings and the like) count in their own sequence space, marked by the top bit
+CONTROL = 1 << 31
+
+
+def nonce(stream_id, seq):
+    return stream_id + seq.to_bytes(8, 'big')
+
+
+class FrameCipher:
+    # one per call, seals outgoing frames and opens incoming ones (several senders in a room)
+    def __init__(self, key, max_frame=MAX_FRAME):
+        self.key = key
+        self.aead = AESGCM(key) if AESGCM is not None else None
+        # every stream gets a fresh random id so two calls on the same key never share nonces
+        self.stream_id = get_random_bytes(4)
+        self.seq = 0
+        self.control_seq = CONTROL
+        self.last_seq = {}  # {(stream id, control bit) : highest sequence number opened}
+        self.out_buf = bytearray(max_frame + OVERHEAD)
+        self.in_buf = bytearray(max_frame + TAG_LEN)
+
+    def seal(self, data, control=False):
+        # encrypts into the preallocated output buffer, the returned view is only valid until the next seal()
+        n = len(data)
+        out = memoryview(self.out_buf)
+        if control:
+            self.control_seq += 1
+            seq = self.control_seq
+        else:
+            self.seq += 1
+            seq = self.seq
+        HEADER.pack_into(out, 0, self.stream_id, seq)
+        header = out[:HEADER.size]
+        body = out[HEADER.size:HEADER.size + n + TAG_LEN]
+        iv = nonce(self.stream_id, seq)
+        if self.aead is not None:
+            self.aead.encrypt_into(iv, data, header, body)
+        else:
+            c = AES.new(self.key, AES.MODE_GCM, nonce=iv, mac_len=TAG_LEN)
+            c.update(header)
+            c.encrypt(data, output=body[:n])
+            body[n:] = c.digest()
+        return out[:HEADER.size + n + TAG_LEN]
+
+    def open(self, frame):
+        # returns (stream id, sequence number, plaintext view), raises ValueError on a bad or replayed frame
+        # control frames come back with the CONTROL bit set in their sequence number
+        if len(frame) < OVERHEAD:
+            raise ValueError("frame too short")
+        stream_id, seq = HEADER.unpack_from(frame)
+        space = (stream_id, seq & CONTROL)
+        if seq <= self.last_seq.get(space, seq & CONTROL):
+            raise ValueError("replayed or reordered frame")
+        frame = memoryview(frame)
+        n = len(frame) - OVERHEAD
+        iv = nonce(stream_id, seq)
+        out = memoryview(self.in_buf)
+        if self.aead is not None:
+            try:
+                self.aead.decrypt_into(iv, frame[HEADER.size:], frame[:HEADER.size], out[:n])
+            except InvalidTag:
+                raise ValueError("frame failed authentication")
+        else:
+            c = AES.new(self.key, AES.MODE_GCM, nonce=iv, mac_len=TAG_LEN)
+            c.update(frame[:HEADER.size])
+            c.decrypt(frame[HEADER.size:HEADER.size + n], output=out[:n])
+            c.verify(frame[HEADER.size + n:])
+        self.last_seq[space] = seq
+        return stream_id, seq, out[:n]
@@ -0,0 +1,143 @@
+import csv
+import os
+from threading import Lock
+from time import perf_counter, time
+
+PING = b'PING'
+PONG = b'PONG'
+# pings and pongs carry the pinger's stream id, the stream id of the peer it asks and a ping id. In a room the
+# relay hands control frames to everyone, so only the peer asked answers and only the pinger takes the pong
+STREAM_ID_LEN = 4
+
+
+def parse(payload, kind):
+    # (pinger's stream id, asked peer's stream id, ping id) from a ping or pong payload
+    at = len(kind)
+    pinger = payload[at:at + STREAM_ID_LEN]
+    peer = payload[at + STREAM_ID_LEN:at + 2 * STREAM_ID_LEN]
+    return pinger, peer, int.from_bytes(payload[at + 2 * STREAM_ID_LEN:at + 2 * STREAM_ID_LEN + 4], 'big')
+
+
+class StatsLog:
+    # csv file that rolls over to .1, .2, ... once it grows past max_bytes
+    def __init__(self, path, fields, max_bytes=1024 * 1024, backups=3):
+        self.path = path
+        self.fields = ['time'] + list(fields)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.f = None
+        self._open()
+
+    def _open(self):
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.f = open(self.path, 'a', newline='')
+        self.writer = csv.DictWriter(self.f, self.fields, extrasaction='ignore')
+        if new:
+            self.writer.writeheader()
+
+    def _roll(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, row):
+        if self.f.tell() >= self.max_bytes:
+            self._roll()
+        self.writer.writerow(dict(row, time=round(time(), 3)))
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class CallStats:
+    # per call numbers for the voice client, snapshot() is the stats api
+    FIELDS = ['frames_sent', 'frames_received', 'frames_lost', 'loss_pct', 'jitter_ms', 'rtt_ms',
+              'encrypt_us', 'decrypt_us', 'tx_fill', 'rx_fill', 'underruns', 'overruns']
+
+    def __init__(self, frame_interval, stream_id):
+        self.frame_interval = frame_interval
+        self.stream_id = stream_id  # ours, pongs for other stream ids are someone else's
+        self.lock = Lock()
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.frames_lost = 0
+        self.encrypt_time = 0.0
+        self.decrypt_time = 0.0
+        self.jitter = 0.0
+        self.rtt = None
+        self.streams = {}  # {stream id : (last sequence number, arrival time)}
+        self.pings = {}  # {ping id : time sent}
+        self.ping_id = 0
+
+    def sent(self, encrypt_time):
+        with self.lock:
+            self.frames_sent += 1
+            self.encrypt_time += encrypt_time
+
+    def received(self, stream_id, seq, decrypt_time):
+        now = perf_counter()
+        with self.lock:
+            self.frames_received += 1
+            self.decrypt_time += decrypt_time
+            last = self.streams.get(stream_id)
+            if last is not None:
+                last_seq, last_arrival = last
+                if seq > last_seq + 1:
+                    self.frames_lost += seq - last_seq - 1
+                # RFC 3550 style running jitter, against the nominal frame spacing since frames carry no clock
+                d = (now - last_arrival) - (seq - last_seq) * self.frame_interval
+                self.jitter += (abs(d) - self.jitter) / 16
+            self.streams[stream_id] = (seq, now)
+
+    def ping(self, peer):
+        # payload for a ping control frame to the peer with that stream id, it echoes it back as a pong
+        with self.lock:
+            self.ping_id += 1
+            self.pings[self.ping_id] = perf_counter()
+            # forget pings that never came back
+            for old in [p for p in self.pings if p < self.ping_id - 8]:
+                del self.pings[old]
+            return PING + self.stream_id + peer + self.ping_id.to_bytes(4, 'big')
+
+    def answer(self, payload):
+        # the pong for a ping, None if the ping was for someone else
+        pinger, peer, ping_id = parse(payload, PING)
+        if peer != self.stream_id:
+            return None
+        return PONG + pinger + peer + ping_id.to_bytes(4, 'big')
+
+    def pong(self, payload):
+        pinger, _, ping_id = parse(payload, PONG)
+        if pinger != self.stream_id:
+            return
+        with self.lock:
+            sent = self.pings.pop(ping_id, None)
+            if sent is not None:
+                self.rtt = perf_counter() - sent
+
+    def snapshot(self, engine=None):
+        with self.lock:
+            total = self.frames_received + self.frames_lost
+            snap = {
+                'frames_sent': self.frames_sent,
+                'frames_received': self.frames_received,
+                'frames_lost': self.frames_lost,
+                'loss_pct': round(100 * self.frames_lost / total, 2) if total else 0.0,
+                'jitter_ms': round(self.jitter * 1000, 3),
+                'rtt_ms': round(self.rtt * 1000, 3) if self.rtt is not None else None,
+                'encrypt_us': round(self.encrypt_time / self.frames_sent * 1e6, 1) if self.frames_sent else 0.0,
+                'decrypt_us': round(self.decrypt_time / self.frames_received * 1e6, 1) if self.frames_received else 0.0,
+            }
+        if engine is not None:
+            snap['tx_fill'] = engine.capture_buf.getlen()
+            snap['rx_fill'] = engine.playback_buf.getlen()
+            snap['underruns'] = engine.underruns
+            snap['overruns'] = engine.overruns
+        return snap
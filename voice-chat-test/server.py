@@ -1,115 +1,307 @@
-from time import sleep
-from threading import Thread, Lock, Condition
-import pickle
+import asyncio
 import socket
+import struct
+import sys
+from collections import deque
+from time import perf_counter, process_time
+import qos
 
 SOCK_IP = '0.0.0.0'  # internal IP  of the server
 SOCK_PORT = 9001
 
+NAME_LEN = 512  # names are space padded to 512 bytes by the client
+MAX_HEADER_LEN = 20  # every frame starts with a 20 byte zero padded length, same as the client
+PEER_QUEUE_FRAMES = 32  # frames queued per listener before the oldest ones get dropped
+ROOM_PREFIX = '#'  # a recipient name starting with this joins a room instead of calling one person
+# rooms interleave frames from several speakers so they need a stateless codec every client has
+ROOM_CODECS = b'mulaw,pcm16,f32'
+# stream id and sequence number sit in clear right after the length header (see framecrypt.py)
+FRAME_ID = struct.Struct('>4sI')
+CONTROL = 1 << 31
+STATS_FILE = 'relay_stats.csv'
+STATS_INTERVAL = 1.0
+STATS_FIELDS = ['peer', 'recipient', 'frames_in', 'frames_out', 'frames_lost', 'dropped', 'queued', 'write_buffer']
+verbose = True
 
-class Client:
-    allClients = []
-    availableClients = {}  # {'client name' : client object}
 
+def log(msg):
+    if verbose:
+        print(msg)
 
-    def __init__(self, client_ptr):
-        Client.allClients.append(self)
-        self.cl_ptr = client_ptr
+
+class Peer(asyncio.Protocol):
+    # one connection, driven entirely by the event loop callbacks (no thread, no polling)
+    def __init__(self, relay):
+        self.relay = relay
+        self.transport = None
+        self.buf = bytearray()
         self.name = None
-        self.name = self.get_name()
-        self.recipient_name = None
-        self.recipient_name = self.get_recipient_name()
-        print(f"received name {self.name} and recipient {self.recipient_name}")
-        Client.availableClients[self.name] = self
-        try:
-            self.lobby()
-        except ConnectionResetError:
-            print("CONNECTION RESET ERROR")
-            self.close()
-        except BrokenPipeError:
-            print("BROKEN PIPE. Closing connection")
-            self.close()
-
-    def lobby(self):
-        cl = None
-        while True:
+        self.recipient = None
+        self.partner = None
+        self.room = None
+        self.started = False
+        # frames waiting while the socket is backed up, oldest ones fall off the end
+        self.queue = deque(maxlen=PEER_QUEUE_FRAMES)
+        self.paused = False
+        self.hungup = False
+        self.frames = 0
+        self.dropped = 0
+        self.frames_in = 0
+        self.lost = 0
+        self.last_seq = {}  # {stream id : last sequence number seen}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def data_received(self, data):
+        buf = self.buf
+        buf += data
+        if self.recipient is None:
+            if len(buf) < NAME_LEN * 2:
+                return
+            self.name = buf[:NAME_LEN].decode().rstrip()
+            log(f"Client connected: {self.name}")
+            self.recipient = buf[NAME_LEN:NAME_LEN * 2].decode().rstrip()
+            log(f"Client {self.name} wants to connect to {self.recipient}")
+            del buf[:NAME_LEN * 2]
+            self.relay.join(self)
+        if not self.started:
+            # hold on to anything sent early until there is someone to forward it to
+            return
+        # forward whole frames so frames from different speakers never get spliced together
+        pos = 0
+        end = len(buf)
+        while end - pos >= MAX_HEADER_LEN:
             try:
-                cl = Client.availableClients[self.recipient_name]
-                if cl.get_recipient_name() == self.name:
-                    break
-                else:
-                    print("recipient busy.")
-                    sleep(1)
-            except KeyError:
-                print("waiting...")
-                sleep(1)
-                continue
-        if cl is not None:
-            # found a client who wants to connect to self
-            self.cl_ptr[0].send('go'.encode())
-            self.converse(cl)
-        self.close()
-
-    # Enter a loop to keep searching for recipient in available clients
-
-    def get_name(self):
-        if self.name is None:
-            # receive name
-            self.name = self.cl_ptr[0].recv(512).decode().rstrip()
-            print(f"Client connected: {self.name}")
-        return self.name
-
-    def get_recipient_name(self):
-        if self.recipient_name is None:
-            # receive recipient name
-            self.recipient_name = self.cl_ptr[0].recv(512).decode().rstrip()
-            print(f"Client {self.name} wants to connect to {self.recipient_name}")
-        return self.recipient_name
-
-    # def getRecipientSocket(self):
-    #     search list of available clients
-
-    def converse(self, recipient_obj):
-        print("establishing connection...")
-        try:
-            while True:
-                self.send(recipient_obj, self.read())
-        except KeyboardInterrupt:
-            self.close()
-        except OSError:
-            self.close()
-
-    def send(self, cl_object, data):
-        cl_object.cl_ptr[0].send(data)
-
-    def read(self):
-        return self.cl_ptr[0].recv(1024)
-
-    def close(self):
-        try:
-            Client.allClients.remove(self)
-        except ValueError:
-            print("Client does not exist in 'allClients' array")
-        Client.availableClients.pop(self.get_name(), None)
-        self.cl_ptr[0].close()
-        print(f"Client {self.name} removed.")
+                size = int(buf[pos:pos + MAX_HEADER_LEN])
+            except ValueError:
+                log(f"Client {self.name} sent a broken frame header, dropping it")
+                self.transport.close()
+                return
+            if end - pos - MAX_HEADER_LEN < size:
+                break
+            frame = bytes(buf[pos:pos + MAX_HEADER_LEN + size])
+            pos += MAX_HEADER_LEN + size
+            self.frames_in += 1
+            if self.frames_in == 1:
+                # the first frame is the codec list
+                if self.room is not None:
+                    # the room answers it instead of the other members
+                    self.push(str(len(ROOM_CODECS)).encode().rjust(MAX_HEADER_LEN, b'0') + ROOM_CODECS)
+                    continue
+            elif size >= FRAME_ID.size:
+                self.count(frame)
+            for target in self.targets():
+                target.push(frame)
+        del buf[:pos]
+
+    def count(self, frame):
+        # loss as seen by the relay, so a bad call can be split into uplink and downlink trouble
+        stream_id, seq = FRAME_ID.unpack_from(frame, MAX_HEADER_LEN)
+        if seq & CONTROL:
+            return
+        last = self.last_seq.get(stream_id)
+        if last is not None and seq > last + 1:
+            self.lost += seq - last - 1
+        self.last_seq[stream_id] = seq
+
+    def stats(self):
+        return {
+            'peer': self.name,
+            'recipient': self.recipient,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames,
+            'frames_lost': self.lost,
+            'dropped': self.dropped,
+            'queued': len(self.queue),
+            'write_buffer': self.transport.get_write_buffer_size(),
+        }
+
+    def start(self):
+        # called by the relay once the call is set up
+        self.started = True
+        self.transport.write(b'go')
+        if self.buf:
+            self.data_received(b'')
+
+    def targets(self):
+        if self.room is not None:
+            return [p for p in self.room if p is not self]
+        return [self.partner] if self.partner is not None else []
+
+    def push(self, frame):
+        # never let one slow listener hold up the speaker, old audio is worthless anyway
+        if self.paused:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(frame)
+            return
+        self.transport.write(frame)
+        self.frames += 1
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        while self.queue and not self.paused:
+            self.push(self.queue.popleft())
+        if self.hungup and not self.queue:
+            self.transport.close()
+
+    def hangup(self):
+        # close once whatever is still queued has been sent
+        self.partner = None
+        self.hungup = True
+        if not self.queue:
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.recipient is not None:
+            self.relay.leave(self)
+
+
+class Relay:
+    def __init__(self):
+        self.waiting = {}  # {'client name' : Peer} for people waiting for their recipient
+        self.rooms = {}  # {'#room' : set of Peers}
+        self.peers = set()
+
+    def stats(self):
+        # one dict per connected client, this is what ends up in the stats file
+        return [p.stats() for p in self.peers]
+
+    def log_stats(self, stats_log):
+        loop = asyncio.get_running_loop()
+        for row in self.stats():
+            stats_log.write(row)
+        loop.call_later(STATS_INTERVAL, self.log_stats, stats_log)
+
+    def join(self, peer):
+        self.peers.add(peer)
+        if peer.recipient.startswith(ROOM_PREFIX):
+            peer.room = self.rooms.setdefault(peer.recipient, set())
+            peer.room.add(peer)
+            log(f"Client {peer.name} joined room {peer.recipient} ({len(peer.room)} in room)")
+            peer.start()
+            return
+        other = self.waiting.get(peer.recipient)
+        if other is not None and other.recipient == peer.name:
+            # found a client who wants to connect to us, start both ends
+            del self.waiting[peer.recipient]
+            peer.partner, other.partner = other, peer
+            other.start()
+            peer.start()
+        else:
+            log(f"Client {peer.name} waiting for {peer.recipient}")
+            self.waiting[peer.name] = peer
+
+    def leave(self, peer):
+        self.peers.discard(peer)
+        if self.waiting.get(peer.name) is peer:
+            del self.waiting[peer.name]
+        if peer.room is not None:
+            peer.room.discard(peer)
+            if not peer.room:
+                self.rooms.pop(peer.recipient, None)
+        if peer.partner is not None:
+            # hang up the other end as well, same as the old converse() loop dying
+            peer.partner.hangup()
+        log(f"Client {peer.name} removed.")
+
+
+async def serve(host=SOCK_IP, port=SOCK_PORT):
+    relay = Relay()
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: Peer(relay), host, port, backlog=1024)
+    log(f"binding socket on {host}:{port}")
+    stats_log = qos.StatsLog(STATS_FILE, STATS_FIELDS)
+    relay.log_stats(stats_log)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        stats_log.close()
+
+
+async def bench_clients(port, calls, frames, interval, frame_size, first):
+    # runs in a child process so the fake clients don't compete with the relay for the event loop
+    samples = []
+
+    async def client(name, recipient):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(name.ljust(NAME_LEN).encode() + recipient.ljust(NAME_LEN).encode())
+        return reader, writer
+
+    async def talk(reader, writer):
+        await reader.readexactly(2)
+        payload = b'\0' * (frame_size - 8)
+        header = str(frame_size).encode().rjust(MAX_HEADER_LEN, b'0')
+
+        async def send():
+            for _ in range(frames):
+                writer.write(header + int(perf_counter() * 1e9).to_bytes(8, 'big') + payload)
+                await asyncio.sleep(interval)
+
+        async def recv():
+            for _ in range(frames):
+                body = (await reader.readexactly(MAX_HEADER_LEN + frame_size))[MAX_HEADER_LEN:]
+                samples.append(perf_counter() - int.from_bytes(body[:8], 'big') / 1e9)
+
+        await asyncio.gather(send(), recv())
+        writer.close()
+
+    ends = [await client(f'{"ab"[first]}{i}', f'{"ba"[first]}{i}') for i in range(calls)]
+    await asyncio.gather(*(talk(r, w) for r, w in ends))
+    return samples
+
+
+def run_bench_clients(port, calls, frames, interval, frame_size, first, out):
+    out.put(asyncio.run(bench_clients(port, calls, frames, interval, frame_size, first)))
+
+
+async def bench(calls=500, frames=250, interval_ms=20, frame_size=256):
+    # loopback benchmark: <calls> calls, both ends sending a frame every <interval_ms>
+    import multiprocessing
+    global verbose
+    verbose = False
+    relay = Relay()
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: Peer(relay), '127.0.0.1', 0, backlog=4096)
+    port = server.sockets[0].getsockname()[1]
+    out = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=run_bench_clients,
+                                     args=(port, calls, frames, interval_ms / 1000, frame_size, first, out))
+             for first in (0, 1)]
+    start = perf_counter()
+    cpu = process_time()
+    for p in procs:
+        p.start()
+    samples = []
+    for _ in procs:
+        samples += await loop.run_in_executor(None, out.get)
+    elapsed = perf_counter() - start
+    cpu = process_time() - cpu
+    server.close()
+    samples.sort()
+    print(f"{calls} calls, {len(samples)} frames relayed in {elapsed:.2f}s, "
+          f"relay cpu {cpu / len(samples) * 1e6:.1f}us/frame")
+    print(f"relay latency p50 {samples[len(samples) // 2] * 1000:.2f}ms "
+          f"p99 {samples[int(len(samples) * 0.99)] * 1000:.2f}ms max {samples[-1] * 1000:.2f}ms")
+
 
 def main():
-    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    print(f"binding socket on {SOCK_IP}:{SOCK_PORT}")
-    serversocket.bind((SOCK_IP, SOCK_PORT))
-    serversocket.listen(3)
-
-    while True:
-        try:
-            client_id = (serversocket.accept(),)
-            thrd1 = Thread(target=client_handler, args=client_id)
-            thrd1.start()
-        except KeyboardInterrupt:
-            serversocket.close()
-            break
-
-def client_handler(clientid):
-    Client(clientid)
-
-main()
\ No newline at end of file
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench':
+        asyncio.run(bench(*(int(v) for v in sys.argv[2:])))
+    else:
+        main()